@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+from collections import namedtuple
+from opcodes import OpCodes
+import array, math
+
+# A compiled basic block. func() runs the block and returns the new PC, or
+# None if the block couldn't run, in which case nothing has been changed and
+# the block should be interpreted instead. addrs are the addresses of the
+# opcodes in the block, and length is how many there are, which is also how
+# many cycles the block takes. func is None if the opcode at start can't be
+# compiled, so it always has to be interpreted.
+Block = namedtuple("Block", "start, end, length, addrs, func, source")
+
+class BlockCompiler:
+  """
+  Compiles basic blocks of a FastCPU's program into Python functions.
+
+  A block is a run of opcodes that don't branch, ending with the first
+  opcode that branches, touches the call stack, waits, or writes somewhere
+  (which might be program RAM). The opcodes before that are compiled to
+  straight-line code on local variables, so nothing is pushed or popped.
+  At the end, the stack, PC, Cycles and SysTime are updated once, and then
+  the last opcode is run, either inline or by calling its normal handler.
+
+  A block checks up front that the stack has enough items and room for
+  everything it does. If it can't run, or anything in it raises before the
+  CPU has been updated, it returns None with nothing changed, and the
+  caller interprets it instead, which gets the same exception in the same
+  place as stepping would.
+  """
+  Opcodes = OpCodes()
+
+  # Longest block. Keeps the generated functions a sensible size.
+  MAXLENGTH = 64
+
+  # Opcodes that end a block, and are run after the CPU has been updated.
+  # The branches, calls, stores and loops are done inline, the rest by their
+  # handlers.
+  ENDERS = {'BZ', 'BNZ', 'BRA', 'CALL', ';', 'EXIT', 'FOR', 'ENDFOR', 'WAIT', 'STOP',
+    '!', '!B', 'IOW', 'TOR', 'FROMR'}
+
+  # Opcodes that are always interpreted, because their stack effect depends
+  # on the data, or there's nothing to gain.
+  UNCOMPILED = {'COPY', 'IORT'}
+
+  def __init__(self, cpu):
+    self.CPU = cpu
+    self.Globals = {'math' : math}
+    self.Rounder = array.array('f', [0.0])
+
+  def compile(self, start):
+    """
+    Compile the block starting at start
+    """
+    cpu = self.CPU
+    addrs = []
+    addr = start
+    ender = None
+    ins = None
+    while (len(addrs) < self.MAXLENGTH) and (addr < len(cpu.ROM)):
+      ins = cpu.Decoded[addr]
+      if ins is None:
+        ins = cpu.decode(addr)
+
+      name = self.opName(ins)
+      if (name is None) or (name in self.UNCOMPILED):
+        break
+
+      addrs.append(addr)
+      addr = ins.nextpc
+      if name in self.ENDERS:
+        ender = name
+        break
+
+    if not addrs:
+      return Block(start, start+1 if ins is None else ins.nextpc, 0, (), None, None)
+
+    source = self.generate(addrs, ender)
+    code = compile(source, f"<block {start}>", 'exec')
+    local = {}
+    exec(code, self.Globals, local)
+    func = local['make'](cpu, cpu.Stack, cpu.Stack.Values, cpu.CallStack, cpu.SysTime, self.Rounder)
+
+    return Block(start, addr, len(addrs), tuple(addrs), func, source)
+
+  def opName(self, ins):
+    if ins.operand is not None:
+      return 'IMM'
+
+    if ins.handler == self.CPU.badOpcode:
+      return None
+
+    return self.Opcodes.OPCODENAME.get(ins.op)
+
+  def generate(self, addrs, ender):
+    """
+    Returns the source of a make() function, that returns the function for
+    the block made of the opcodes at addrs.
+    """
+    cpu = self.CPU
+    gen = StackGen()
+    n = len(addrs)
+    for i, addr in enumerate(addrs):
+      ins = cpu.Decoded[addr]
+      if (ender is not None) and (i == n-1):
+        break
+
+      gen.op(self.opName(ins), ins, i+1)
+
+    last = cpu.Decoded[addrs[-1]]
+    nextpc = last.nextpc
+    post = []
+
+    if ender in ('BZ', 'BNZ'):
+      a = gen.pop()
+      x = gen.pop()
+      test = '==' if ender == 'BZ' else '!='
+      gen.emit(f"npc = int(round({a})) if {x} {test} 0 else {nextpc}")
+
+    elif ender == 'BRA':
+      a = gen.pop()
+      gen.emit(f"npc = int(round({a}))")
+
+    elif ender == 'CALL':
+      a = gen.pop()
+      gen.emit(f"npc = int(round({a}))")
+      gen.emit("if C.Top >= C.Size:")
+      gen.emit("  st.Ticks = ticks0")
+      gen.emit("  return None")
+      post.append(f"C.pushF({nextpc})")
+
+    elif ender in (';', 'EXIT'):
+      gen.emit("if C.Top < 1:")
+      gen.emit("  st.Ticks = ticks0")
+      gen.emit("  return None")
+      post.append("npc = int(round(C.popF()))")
+
+    elif ender == 'ENDFOR':
+      gen.emit("if C.Top < 4:")
+      gen.emit("  st.Ticks = ticks0")
+      gen.emit("  return None")
+      post.append("CV = C.Values")
+      post.append("ct = C.Top")
+      post.append("index = CV[ct-2] + CV[ct-3]")
+      post.append("if (index >= CV[ct-4]) if (CV[ct-3] > 0) else (index <= CV[ct-4]):")
+      post.append("  C.Top = ct - 4")
+      post.append(f"  npc = {nextpc}")
+      post.append("else:")
+      post.append("  CV[ct-2] = index")
+      post.append("  npc = int(round(CV[ct-1]))")
+
+    elif ender in ('!', '!B', 'IOW'):
+      y = gen.pop()
+      x = gen.pop()
+      call = {'!' : 'memStore', '!B' : 'memStoreB', 'IOW' : 'ioWrite'}[ender]
+      post.append(f"cpu.PC = npc = {nextpc}")
+      post.append(f"cpu.{call}({x}, {y})")
+
+    elif ender is not None:
+      # Leave its operands on the stack, and let the handler do it
+      handler = cpu.OpMap.get(ender, ender)
+      post.append(f"cpu.PC = {nextpc}")
+      post.append(f"cpu.{handler}()")
+      post.append("npc = cpu.PC")
+
+    else:
+      gen.emit(f"npc = {nextpc}")
+
+    lines = []
+    lines.append("def make(cpu, S, V, C, st, R):")
+    lines.append("  def block():")
+    lines.append("    top = S.Top")
+    lines.append(f"    if (top < {gen.Need}) or (top > S.Size - {gen.Grow}):")
+    lines.append("      return None")
+    lines.append("    ticks0 = st.Ticks")
+    lines.append("    try:")
+    lines.extend("      " + l for l in gen.Lines)
+    if not gen.Lines:
+      lines.append("      pass")
+    lines.append("    except Exception:")
+    lines.append("      st.Ticks = ticks0")
+    lines.append("      return None")
+    for l in gen.commit():
+      lines.append("    " + l)
+    if gen.Grow:
+      lines.append(f"    if top + {gen.Grow} > S.HighWater:")
+      lines.append(f"      S.HighWater = top + {gen.Grow}")
+    lines.append(f"    cpu.Cycles += {n}")
+    lines.append(f"    st.Ticks = ticks0 + {n}")
+    for l in post:
+      lines.append("    " + l)
+    lines.append("    return npc")
+    lines.append("  return block")
+
+    return "\n".join(lines) + "\n"
+
+class StackGen:
+  """
+  Turns stack opcodes into assignments to local variables, by keeping a
+  stack of the expressions that are on the stack at each point.
+
+  e0, e1, ... are the items that were on the stack when the block started,
+  loaded when they're first needed. e0 is the TOS. t0, t1, ... are results.
+  Arithmetic results are rounded to float32 through R, the same as
+  pushing them would.
+  """
+  def __init__(self):
+    self.Stack = []
+    self.Lines = []
+    self.Loaded = 0  # How many entry items have been loaded
+    self.Temps = 0
+    self.Need = 0    # Depth needed on entry
+    self.Grow = 0    # Most the stack grows beyond its entry depth
+
+  def emit(self, line):
+    self.Lines.append(line)
+
+  def pop(self):
+    if self.Stack:
+      return self.Stack.pop()
+
+    e = f"e{self.Loaded}"
+    self.emit(f"{e} = V[top-{self.Loaded+1}]")
+    self.Loaded += 1
+    self.Need = self.Loaded
+    return e
+
+  def push(self, x):
+    self.Stack.append(x)
+    self.Grow = max(self.Grow, len(self.Stack) - self.Loaded)
+
+  def temp(self, expr, rounded=True):
+    t = f"t{self.Temps}"
+    self.Temps += 1
+    if rounded:
+      self.emit(f"R[0] = {expr}")
+      self.emit(f"{t} = R[0]")
+    else:
+      self.emit(f"{t} = {expr}")
+
+    self.push(t)
+
+  def literal(self, val):
+    val = float(val)
+    if math.isfinite(val):
+      return repr(val)
+
+    return f"float('{val}')"
+
+  def commit(self):
+    """
+    Lines that write the stack back to the CPU. Entry items that are still
+    in the same place don't need writing.
+    """
+    lines = []
+    base = self.Loaded
+    for i, x in enumerate(self.Stack):
+      if x != f"e{base-1-i}":
+        lines.append(f"V[top-{base-i}] = {x}" if base-i > 0 else f"V[top+{i-base}] = {x}")
+
+    delta = len(self.Stack) - self.Loaded
+    if delta:
+      lines.append(f"S.Top = top + {delta}" if delta > 0 else f"S.Top = top - {-delta}")
+
+    return lines
+
+  def op(self, name, ins, cycle):
+    """
+    Generate the code for one opcode. cycle is its position in the block,
+    counting from 1, for keeping SysTime right.
+    """
+    pop = self.pop
+    push = self.push
+    temp = self.temp
+
+    if name == 'IMM':
+      push(self.literal(ins.operand))
+
+    elif name == 'DUP':
+      x = pop()
+      push(x)
+      push(x)
+
+    elif name == 'DROP':
+      pop()
+
+    elif name == 'OVER':
+      b = pop()
+      a = pop()
+      push(a)
+      push(b)
+      push(a)
+
+    elif name == 'SWAP':
+      b = pop()
+      a = pop()
+      push(b)
+      push(a)
+
+    elif name == 'ROT':
+      c = pop()
+      b = pop()
+      a = pop()
+      push(b)
+      push(c)
+      push(a)
+
+    elif name == 'NROT':
+      c = pop()
+      b = pop()
+      a = pop()
+      push(c)
+      push(a)
+      push(b)
+
+    elif name in ('+', '-', '*', '/'):
+      y = pop()
+      x = pop()
+      temp(f"{x} {name} {y}")
+
+    elif name == 'POW':
+      y = pop()
+      x = pop()
+      temp(f"math.pow({x}, {y})")
+
+    elif name == 'NEG':
+      temp(f"-{pop()}", rounded=False)
+
+    elif name == 'REC':
+      temp(f"1.0/{pop()}")
+
+    elif name == 'TZ':
+      temp(f"1.0 if {pop()} == 0 else 0.0", rounded=False)
+
+    elif name in ('TGT', 'TLT', 'TGE', 'TLE'):
+      test = {'TGT' : '>', 'TLT' : '<', 'TGE' : '>=', 'TLE' : '<='}[name]
+      y = pop()
+      x = pop()
+      temp(f"1.0 if {x} {test} {y} else 0.0", rounded=False)
+
+    elif name == 'TIN':
+      x = pop()
+      temp(f"1.0 if (math.isnan({x}) or math.isinf({x})) else 0.0", rounded=False)
+
+    elif name in ('OR', 'AND', 'XOR'):
+      op = {'OR' : '|', 'AND' : '&', 'XOR' : '^'}[name]
+      y = pop()
+      x = pop()
+      temp(f"float(int(round({x})) {op} int(round({y})))")
+
+    elif name == 'BINV':
+      temp(f"float(~int(round({pop()})))")
+
+    elif name == '@':
+      temp(f"cpu.memFetchF({pop()})", rounded=False)
+
+    elif name == '@B':
+      temp(f"cpu.memFetchBF({pop()})", rounded=False)
+
+    elif name in ('TXP', 'RXP?'):
+      push("1.0")
+
+    elif name == 'IOR':
+      x = pop()
+      self.emit(f"st.Ticks = ticks0 + {cycle}")
+      temp(f"cpu.Sim.ioReadF({x})")
+
+    elif name == 'COPYR':
+      temp("C.readF(0)", rounded=False)
+
+    elif name == 'INDEX':
+      temp(f"C.readF(int(round({pop()}))*4 + 1)", rounded=False)
+
+    elif name == 'NOP':
+      pass
+
+    else:
+      raise ValueError(f"Can't compile {name}")
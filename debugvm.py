@@ -3,10 +3,12 @@ from dearpygui.core import *
 from dearpygui.simple import *
 
 from disasm import DebugDis
-import json, sys, random
+import array, json, math, sys, random
 from collections import OrderedDict
 from vm import *
-import systemtime
+import systemtime, symbols
+from timetravel import TimeLine
+import instrument
 
 FontSize = 5
 Windows = {}
@@ -18,6 +20,44 @@ VMCPU = CPU(SYSTIME)
 PREFS_FILE_NAME = 'prefs.debugvm.json'
 UI_FILE_NAME = 'ui.debugvm.json'
 FILETOLOAD = "froths/ShotSequencer.debug"
+RUN_CHUNK = 1000 # Opcodes to run between UI updates, when running
+CHECKPOINT_INTERVAL = 1000 # Opcodes between snapshots, for going backwards
+MAX_CHECKPOINTS = 500      # Most snapshots to keep. They're a few KB each.
+TIMELINE = TimeLine(VMCPU, CHECKPOINT_INTERVAL, MAX_CHECKPOINTS)
+
+class HeatMap:
+  """
+  Counts how many times each address has been run, in an array indexed by
+  PC, for the heat overlay in the editor. Gets them from TIMELINE, so
+  opcodes that are run again to go backwards aren't counted twice.
+  """
+  def __init__(self, cpu):
+    self.CPU = cpu
+    self.clear()
+
+  def clear(self):
+    self.Counts = array.array('L', [0]*len(self.CPU.ROM))
+
+  def opcode(self, pc, ins):
+    self.Counts[pc] += 1
+
+  def lineTotals(self, D):
+    """
+    Returns {source line : cycles run on it}
+    """
+    totals = {}
+    for addr, n in enumerate(self.Counts):
+      if n and (addr in D.MemToSourceLine):
+        line = D.MemToSourceLine[addr]
+        totals[line] = totals.get(line, 0) + n
+
+    return totals
+
+HEATMAP = HeatMap(VMCPU)
+TIMELINE.Observer = HEATMAP.opcode
+
+# Show IO in the console. Use 'trace' for 'vm' to see every opcode as well.
+instrument.setLevel('sim', instrument.DEBUG)
 
 def charW(x):
   return int(round(x*CharW))
@@ -28,6 +68,7 @@ def charH(x):
 def add_default_prefs():
   add_value("Display DPI", 160.0)
   add_value("Font height (mm)", 4.0)
+  add_value("Symbol depth", symbols.RenderDepth)
 
 def set_from_prefs_dict(prefs):
   print("Loading prefs from prefs.json: ")
@@ -42,6 +83,7 @@ def save_prefs():
 
   prefs["Display DPI"] = dpi
   prefs["Font height (mm)"] = height
+  prefs["Symbol depth"] = get_value("Symbol depth")
   with open(PREFS_FILE_NAME, 'w') as outfile:
     json.dump(prefs, outfile, indent=2)
     outfile.close()
@@ -126,6 +168,15 @@ def cb_set_font_height(sender, data):
   print(sender, data)
   setupFonts()
 
+def cb_set_symbol_depth(sender, data):
+  update_cpu_views()
+
+def symText(sym):
+  """
+  Symbols are only turned into text here, when a view needs them.
+  """
+  return symbols.render(sym, int(get_value("Symbol depth")))
+
 def callback_size_prefs(sender, data):
   with window("Display Preferences", autosize=True):  
     add_drag_float("Display DPI", callback=cb_set_display_DPI,
@@ -140,6 +191,13 @@ def callback_size_prefs(sender, data):
       max_value=20.0,
       clamped=True
       )
+    add_drag_int("Symbol depth", callback=cb_set_symbol_depth,
+      default_value=symbols.RenderDepth,
+      min_value=1,
+      max_value=symbols.MaxDepth,
+      clamped=True,
+      tip="How many levels of a symbolic expression to show"
+      )
 
 def cb_load_data(sender, data):
   print(sender, data)
@@ -163,24 +221,26 @@ def cb_run(sender, data):
   if "Program" not in Windows:
     return
 
-  try:
-    VMCPU.step(ignorebp=VMCPU.PC)
-    update_cpu_views()
-    while True:
-      VMCPU.step()
-      if random.random() < 0.01: # Don't update UI every step... can be slow
-        update_cpu_views()
-  except VMCPUStopped:
-    update_cpu_views()
-  except VMCPUBreakpoint:
+  # Run in chunks, so the UI gets updated now and then. Updating it every
+  # step is slow.
+  result = TIMELINE.run(max_cycles=RUN_CHUNK, ignorebp=VMCPU.PC)
+  while result.reason == StopReason.CYCLES:
     update_cpu_views()
+    result = TIMELINE.run(max_cycles=RUN_CHUNK)
+
+  update_cpu_views()
+  if result.reason == StopReason.WATCHPOINT:
+    print(f"Watchpoint at {result.watch.addr:#06x}: {result.watch.old} -> {result.watch.new}")
+
+  if result.reason == StopReason.ERROR:
+    raise result.error
 
 def cb_step(sender, data):  
   if "Program" not in Windows:
     return
   
   try:
-    VMCPU.step(ignorebp=VMCPU.PC)
+    TIMELINE.step(ignorebp=VMCPU.PC)
     update_cpu_views()
   except VMCPUStopped:
     update_cpu_views()
@@ -193,9 +253,9 @@ def cb_out(sender, data):
   
   try:
     while VMCPU.getCurrentOpcodeName()!= ";":
-      VMCPU.step(ignorebp=VMCPU.PC)
+      TIMELINE.step(ignorebp=VMCPU.PC)
       update_cpu_views()
-    VMCPU.step(ignorebp=VMCPU.PC)
+    TIMELINE.step(ignorebp=VMCPU.PC)
     update_cpu_views()      
   except VMCPUStopped:
     update_cpu_views()
@@ -214,7 +274,7 @@ def cb_lstep(sender, data):
     currentline = editor.D.getSourceLineForAddr(VMCPU.PC)
     line = currentline
     while (line == currentline):
-      VMCPU.step(ignorebp=currentpc)
+      TIMELINE.step(ignorebp=currentpc)
       update_cpu_views()
       line = editor.D.getSourceLineForAddr(VMCPU.PC)
 
@@ -250,7 +310,7 @@ def cb_nextl(sender, data):
     nextlineaddr = editor.D.getAddrForSourceLine(currentline+1)
     while line == currentline:
       while VMCPU.PC != nextlineaddr:
-        VMCPU.step(ignorebp=currentpc)
+        TIMELINE.step(ignorebp=currentpc)
         if random.random() < 0.05:
           update_cpu_views()    # Update UI 5% of the time
       update_cpu_views()
@@ -284,10 +344,10 @@ def cb_over(sender, data):
         # It's a call to a subroutine. Run until we get out.
         nextlineaddr = editor.D.getAddrForSourceLine(line+1)
         while VMCPU.PC != nextlineaddr:
-          VMCPU.step(ignorebp=currentpc)
+          TIMELINE.step(ignorebp=currentpc)
       else:
         # Not a call. Just execute an opcode
-        VMCPU.step(ignorebp=currentpc)
+        TIMELINE.step(ignorebp=currentpc)
 
       update_cpu_views()
       line = editor.D.getSourceLineForAddr(VMCPU.PC)    
@@ -297,20 +357,48 @@ def cb_over(sender, data):
   except VMCPUBreakpoint:
     update_cpu_views()
 
+def cb_back(sender, data):
+  if "Program" not in Windows:
+    return
+
+  TIMELINE.stepBack()
+  update_cpu_views()
+
+def cb_rcont(sender, data):
+  if "Program" not in Windows:
+    return
+
+  TIMELINE.reverseContinue()
+  update_cpu_views()
+
+def cb_goto(sender, data):
+  if "Program" not in Windows:
+    return
+
+  TIMELINE.goto(get_value("Cycle"))
+  update_cpu_views()
+
 def cb_shot(sender, data):
   SYSTIME.reset()
   VMCPU.reset()
+  VMCPU.Sim.reset()
   VMCPU.moveToWord("RunShot")
+  TIMELINE.restart()
+  HEATMAP.clear()
   update_cpu_views()
 
 def cb_idle(sender, data):
   VMCPU.reset()
   VMCPU.moveToWord("Idle")
+  TIMELINE.restart()
+  HEATMAP.clear()
   update_cpu_views()
 
 def cb_halt(sender, data):
   VMCPU.reset()
   VMCPU.moveToWord("Halt")
+  TIMELINE.restart()
+  HEATMAP.clear()
   update_cpu_views()
 
 def add_controls():
@@ -334,6 +422,16 @@ def add_controls():
       add_button("IDLE", width=w, callback=cb_idle,   tip="Move to 'Idle'")
       add_button("HALT", width=w, callback=cb_halt,   tip="Move to 'Halt'")
 
+    with group("Buttons4", horizontal=True):
+      add_button("BACK",  width=w, callback=cb_back,  tip="Go back one instruction")
+      add_button("RCONT", width=w, callback=cb_rcont, tip="Run backwards to the last breakpoint or watchpoint")
+      add_button("GOTO",  width=w, callback=cb_goto,  tip="Go to the cycle below, forwards or backwards")
+
+    add_input_int("Cycle", width=w*3, default_value=0, tip="Cycle for GOTO")
+
+    add_input_text("Break if", width=w*3, default_value="",
+      tip="Condition for new breakpoints, eg. TOS > 9.0, F(4) == 0 or Cycles > 100000")
+
 
   for item in get_item_children("Controls"):
     set_item_style_var(item, mvGuiStyleVar_FrameRounding, [charH(1)*0.3])
@@ -373,6 +471,8 @@ class Editor:
     self.TextLines = self.D.SourceLines
     self.addLines()
     self.Selected = None
+    self.HeatCycles = None
+    self.HeatLines = set()
 
   def selectMemAddr(self, addr):
     """
@@ -402,16 +502,50 @@ class Editor:
   def updateDisplay(self):
     self.selectMemAddr(VMCPU.PC)
 
+  def updateHeat(self, heatmap):
+    """
+    Colour each source line by how many cycles have been run on it, from
+    white for few to red for the most, on a log scale
+    """
+    if VMCPU.Cycles == self.HeatCycles:
+      return
+
+    self.HeatCycles = VMCPU.Cycles
+    totals = heatmap.lineTotals(self.D)
+    hottest = math.log1p(max(totals.values(), default=1))
+    for line in self.HeatLines - set(totals):
+      set_item_color(f"SourceL{line}", mvGuiCol_Text, [255, 255, 255, 255])
+      configure_item(f"SourceL{line}", tip="")
+
+    for line, n in totals.items():
+      heat = math.log1p(n) / hottest
+      set_item_color(f"SourceL{line}", mvGuiCol_Text, [255, 255*(1-heat), 255*(1-heat), 255])
+      configure_item(f"SourceL{line}", tip=f"{n} cycles")
+
+    self.HeatLines = set(totals)
+
   def cb_addr_click(self, sender, data):
     #print(sender, data)
-    VMCPU.toggleBP(data)
+    condition = get_value("Break if") if does_item_exist("Break if") else ""
+    if VMCPU.isBP(data) or not condition:
+      VMCPU.toggleBP(data)
+    else:
+      try:
+        VMCPU.setBP(data, condition)
+      except SyntaxError as e:
+        print(f"Bad breakpoint condition: {e}")
+        return
+
     item = f"SourceLN{self.D.getSourceLineForAddr(data)}"
     i = 4
     hovercol = hsv_to_rgb(i/7.0, 0.7, 0.7, 0.3)
     if VMCPU.isBP(data):
       set_item_color(item, mvGuiCol_Button, hsv_to_rgb(i/7.0, 0.8, 0.8, 1.0))
       set_item_color(item, mvGuiCol_ButtonHovered, hsv_to_rgb(i/7.0, 0.8, 0.8, 1.0))
-      configure_item(item, tip="Breakpoint at Addr %d" % data)
+      if data in VMCPU.BPConditions:
+        configure_item(item, tip="Breakpoint at Addr %d, if %s" % (data, VMCPU.BPConditions[data].text))
+      else:
+        configure_item(item, tip="Breakpoint at Addr %d" % data)
     else:
       set_item_color(item, mvGuiCol_Button, [0,0,0,0])
       set_item_color(item, mvGuiCol_ButtonHovered, hovercol)
@@ -486,12 +620,12 @@ class MemoryDisplay:
           val, sym = self.getByteAddrInfo(byteaddr)
           val = int(round(val))
           set_value(f"{self.Name}bval_{byteaddr}", "%02X %4d" % (val, val))
-          set_value(f"{self.Name}bsym_{byteaddr}", "%s" % sym)
+          set_value(f"{self.Name}bsym_{byteaddr}", symText(sym))
 
           if (byteaddr % 4) == 0:
             val, sym = self.getFloatAddrInfo(byteaddr)
             set_value(f"{self.Name}fval_{byteaddr}", "%12.6f" % val)
-            set_value(f"{self.Name}fsym_{byteaddr}", "%s" % sym)
+            set_value(f"{self.Name}fsym_{byteaddr}", symText(sym))
 
       self.CPU.clearMemWriteList()
 
@@ -509,7 +643,7 @@ class MemoryDisplay:
                 val = int(round(val))
                 add_text(f"{self.Name}byte_{byteaddr}", default_value="%05d %04x" % (byteaddr, byteaddr))
                 add_text(f"{self.Name}bval_{byteaddr}", default_value="%02X %4d" % (val, val))
-                add_text(f"{self.Name}bsym_{byteaddr}", default_value="%s" % (sym,))
+                add_text(f"{self.Name}bsym_{byteaddr}", default_value=symText(sym))
           with group(f"{self.Name}right"):
             for addr in range(0, 256):
               if (addr % 4) == 0:
@@ -517,7 +651,7 @@ class MemoryDisplay:
                   val, sym = self.getFloatAddrInfo(addr)
                   #add_text(f"{self.Name}float_{addr}", default_value="%05d %04x" % (addr, addr))
                   add_text(f"{self.Name}fval_{addr}", default_value="%12.6f" % (val,))
-                  add_text(f"{self.Name}fsym_{addr}", default_value="%s" % (sym,))
+                  add_text(f"{self.Name}fsym_{addr}", default_value=symText(sym))
               else:
                 with group(f"{self.Name}spacerg_{addr}", horizontal=True):
                   add_text(f"{self.Name}spacerl_{addr}", default_value=' ')
@@ -546,9 +680,10 @@ class StackDisplay:
         sv = self.getStackVal(i)
         if sv != None:
           #print(get_item_configuration(f"{self.Name}val_{i}"))
-          configure_item(f"{self.Name}val_{i}", label=("%12.6f" % self.getStackVal(i).float))
-          set_value(f"{self.Name}sym_{i}", self.getStackVal(i).symbol)
-          configure_item(f"{self.Name}sym_{i}", tip=self.getStackVal(i).symbol)
+          configure_item(f"{self.Name}val_{i}", label=("%12.6f" % sv.float))
+          text = symText(sv.symbol)
+          set_value(f"{self.Name}sym_{i}", text)
+          configure_item(f"{self.Name}sym_{i}", tip=text)
         else:
           configure_item(f"{self.Name}val_{i}", label="------------")
           set_value(f"{self.Name}sym_{i}", '')
@@ -563,7 +698,7 @@ class StackDisplay:
             sv = self.getStackVal(i)
             if sv != None:
               with tree_node(f"{self.Name}val_{i}", label="%12.6f" % self.getStackVal(i).float, default_open=True):
-                add_text(f"{self.Name}sym_{i}", default_value=self.getStackVal(i).symbol)
+                add_text(f"{self.Name}sym_{i}", default_value=symText(sv.symbol))
             else:
               with tree_node(f"{self.Name}val_{i}", label="------------", default_open=True):
                 add_text(f"{self.Name}sym_{i}", default_value='')
@@ -632,6 +767,11 @@ def fix_window_positions():
 def cb_mouse_release(sender, data):
   fix_window_positions()
 
+def cb_render(sender, data):
+  # The heat overlay is refreshed once a frame, not every step
+  if "Program" in Windows:
+    Windows["Program"].updateHeat(HEATMAP)
+
 def cb_close(sender, data):
   set_mouse_release_callback(None)
   set_render_callback(None)
@@ -666,6 +806,8 @@ def setup_UI(sender, data):
 
   VMCPU.loadDebug(FILETOLOAD)
   VMCPU.moveToWord("RunShot")
+  TIMELINE.restart()
+  HEATMAP.clear()
   update_cpu_views()
 
 
@@ -674,6 +816,7 @@ def setup_UI(sender, data):
   set_style_global_alpha(1.0)
 
   set_mouse_release_callback(cb_mouse_release)
+  set_render_callback(cb_render)
   restore_ui()
   fix_window_positions()
 
@@ -2,8 +2,13 @@
 from Scanner import *
 from Parser import *
 import sys, os
+import instrument
+
+def main(filetoparse, verbose=False):
+  if verbose:
+    # Show the listing as it's compiled
+    instrument.setLevel('compiler', instrument.DEBUG)
 
-def main(filetoparse):
   filebase = filetoparse.rsplit(".", 1)[0]
   dirName, fileName = os.path.split(filetoparse)
 
@@ -26,4 +31,5 @@ def main(filetoparse):
     sys.exit(1)
 
 if __name__ == '__main__':
-  main(sys.argv[1])
\ No newline at end of file
+  args = [a for a in sys.argv[1:] if a != '-v']
+  main(args[0], verbose='-v' in sys.argv[1:])
\ No newline at end of file
@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+"""
+Skips over idle polling loops.
+
+A program that waits for something, like RunShot polling SecsReached, or
+Wait1Sec's loops of WAITs, runs the same loop over and over, and nothing
+changes but the time. FastForward runs a CPU in chunks, and between them
+looks for a loop like that, by following the program from where it is
+until it gets back there with everything the same except Cycles and
+SysTime. If it finds one, it works out how many more times round the loop
+would do exactly the same thing, and adds the cycles and ticks for them
+without running them.
+
+Only WAIT and IO reads depend on the time. IO_NumSeconds goes up, and the
+Sim's sensors move steadily towards their targets, which DE1Sim.ioTrend()
+says. While it follows the loop, values read from them are tracked through
+the stacks. They can go through DUP and friends, be added to, multiplied
+and divided by constants, and compared, so every comparison they get to
+changes at most once as time goes on. Anything else done with them (storing them, branching on them,
+writing them out, TZ and the bitwise ops) means it isn't treated as idle.
+A later time round the loop then does the same as the first if all those
+comparisons come out the same, which is checked by running it, and the
+furthest one that does is found by bisecting.
+
+Nothing is skipped while there are breakpoints or watchpoints.
+
+Usage: python3 fastforward.py prog.debug [word] [max_cycles]
+"""
+import operator, sys, time
+import vm, systemtime, instrument
+
+LOG = instrument.channel('vm')
+
+class LoopFound(Exception):
+  pass
+
+class NotIdle(Exception):
+  pass
+
+class FastForward:
+  """
+  Runs a CPU with run(), skipping what it can. Skipped and Loops count the
+  cycles skipped and how many times.
+  """
+  # Cycles run between looks for a loop, and the most it backs off to when
+  # it doesn't find any
+  MINCHUNK = 1024
+  MAXCHUNK = 1 << 16
+
+  # Longest loop it looks for, in cycles
+  PROBECYCLES = 4096
+
+  # Most times round a loop skipped at once, for ones that never finish
+  MAXSKIP = 1 << 24
+
+  COMPARES = {'TGT' : operator.gt, 'TLT' : operator.lt, 'TGE' : operator.ge, 'TLE' : operator.le}
+
+  # Opcodes that are fine on values that don't depend on the time, and make
+  # one that doesn't. (pops, pushes)
+  CONSTANT = {'OR' : (2, 1), 'AND' : (2, 1), 'XOR' : (2, 1), 'POW' : (2, 1), 'BINV' : (1, 1),
+    'REC' : (1, 1), 'TZ' : (1, 1), 'TIN' : (1, 1), '@' : (1, 1), '@B' : (1, 1), 'IORT' : (1, 1),
+    'TXP' : (0, 1), 'RXP?' : (0, 1), 'BZ' : (2, 0), 'BNZ' : (2, 0), 'BRA' : (1, 0),
+    '!' : (2, 0), '!B' : (2, 0), 'IOW' : (2, 0), 'FOR' : (4, 0), 'WAIT' : (0, 0),
+    'NOP' : (0, 0), 'STOP' : (0, 0)}
+
+  def __init__(self, cpu):
+    self.CPU = cpu
+    self.Skipped = 0
+    self.Loops = 0
+
+  def run(self, max_cycles=None, until_ticks=None, ignorebp=None):
+    """
+    Same as CPU.run()
+    """
+    cpu = self.CPU
+    start = cpu.Cycles
+    end = sys.maxsize if max_cycles is None else start + max_cycles
+    chunk = self.MINCHUNK
+    while True:
+      if cpu.BreakPoints or cpu.WatchPoints:
+        result = cpu.run(end - cpu.Cycles, until_ticks, ignorebp)
+        return result._replace(cycles=cpu.Cycles - start)
+
+      result = cpu.run(min(chunk, end - cpu.Cycles), until_ticks, ignorebp)
+      ignorebp = None
+      if (result.reason != vm.StopReason.CYCLES) or (cpu.Cycles >= end):
+        return result._replace(cycles=cpu.Cycles - start)
+
+      result, loop = self.probe(end, until_ticks)
+      if result is not None:
+        return result._replace(cycles=cpu.Cycles - start)
+
+      if (loop is not None) and self.skip(loop, end, until_ticks):
+        chunk = self.MINCHUNK
+      else:
+        chunk = min(chunk * 2, self.MAXCHUNK)
+
+  def probe(self, end, until_ticks):
+    """
+    Follow the program from here, looking for an idle loop. Returns
+    (RunResult, None) if the CPU stopped, or (None, loop) where loop is a
+    dict describing it, or None if there isn't one.
+    """
+    cpu = self.CPU
+    self.Start = cpu.snapshot()
+    # Which way each stack item changes with time, or None. Whatever's there
+    # already stays the same while it's there.
+    self.Shadow = [None]*cpu.Stack.Top
+    self.ShadowCalls = [None]*cpu.CallStack.Top
+    self.Last = None
+    self.Waits = False
+    self.Tests = set()      # Addresses of comparisons of the time
+    self.Outcomes = []
+    state = self.Start
+    result = cpu.run(min(self.PROBECYCLES, end - cpu.Cycles), until_ticks, observer=self.follow)
+    if result.reason != vm.StopReason.ERROR:
+      if result.reason == vm.StopReason.CYCLES:
+        return (None, None)
+
+      return (result, None)
+
+    if isinstance(result.error, NotIdle):
+      return (None, None)
+
+    if not isinstance(result.error, LoopFound):
+      return (result, None)
+
+    ticks = cpu.SysTime.Ticks - state.ticks
+    if self.Waits and (ticks % cpu.SysTime.ACPERIOD):
+      return (None, None)
+
+    return (None, {'snapshot' : cpu.snapshot(), 'cycles' : cpu.Cycles - state.cycles,
+      'ticks' : ticks, 'tests' : self.Tests, 'outcomes' : self.Outcomes})
+
+  def same(self, a, b):
+    """
+    True if snapshots a and b are the same, apart from the time
+    """
+    return a._replace(cycles=0, ticks=0) == b._replace(cycles=0, ticks=0)
+
+  def follow(self, pc, ins):
+    """
+    The observer for probe(). Keeps track of which stack items depend on
+    the time, and stops the run when it's back where it started.
+    """
+    cpu = self.CPU
+    S = self.Shadow
+    R = self.ShadowCalls
+    # Line up with what the last opcode actually did
+    if self.Last in ('FOR', 'ENDFOR'):
+      del R[cpu.CallStack.Top:]
+      R.extend([None]*(cpu.CallStack.Top - len(R)))
+
+    if (len(S) != cpu.Stack.Top) or (len(R) != cpu.CallStack.Top):
+      raise NotIdle()
+
+    if (pc == self.Start.pc) and (self.Last is not None):
+      if any(S) or any(R) or not self.same(cpu.snapshot(), self.Start):
+        raise NotIdle()
+
+      raise LoopFound()
+
+    name = 'IMM' if ins.operand is not None else cpu.Opcodes.OPCODENAME.get(ins.op)
+    self.Last = name
+    self.taint(name, pc)
+
+  def taint(self, name, pc):
+    """
+    Do to the shadow stacks what opcode name is about to do to the real ones
+    """
+    cpu = self.CPU
+    S = self.Shadow
+    R = self.ShadowCalls
+    V = cpu.Stack.Values
+    top = cpu.Stack.Top
+
+    def pop(n):
+      if len(S) < n:
+        raise NotIdle()
+
+      items = S[len(S)-n:]
+      del S[len(S)-n:]
+      return items
+
+    def combine(a, b):
+      if (a is not None) and (b is not None) and (a != b):
+        raise NotIdle()
+
+      return a if a is not None else b
+
+    def neg(a):
+      return None if a is None else -a
+
+    def sign(x):
+      return -1 if x < 0 else 1
+
+    if name in ('IMM', 'PCIMMS', 'IMMS', 'IMMU', 'IMMF'):
+      S.append(None)
+
+    elif name == 'DUP':
+      S.append(pop(1)[0])
+      S.append(S[-1])
+
+    elif name == 'DROP':
+      pop(1)
+
+    elif name == 'OVER':
+      a, b = pop(2)
+      S.extend((a, b, a))
+
+    elif name == 'SWAP':
+      a, b = pop(2)
+      S.extend((b, a))
+
+    elif name == 'ROT':
+      a, b, c = pop(3)
+      S.extend((b, c, a))
+
+    elif name == 'NROT':
+      a, b, c = pop(3)
+      S.extend((c, a, b))
+
+    elif name == 'COPY':
+      if pop(1)[0] is not None:
+        raise NotIdle()
+
+      i = int(round(V[top-1]))
+      if not (0 <= i < len(S)):
+        raise NotIdle()
+
+      S.append(S[-1-i])
+
+    elif name == '+':
+      a, b = pop(2)
+      S.append(combine(a, b))
+
+    elif name == '-':
+      a, b = pop(2)
+      S.append(combine(a, neg(b)))
+
+    elif name == '*':
+      a, b = pop(2)
+      if (a is not None) and (b is not None):
+        raise NotIdle()
+
+      S.append(a * sign(V[top-1]) if a is not None else (b * sign(V[top-2]) if b is not None else None))
+
+    elif name == '/':
+      a, b = pop(2)
+      if (b is not None) or ((a is not None) and (V[top-1] == 0)):
+        raise NotIdle()
+
+      S.append(a * sign(V[top-1]) if a is not None else None)
+
+    elif name == 'NEG':
+      S.append(neg(pop(1)[0]))
+
+    elif name in self.COMPARES:
+      a, b = pop(2)
+      if combine(a, neg(b)) is not None:
+        self.Tests.add(pc)
+        self.Outcomes.append(self.COMPARES[name](V[top-2], V[top-1]))
+      S.append(None)
+
+    elif name == 'IOR':
+      if pop(1)[0] is not None:
+        raise NotIdle()
+
+      S.append(cpu.Sim.ioTrend(V[top-1]))
+
+    elif name == 'CALL':
+      if pop(1)[0] is not None:
+        raise NotIdle()
+
+      R.append(None)
+
+    elif name in (';', 'EXIT'):
+      if (not R) or (R.pop() is not None):
+        raise NotIdle()
+
+    elif name == 'TOR':
+      R.append(pop(1)[0])
+
+    elif name == 'FROMR':
+      if not R:
+        raise NotIdle()
+
+      S.append(R.pop())
+
+    elif name == 'COPYR':
+      if not R:
+        raise NotIdle()
+
+      S.append(R[-1])
+
+    elif name == 'INDEX':
+      if pop(1)[0] is not None:
+        raise NotIdle()
+
+      i = int(round(V[top-1]))*4 + 1
+      if not (0 <= i < len(R)):
+        raise NotIdle()
+
+      S.append(R[-1-i])
+
+    elif name == 'ENDFOR':
+      if any(R[-4:]):
+        raise NotIdle()
+
+    elif name in self.CONSTANT:
+      pops, pushes = self.CONSTANT[name]
+      if any(pop(pops)):
+        raise NotIdle()
+
+      S.extend([None]*pushes)
+      if name == 'WAIT':
+        self.Waits = True
+
+    else:
+      raise NotIdle()
+
+  def test(self, pc, ins):
+    """
+    The observer for check(). Records how the comparisons of the time came
+    out.
+    """
+    if pc in self.Tests:
+      stack = self.CPU.Stack
+      V = stack.Values
+      name = self.CPU.Opcodes.OPCODENAME.get(ins.op)
+      self.Outcomes.append(self.COMPARES[name](V[stack.Top-2], V[stack.Top-1]))
+
+  def check(self, loop, n):
+    """
+    True if going round the loop n times later than it was found does
+    exactly what it did then
+    """
+    cpu = self.CPU
+    snap = loop['snapshot']
+    cpu.restore(snap)
+    cpu.SysTime.Ticks = snap.ticks + n * loop['ticks']
+    self.Tests = loop['tests']
+    self.Outcomes = []
+    result = cpu.run(loop['cycles'], observer=self.test)
+    return ((result.reason == vm.StopReason.CYCLES) and (self.Outcomes == loop['outcomes'])
+      and (cpu.SysTime.Ticks == snap.ticks + (n+1) * loop['ticks']) and self.same(cpu.snapshot(), snap))
+
+  def skip(self, loop, end, until_ticks):
+    """
+    Skip as many times round the loop as can be, without going past end
+    or until_ticks. Returns True if it skipped any.
+    """
+    cpu = self.CPU
+    snap = loop['snapshot']
+    cycles = loop['cycles']
+    ticks = loop['ticks']
+    most = min(self.MAXSKIP, (end - snap.cycles) // cycles)
+    if until_ticks is not None:
+      most = min(most, (until_ticks - snap.ticks) // ticks)
+
+    # Find the last time round, counting from 0 for the one starting now,
+    # that does the same as the one that found the loop
+    good = -1
+    bad = most
+    n = 0
+    while n < bad:
+      if not self.check(loop, n):
+        bad = n
+        break
+
+      good = n
+      n = 2*n + 1
+
+    while bad - good > 1:
+      n = (good + bad) // 2
+      if self.check(loop, n):
+        good = n
+      else:
+        bad = n
+
+    cpu.restore(snap)
+    skipped = good + 1
+    cpu.Cycles = snap.cycles + skipped * cycles
+    cpu.SysTime.Ticks = snap.ticks + skipped * ticks
+    if not skipped:
+      return False
+
+    self.Skipped += skipped * cycles
+    self.Loops += 1
+    if LOG.Debug:
+      LOG.debug(f"Skipped {skipped} times round the loop at {snap.pc}, {skipped * cycles} cycles")
+
+    return True
+
+def main(argv):
+  if len(argv) < 2:
+    print(__doc__)
+    return
+
+  word = argv[2] if len(argv) > 2 else "RunShot"
+  maxcycles = int(argv[3]) if len(argv) > 3 else 100000000
+
+  for skipping in (False, True):
+    cpu = vm.FastCPU(systemtime.SystemTime())
+    cpu.loadDebug(argv[1])
+    cpu.moveToWord(word)
+    fastforward = FastForward(cpu)
+    started = time.perf_counter()
+    result = (fastforward.run if skipping else cpu.run)(max_cycles=maxcycles)
+    taken = time.perf_counter() - started
+    print(f"{'Skipping' if skipping else 'Running '}: {result.reason} after {result.cycles} cycles, "
+      f"{cpu.SysTime.Ticks} ticks, {taken:.3f}s. {fastforward.Skipped} cycles skipped in {fastforward.Loops} loops.")
+    if result.error is not None:
+      print(f"  {result.error!r}")
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -1,6 +1,9 @@
 import array, collections
 import opcodes, ioconsts
 import struct, sys, json
+import instrument
+
+LOG = instrument.channel('compiler')
 
 T_Call    = collections.namedtuple('T_Call', 'wordname')
 T_Bra     = collections.namedtuple('T_Bra', 'opcode targetlabel')
@@ -56,7 +59,8 @@ class FrothCompiler:
     if len(self.DeferredCopies):
       self.emitCopies()
 
-    print("%5d" % self.Addr, "%6s" % op, "  ", comment)
+    if LOG.Debug:
+      LOG.debug("%5d %6s    %s" % (self.Addr, op, comment))
     if op in self.Opcodes.OPCODESET:
       self.updateStackUse(*self.Opcodes.OPNETSTACK[op])
       self.ROM.append(self.Opcodes.OPCODENUM[op])
@@ -64,7 +68,8 @@ class FrothCompiler:
       self.ROM.append(op)
 
     if (op == ';') or (op == 'EXIT'):
-      print("Stack delta:", self.StackUse)
+      if LOG.Debug:
+        LOG.debug(f"Stack delta: {self.StackUse}")
       self.checkWordStacks()
       currentword = self.WordList[-1]
       self.WordStackUse[currentword] = self.StackUse
@@ -79,7 +84,8 @@ class FrothCompiler:
     copies = list(self.DeferredCopies)
     self.DeferredCopies = []
     while len(copies):
-      print(repr(copies))
+      if LOG.Debug:
+        LOG.debug(repr(copies))
       if len(copies) == 1:
         # Just one copy
         copy = copies.pop(0)
@@ -111,7 +117,8 @@ class FrothCompiler:
       self.StackUse = (0,0)
       self.Words[wordstr] = (self.WordCnt, self.Addr)
       self.WordList.append(wordstr)
-      print(": %s" % wordstr)
+      if LOG.Debug:
+        LOG.debug(": %s" % wordstr)
       self.WordCnt += 1
       return wordstr
     else:
@@ -120,7 +127,8 @@ class FrothCompiler:
   def addGlobal(self, gstr):
    if gstr not in self.Globals:
      self.Globals[gstr] = self.GlobalLastAddr
-     print("GLOBAL: %s" % gstr)
+     if LOG.Debug:
+       LOG.debug("GLOBAL: %s" % gstr)
      self.GlobalLastAddr += 4
    else:
      self.Parser.SemErr(f"'{gstr}' already defined: ")       
@@ -131,11 +139,13 @@ class FrothCompiler:
      self.Parser.SemErr("Label already defined: " + labelname)
    else:
      self.Labels[labelname] = self.Addr
-     print("{%s}" % labelname)
+     if LOG.Debug:
+       LOG.debug("{%s}" % labelname)
 
   def addTag(self, tag):
    self.Tags[self.Addr] = tag
-   print("%5d" % self.Addr, "<%s>" % tag)
+   if LOG.Debug:
+     LOG.debug("%5d <%s>" % (self.Addr, tag))
 
    # Update stack ids if necessary
    if len(self.StackIdList):
@@ -215,7 +225,8 @@ class FrothCompiler:
     self.AddrToSource[addr] = tuple(d)
 
   def doFixup(self, tofix, addr):
-    print(f"Fixup {tofix} to {addr}")
+    if LOG.Debug:
+      LOG.debug(f"Fixup {tofix} to {addr}")
 
     self.ROM[tofix] = addr & 0xFF
     self.fixupAddr(tofix) 
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Logging for the VM, the simulator and the compiler.
+
+Each subsystem has a Channel, with a level. The channel has a flag for each
+level, so a call site costs one attribute check when that level is off:
+
+  LOG = instrument.channel('vm')
+  ...
+  if LOG.Trace:
+    LOG.trace(f"IMM {imm}")
+
+Everything goes to one buffered Sink, which writes lines out in blocks.
+Errors and warnings are written straight away.
+"""
+import atexit, sys
+
+OFF   = 0
+ERROR = 1
+WARN  = 2
+INFO  = 3
+DEBUG = 4
+TRACE = 5
+
+LEVELS = {'off' : OFF, 'error' : ERROR, 'warn' : WARN, 'info' : INFO, 'debug' : DEBUG, 'trace' : TRACE}
+
+# Level for channels that haven't been set
+DEFAULTLEVEL = WARN
+
+class Sink:
+  """
+  Collects lines, and writes them to stream every size lines, or when it's
+  flushed. stream defaults to whatever sys.stdout is at the time.
+  """
+  def __init__(self, stream=None, size=1000):
+    self.Stream = stream
+    self.Size = size
+    self.Lines = []
+
+  def write(self, line, now=False):
+    self.Lines.append(line)
+    if now or (len(self.Lines) >= self.Size):
+      self.flush()
+
+  def flush(self):
+    if not self.Lines:
+      return
+
+    stream = self.Stream if self.Stream is not None else sys.stdout
+    stream.write("\n".join(self.Lines) + "\n")
+    stream.flush()
+    self.Lines = []
+
+class Channel:
+  """
+  Logging for one subsystem. Error, Warn, Info, Debug and Trace are True
+  if that level is on.
+  """
+  def __init__(self, name, sink, level=DEFAULTLEVEL):
+    self.Name = name
+    self.Sink = sink
+    self.setLevel(level)
+
+  def setLevel(self, level):
+    if isinstance(level, str):
+      level = LEVELS[level.lower()]
+
+    self.Level = level
+    self.Error = level >= ERROR
+    self.Warn = level >= WARN
+    self.Info = level >= INFO
+    self.Debug = level >= DEBUG
+    self.Trace = level >= TRACE
+
+  def error(self, msg):
+    self.Sink.write(f"{self.Name}: error: {msg}", now=True)
+
+  def warn(self, msg):
+    self.Sink.write(f"{self.Name}: warning: {msg}", now=True)
+
+  def info(self, msg):
+    self.Sink.write(msg)
+
+  def debug(self, msg):
+    self.Sink.write(msg)
+
+  def trace(self, msg):
+    self.Sink.write(msg)
+
+SINK = Sink()
+Channels = {}
+
+def channel(name):
+  """
+  The channel for a subsystem, made the first time it's asked for
+  """
+  if name not in Channels:
+    Channels[name] = Channel(name, SINK)
+
+  return Channels[name]
+
+def setLevel(name, level):
+  channel(name).setLevel(level)
+
+def flush():
+  SINK.flush()
+
+atexit.register(flush)
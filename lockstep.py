@@ -0,0 +1,1016 @@
+#!/usr/bin/env python3
+"""
+Runs one FROTH program on many machines at once, in lockstep.
+
+Lockstep holds N FastCPUs (lanes) as numpy arrays: each stack is an N x
+size array of float32, and PC, Cycles and SysTime are an array each. The
+lanes at the same PC run the opcode there once, for all of them. Their
+Sims are a DE1SimBatch. So a sweep over sensor inputs or values in memory
+costs about the same per opcode however many lanes there are, and it's
+worth it from a few hundred lanes up.
+
+When lanes branch different ways (BZ, BNZ, FOR and ENDFOR, or RET to
+different places), the group at the lowest PC is always run next, and the
+others wait. For the code the compiler generates, that brings them back
+together where the paths join: after the IF or ELSE, or after the loop.
+That's the branch's post-dominator, without having to find it, which
+can't be done in general, as branch addresses come off the stack.
+
+Each lane does exactly what FastCPU.run() would, bit for bit. Anything the
+vector code doesn't do (POW, IORT, stores to program RAM) and any opcode
+that would fail on a lane (under or overflow, dividing by zero, a bad
+address or channel) is run for that lane on its own, by a FastCPU that the
+lane is copied in and out of. A lane whose program RAM has been written,
+or that goes outside it, finishes the run on that FastCPU.
+
+There are no breakpoints, watchpoints or observers.
+
+Usage: python3 lockstep.py prog.debug lanes [word] [max_cycles]
+"""
+import sys, time
+import numpy
+import vm, systemtime
+from simbatch import DE1SimBatch, DE1SimView
+
+F64 = numpy.float64
+
+class StackBatch:
+  """
+  The same F32Stack in each of N lanes. Values[i] holds lane i's items, Top[i]
+  is how many there are, and HighWater[i] is the most it's held.
+  """
+  def __init__(self, n, size):
+    self.Values = numpy.zeros((n, size), dtype=numpy.float32)
+    self.Top = numpy.zeros(n, dtype=numpy.int64)
+    self.HighWater = numpy.zeros(n, dtype=numpy.int64)
+    self.Size = size
+
+  def reset(self):
+    self.Top[:] = 0
+    self.HighWater[:] = 0
+
+  def snapshot(self, i):
+    """
+    Lane i's items, the same as F32Stack.snapshot() of a non-symbolic stack
+    """
+    return (self.Values[i, :self.Top[i]].tobytes(), None)
+
+  def restore(self, i, state):
+    values, symbols = state
+    top = len(values) // 4
+    self.Values[i, :top] = numpy.frombuffer(values, dtype=numpy.float32)
+    self.Top[i] = top
+    self.HighWater[i] = max(self.HighWater[i], top)
+
+  def grew(self, lanes):
+    """
+    lanes have pushed, so bring their HighWater up to date
+    """
+    self.HighWater[lanes] = numpy.maximum(self.HighWater[lanes], self.Top[lanes])
+
+class Lockstep:
+  """
+  N lanes running the program in filename. Set them up with reset(),
+  moveToWord() and restore(), or through the arrays, and run them with
+  run().
+  """
+  STACKS = ("Stack", "CallStack", "ControlStack")
+
+  # Cycles for a lane with no max_cycles, and the PC of one that's stopped
+  BIG = 1 << 62
+
+  # Memory the vector code reads and writes, as (array, address, size).
+  # Other addresses are left to FastCPU.
+  READS = (("Scratch", 0, 0x100), ("RXPacket", 0x1000, 0x10), ("ROM", 0x2000, 0x400))
+  WRITES = (("Scratch", 0, 0x100), ("TXPacket", 0x1010, 0x10))
+
+  BINARY = {'+' : numpy.add, '-' : numpy.subtract, '*' : numpy.multiply,
+    'TGT' : numpy.greater, 'TLT' : numpy.less, 'TGE' : numpy.greater_equal, 'TLE' : numpy.less_equal}
+  BITWISE = {'OR' : numpy.bitwise_or, 'AND' : numpy.bitwise_and, 'XOR' : numpy.bitwise_xor}
+
+  def __init__(self, filename, n):
+    self.N = n
+
+    # CPU is the program as loaded, and decodes it for all the lanes. Scalar
+    # runs lanes one at a time.
+    self.CPU = vm.FastCPU(systemtime.SystemTime())
+    self.CPU.loadDebug(filename)
+    self.Scalar = vm.FastCPU(systemtime.SystemTime())
+    self.Scalar.loadDebug(filename)
+    self.Sim = DE1SimBatch(n)
+    self.View = DE1SimView(self.Sim, 0, self.Scalar.SysTime)
+    self.Scalar.Sim = self.View
+    self.Program = numpy.frombuffer(self.CPU.ROM.tobytes(), dtype=numpy.uint8)
+
+    cpu = self.CPU
+    self.PC = numpy.zeros(n, dtype=numpy.int64)
+    self.Cycles = numpy.zeros(n, dtype=numpy.int64)
+    self.Ticks = numpy.zeros(n, dtype=numpy.int64)
+    self.Stopped = numpy.zeros(n, dtype=bool)
+    for name in self.STACKS:
+      setattr(self, name, StackBatch(n, getattr(cpu, name).Size))
+    self.Scratch = numpy.zeros((n, len(cpu.Scratch)), dtype=numpy.uint8)
+    self.TXPacket = numpy.zeros((n, len(cpu.TXPacket)), dtype=numpy.uint8)
+    self.RXPacket = numpy.zeros((n, len(cpu.RXPacket)), dtype=numpy.uint8)
+    self.ROM = numpy.tile(self.Program, (n, 1))
+
+    chans = self.Sim.IOConsts.IOCONSTNAME
+    perms = self.Sim.IOConsts.IODICT
+    self.Readable = numpy.array([('R' in perms[chans[c]]) and hasattr(self.Sim, f"{chans[c]}R")
+      for c in range(len(chans))])
+    self.Writable = numpy.array([('W' not in perms[chans[c]]) or hasattr(self.Sim, f"{chans[c]}W")
+      for c in range(len(chans))])
+
+    self.Vector = self.buildDispatch()
+    self.Live = numpy.zeros(n, dtype=bool)
+    self.reset()
+
+  def buildDispatch(self):
+    """
+    Vector handlers, by op number. Immediates and fused pairs aren't in it.
+    """
+    OP = self.CPU.Opcodes.OPCODENUM
+    table = {}
+    for name in ('DUP', 'DROP', 'SWAP', 'OVER', 'ROT', 'NROT', 'NEG', 'REC', 'TZ', 'TIN',
+        'BINV', 'BZ', 'BNZ', 'BRA', 'CALL', 'EXIT', 'WAIT', 'NOP', 'TOR', 'FROMR', 'COPYR',
+        'COPY', 'TXP', 'IOR', 'IOW', 'STOP', 'FOR', 'ENDFOR', 'INDEX'):
+      table[OP[name]] = getattr(self, name)
+
+    for name, func in list(self.BINARY.items()) + list(self.BITWISE.items()):
+      table[OP[name]] = lambda lanes, ins, func=func: self.binary(lanes, ins, func)
+
+    table[OP['/']] = self.DIV
+    table[OP[';']] = self.EXIT
+    table[OP['RXP?']] = self.TXP
+    table[OP['!']] = self.STORE
+    table[OP['@']] = self.FETCH
+    table[OP['!B']] = self.STOREB
+    table[OP['@B']] = self.FETCHB
+
+    F = self.CPU.FUSEDOPS
+    table[F['CALL']] = self.F_CALL
+    table[F['BZ']] = self.F_BZ
+    table[F['BNZ']] = self.F_BNZ
+    table[F['BRA']] = self.F_BRA
+    table[F['IOR']] = self.F_IOR
+    table[F['IOW']] = self.F_IOW
+    return table
+
+  def reset(self):
+    """
+    CPU.reset() and SysTime.reset() for every lane
+    """
+    self.PC[:] = 0
+    self.Cycles[:] = 0
+    self.Ticks[:] = 0
+    self.Sim.reset()
+    self.Stopped[:] = False
+    for name in self.STACKS:
+      getattr(self, name).reset()
+    self.Scratch[:] = 0
+    self.TXPacket[:] = 0
+    self.RXPacket[:] = 0
+
+  def moveToWord(self, word):
+    if word in self.CPU.D.Words:
+      self.PC[:] = self.CPU.D.Words[word][1]
+
+  def snapshot(self, i):
+    """
+    Lane i as a vm.Snapshot, which any CPU can restore()
+    """
+    return vm.Snapshot(int(self.PC[i]), int(self.Cycles[i]), bool(self.Stopped[i]), int(self.Ticks[i]),
+      self.Stack.snapshot(i), self.CallStack.snapshot(i), self.ControlStack.snapshot(i),
+      self.Scratch[i].tobytes(), self.TXPacket[i].tobytes(), self.RXPacket[i].tobytes(),
+      self.ROM[i].tobytes(), self.Sim.snapshot(i), None)
+
+  def restore(self, i, snap):
+    """
+    Make lane i the machine in snap, from any CPU's snapshot()
+    """
+    self.PC[i] = snap.pc
+    self.Cycles[i] = snap.cycles
+    self.Stopped[i] = snap.stopped
+    self.Ticks[i] = snap.ticks
+    self.Stack.restore(i, snap.stack)
+    self.CallStack.restore(i, snap.callstack)
+    self.ControlStack.restore(i, snap.controlstack)
+    for name, data in (("Scratch", snap.scratch), ("TXPacket", snap.tx), ("RXPacket", snap.rx), ("ROM", snap.rom)):
+      row = getattr(self, name)[i]
+      row[:] = numpy.frombuffer(data, dtype=numpy.uint8)[:len(row)]
+    self.Sim.restore(i, snap.sim)
+
+  def load(self, i):
+    """
+    Copy lane i into Scalar
+    """
+    cpu = self.Scalar
+    self.View.I = i
+    cpu.restore(self.snapshot(i))
+    for name in self.STACKS:
+      getattr(cpu, name).HighWater = int(getattr(self, name).HighWater[i])
+
+    return cpu
+
+  def save(self, i):
+    """
+    Copy Scalar back into lane i
+    """
+    cpu = self.Scalar
+    self.restore(i, cpu.snapshot())
+    for name in self.STACKS:
+      getattr(self, name).HighWater[i] = getattr(cpu, name).HighWater
+
+  def run(self, max_cycles=None, until_ticks=None):
+    """
+    FastCPU.run() on every lane. Returns a list of their RunResults.
+    """
+    n = self.N
+    start = self.Cycles.copy()
+    self.End = numpy.full(n, self.BIG) if max_cycles is None else start + max_cycles
+    self.Until = until_ticks
+    self.Live[:] = True
+    self.Reasons = [None]*n
+    self.Errors = [None]*n
+
+    with numpy.errstate(all='ignore'):
+      everyone = numpy.arange(n)
+      self.check(everyone)
+      for i in numpy.flatnonzero(self.Live & self.Stopped):
+        self.retire(i, vm.StopReason.STOPPED)
+      for i in numpy.flatnonzero(self.Live):
+        if not self.inStep(i):
+          self.detach(i)
+
+      key = numpy.where(self.Live, self.PC, self.BIG)
+      while True:
+        pc = int(key.min())
+        if pc >= self.BIG:
+          break
+
+        lanes = numpy.flatnonzero(key == pc)
+        ins = self.CPU.Fused[pc]
+        if ins is None:
+          ins = self.CPU.fuse(pc)
+
+        self.dispatch(lanes, ins)
+        self.check(lanes)
+        key[lanes] = numpy.where(self.Live[lanes], self.PC[lanes], self.BIG)
+
+    return [vm.RunResult(self.Reasons[i], int(self.Cycles[i] - start[i]), self.Errors[i]) for i in range(n)]
+
+  def retire(self, i, reason, error=None):
+    """
+    Lane i has finished the run, for reason
+    """
+    self.Reasons[i] = reason
+    self.Errors[i] = error
+    self.Live[i] = False
+
+  def check(self, lanes):
+    """
+    Retire those of lanes that have run max_cycles, or got to until_ticks
+    """
+    lanes = lanes[self.Live[lanes]]
+    over = self.Cycles[lanes] >= self.End[lanes]
+    for i in lanes[over]:
+      self.retire(i, vm.StopReason.CYCLES)
+
+    if self.Until is not None:
+      for i in lanes[~over & (self.Ticks[lanes] >= self.Until)]:
+        self.retire(i, vm.StopReason.TICKS)
+
+  def inStep(self, i):
+    """
+    True if lane i can run in lockstep: it's in program RAM, and that's
+    the same as everyone's
+    """
+    return (0 <= self.PC[i] < len(self.Program)) and numpy.array_equal(self.ROM[i], self.Program)
+
+  def detach(self, i):
+    """
+    Finish the run for lane i on its own
+    """
+    end = self.End[i]
+    cpu = self.load(i)
+    result = cpu.run(None if end >= self.BIG else int(end - self.Cycles[i]), self.Until)
+    self.save(i)
+    self.retire(i, result.reason, result.error)
+
+  def slow(self, lanes):
+    """
+    Run one opcode on each of lanes, with Scalar
+    """
+    cpu = self.Scalar
+    for i in lanes:
+      i = int(i)
+      self.load(i)
+      try:
+        cpu.runCached(1)
+      except vm.VMCPUStopped:
+        self.retire(i, vm.StopReason.STOPPED)
+      except Exception as e:
+        self.retire(i, vm.StopReason.ERROR, e)
+
+      self.save(i)
+      if self.Live[i] and not self.inStep(i):
+        self.detach(i)
+
+  def dispatch(self, lanes, ins):
+    """
+    Run ins on lanes, which are all at it
+    """
+    if ins.op >= 0x100:
+      # The pair can only be run as one by lanes that wouldn't stop between
+      # them. The others just run the immediate.
+      ok = (self.End[lanes] - self.Cycles[lanes] >= 2) & (self.Stack.Top[lanes] < self.Stack.Size)
+      if self.Until is not None:
+        ok &= self.Ticks[lanes] + 1 < self.Until
+      if not ok.all():
+        self.IMM(lanes[~ok], ins.first)
+        lanes = lanes[ok]
+      if len(lanes):
+        self.Vector[ins.op](lanes, ins)
+
+    elif ins.operand is not None:
+      self.IMM(lanes, ins)
+    elif ins.op in self.Vector:
+      self.Vector[ins.op](lanes, ins)
+    else:
+      self.slow(lanes)
+
+  def split(self, lanes, bad, ins):
+    """
+    Run lanes[bad] with Scalar, and the rest as usual
+    """
+    self.slow(lanes[bad])
+    lanes = lanes[~bad]
+    if len(lanes):
+      self.dispatch(lanes, ins)
+
+  def advance(self, lanes, ins, cycles=1):
+    """
+    Count ins for lanes, and move them on to the next instruction
+    """
+    self.Cycles[lanes] += cycles
+    self.Ticks[lanes] += cycles
+    self.PC[lanes] = ins.nextpc
+
+  def address(self, x):
+    """
+    x rounded to program addresses, and which of them are in program RAM
+    """
+    a = numpy.rint(x)
+    ok = (a >= 0) & (a < len(self.Program))
+    return numpy.where(ok, a, 0).astype(numpy.int64), ok
+
+  def integer(self, x, low=-(1 << 62), high=1 << 62):
+    """
+    x rounded to ints, and which of them are between low and high
+    """
+    a = numpy.rint(x)
+    ok = (a >= low) & (a <= high)
+    return numpy.where(ok, a, 0).astype(numpy.int64), ok
+
+  def cells(self, x, regions, width):
+    """
+    Where in memory the width bytes at addresses x are, for each of x, as
+    (region, offset). region is an index in regions, or -1 for anywhere else.
+    """
+    a, ok = self.integer(x)
+    region = numpy.full(len(a), -1)
+    offset = numpy.zeros(len(a), dtype=numpy.int64)
+    for n, (name, base, size) in enumerate(regions):
+      inside = ok & (a >= base) & (a <= base + size - width)
+      region[inside] = n
+      offset[inside] = a[inside] - base
+
+    return region, offset
+
+  def push(self, stack, lanes, top, x):
+    """
+    Push x on stack for lanes, whose Top is top
+    """
+    stack.Values[lanes, top] = x
+    stack.Top[lanes] = top + 1
+    stack.grew(lanes)
+
+  """
+  OPCODES START HERE. Each runs an opcode for lanes, all at the same PC.
+  Lanes it can't do go to split() before anything has changed.
+  """
+
+  def IMM(self, lanes, ins):
+    S = self.Stack
+    t = S.Top[lanes]
+    bad = t >= S.Size
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    self.advance(lanes, ins)
+    self.push(S, lanes, t, ins.operand)
+
+  def DUP(self, lanes, ins):
+    S = self.Stack
+    t = S.Top[lanes]
+    bad = (t < 1) | (t >= S.Size)
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    self.advance(lanes, ins)
+    self.push(S, lanes, t, S.Values[lanes, t-1])
+
+  def DROP(self, lanes, ins):
+    S = self.Stack
+    t = S.Top[lanes]
+    bad = t < 1
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    self.advance(lanes, ins)
+    S.Top[lanes] = t - 1
+
+  def SWAP(self, lanes, ins):
+    S = self.Stack
+    t = S.Top[lanes]
+    bad = t < 2
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    self.advance(lanes, ins)
+    V = S.Values
+    V[lanes, t-2], V[lanes, t-1] = V[lanes, t-1], V[lanes, t-2]
+
+  def OVER(self, lanes, ins):
+    S = self.Stack
+    t = S.Top[lanes]
+    bad = (t < 2) | (t >= S.Size)
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    self.advance(lanes, ins)
+    self.push(S, lanes, t, S.Values[lanes, t-2])
+
+  def ROT(self, lanes, ins):
+    # a b c -- b c a
+    S = self.Stack
+    t = S.Top[lanes]
+    bad = t < 3
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    self.advance(lanes, ins)
+    V = S.Values
+    V[lanes, t-3], V[lanes, t-2], V[lanes, t-1] = V[lanes, t-2], V[lanes, t-1], V[lanes, t-3]
+
+  def NROT(self, lanes, ins):
+    # a b c -- c a b
+    S = self.Stack
+    t = S.Top[lanes]
+    bad = t < 3
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    self.advance(lanes, ins)
+    V = S.Values
+    V[lanes, t-3], V[lanes, t-2], V[lanes, t-1] = V[lanes, t-1], V[lanes, t-3], V[lanes, t-2]
+
+  def COPY(self, lanes, ins):
+    S = self.Stack
+    t = S.Top[lanes]
+    bad = t < 1
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    # Only items that are on the stack. FastCPU reads above the top.
+    n, ok = self.integer(S.Values[lanes, t-1], 0, t - 2)
+    if not ok.all():
+      return self.split(lanes, ~ok, ins)
+
+    self.advance(lanes, ins)
+    S.Values[lanes, t-1] = S.Values[lanes, t-2-n]
+
+  def binary(self, lanes, ins, func):
+    """
+    x y -- func(x, y). Arithmetic is done in doubles, and rounded to
+    float32 when it's stored, the same as FastCPU.
+    """
+    S = self.Stack
+    t = S.Top[lanes]
+    bad = t < 2
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    x = S.Values[lanes, t-2].astype(F64)
+    y = S.Values[lanes, t-1].astype(F64)
+    bitwise = func in self.BITWISE.values()
+    if bitwise:
+      x, okx = self.integer(x)
+      y, oky = self.integer(y)
+      if not (okx & oky).all():
+        return self.split(lanes, ~(okx & oky), ins)
+
+    self.advance(lanes, ins)
+    x = func(x, y)
+    S.Values[lanes, t-2] = x.astype(F64) if bitwise else x
+    S.Top[lanes] = t - 1
+
+  def DIV(self, lanes, ins):
+    S = self.Stack
+    t = S.Top[lanes]
+    bad = t < 2
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    y = S.Values[lanes, t-1].astype(F64)
+    bad = y == 0
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    self.advance(lanes, ins)
+    S.Values[lanes, t-2] = S.Values[lanes, t-2].astype(F64) / y
+    S.Top[lanes] = t - 1
+
+  def unary(self, lanes, ins):
+    """
+    Checks lanes for an opcode that replaces the TOS. Returns (lanes, tops,
+    TOS as doubles), or None if it's passed them to split().
+    """
+    S = self.Stack
+    t = S.Top[lanes]
+    bad = t < 1
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    return lanes, t, S.Values[lanes, t-1].astype(F64)
+
+  def NEG(self, lanes, ins):
+    args = self.unary(lanes, ins)
+    if args is not None:
+      lanes, t, x = args
+      self.advance(lanes, ins)
+      self.Stack.Values[lanes, t-1] = -x
+
+  def REC(self, lanes, ins):
+    args = self.unary(lanes, ins)
+    if args is not None:
+      lanes, t, x = args
+      bad = x == 0
+      if bad.any():
+        return self.split(lanes, bad, ins)
+
+      self.advance(lanes, ins)
+      self.Stack.Values[lanes, t-1] = 1.0 / x
+
+  def TZ(self, lanes, ins):
+    args = self.unary(lanes, ins)
+    if args is not None:
+      lanes, t, x = args
+      self.advance(lanes, ins)
+      self.Stack.Values[lanes, t-1] = x == 0
+
+  def TIN(self, lanes, ins):
+    args = self.unary(lanes, ins)
+    if args is not None:
+      lanes, t, x = args
+      self.advance(lanes, ins)
+      self.Stack.Values[lanes, t-1] = ~numpy.isfinite(x)
+
+  def BINV(self, lanes, ins):
+    args = self.unary(lanes, ins)
+    if args is not None:
+      lanes, t, x = args
+      x, ok = self.integer(x)
+      if not ok.all():
+        return self.split(lanes, ~ok, ins)
+
+      self.advance(lanes, ins)
+      self.Stack.Values[lanes, t-1] = numpy.invert(x).astype(F64)
+
+  def branch(self, lanes, ins, taken):
+    """
+    x a -- : Branch to a where taken(x)
+    """
+    S = self.Stack
+    t = S.Top[lanes]
+    bad = t < 2
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    go = taken(S.Values[lanes, t-2])
+    target, ok = self.address(S.Values[lanes, t-1])
+    bad = go & ~ok
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    self.advance(lanes, ins)
+    S.Top[lanes] = t - 2
+    self.PC[lanes[go]] = target[go]
+
+  def BZ(self, lanes, ins):
+    self.branch(lanes, ins, lambda x: x == 0)
+
+  def BNZ(self, lanes, ins):
+    self.branch(lanes, ins, lambda x: x != 0)
+
+  def BRA(self, lanes, ins):
+    S = self.Stack
+    t = S.Top[lanes]
+    bad = t < 1
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    target, ok = self.address(S.Values[lanes, t-1])
+    if not ok.all():
+      return self.split(lanes, ~ok, ins)
+
+    self.advance(lanes, ins)
+    S.Top[lanes] = t - 1
+    self.PC[lanes] = target
+
+  def CALL(self, lanes, ins):
+    S = self.Stack
+    C = self.CallStack
+    t = S.Top[lanes]
+    ct = C.Top[lanes]
+    bad = (t < 1) | (ct >= C.Size)
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    target, ok = self.address(S.Values[lanes, t-1])
+    if not ok.all():
+      return self.split(lanes, ~ok, ins)
+
+    self.advance(lanes, ins)
+    self.push(C, lanes, ct, ins.nextpc)
+    S.Top[lanes] = t - 1
+    self.PC[lanes] = target
+
+  def EXIT(self, lanes, ins):
+    C = self.CallStack
+    ct = C.Top[lanes]
+    bad = ct < 1
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    target, ok = self.address(C.Values[lanes, ct-1])
+    if not ok.all():
+      return self.split(lanes, ~ok, ins)
+
+    self.advance(lanes, ins)
+    C.Top[lanes] = ct - 1
+    self.PC[lanes] = target
+
+  def WAIT(self, lanes, ins):
+    self.advance(lanes, ins)
+    ticks = self.Ticks[lanes]
+    self.Ticks[lanes] = ticks + (-ticks) % systemtime.SystemTime.ACPERIOD
+
+  def NOP(self, lanes, ins):
+    self.advance(lanes, ins)
+
+  def TOR(self, lanes, ins):
+    S = self.Stack
+    C = self.CallStack
+    t = S.Top[lanes]
+    ct = C.Top[lanes]
+    bad = (t < 1) | (ct >= C.Size)
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    self.advance(lanes, ins)
+    self.push(C, lanes, ct, S.Values[lanes, t-1])
+    S.Top[lanes] = t - 1
+
+  def FROMR(self, lanes, ins):
+    S = self.Stack
+    C = self.CallStack
+    t = S.Top[lanes]
+    ct = C.Top[lanes]
+    bad = (ct < 1) | (t >= S.Size)
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    self.advance(lanes, ins)
+    self.push(S, lanes, t, C.Values[lanes, ct-1])
+    C.Top[lanes] = ct - 1
+
+  def COPYR(self, lanes, ins):
+    S = self.Stack
+    C = self.CallStack
+    t = S.Top[lanes]
+    ct = C.Top[lanes]
+    bad = (ct < 1) | (t >= S.Size)
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    self.advance(lanes, ins)
+    self.push(S, lanes, t, C.Values[lanes, ct-1])
+
+  def TXP(self, lanes, ins):
+    # TXP and RXP? both always push 1
+    S = self.Stack
+    t = S.Top[lanes]
+    bad = t >= S.Size
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    self.advance(lanes, ins)
+    self.push(S, lanes, t, 1.0)
+
+  def STOP(self, lanes, ins):
+    self.advance(lanes, ins)
+    self.Stopped[lanes] = True
+    for i in lanes:
+      self.retire(i, vm.StopReason.STOPPED)
+
+  def fetch(self, lanes, ins, width):
+    S = self.Stack
+    t = S.Top[lanes]
+    bad = t < 1
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    region, offset = self.cells(S.Values[lanes, t-1], self.READS, width)
+    bad = region < 0
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    self.advance(lanes, ins)
+    x = numpy.empty(len(lanes))
+    for n, (name, base, size) in enumerate(self.READS):
+      here = region == n
+      if here.any():
+        mem = getattr(self, name)
+        rows = lanes[here]
+        if width == 1:
+          x[here] = mem[rows, offset[here]]
+        else:
+          data = mem[rows[:, None], offset[here][:, None] + numpy.arange(width)]
+          x[here] = data.view('<f4')[:, 0]
+
+    S.Values[lanes, t-1] = x
+
+  def FETCH(self, lanes, ins):
+    self.fetch(lanes, ins, 4)
+
+  def FETCHB(self, lanes, ins):
+    self.fetch(lanes, ins, 1)
+
+  def store(self, lanes, ins, width):
+    S = self.Stack
+    t = S.Top[lanes]
+    bad = t < 2
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    x = S.Values[lanes, t-2].astype(F64)
+    region, offset = self.cells(S.Values[lanes, t-1], self.WRITES, width)
+    bad = region < 0
+    if width == 1:
+      x, ok = self.integer(x, 0, 255)
+      bad |= ~ok
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    self.advance(lanes, ins)
+    S.Top[lanes] = t - 2
+    if width == 1:
+      data = x.astype(numpy.uint8)[:, None]
+    else:
+      data = x.astype('<f4').view(numpy.uint8).reshape(-1, width)
+
+    for n, (name, base, size) in enumerate(self.WRITES):
+      here = region == n
+      if here.any():
+        mem = getattr(self, name)
+        mem[lanes[here][:, None], offset[here][:, None] + numpy.arange(width)] = data[here]
+
+  def STORE(self, lanes, ins):
+    self.store(lanes, ins, 4)
+
+  def STOREB(self, lanes, ins):
+    self.store(lanes, ins, 1)
+
+  def channel(self, x, allowed):
+    """
+    x rounded to IO channels, and which of them are allowed
+    """
+    chan, ok = self.integer(x, 0, len(allowed) - 1)
+    return chan, ok & allowed[chan]
+
+  def IOR(self, lanes, ins):
+    S = self.Stack
+    t = S.Top[lanes]
+    bad = t < 1
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    chan, ok = self.channel(S.Values[lanes, t-1], self.Readable)
+    if not ok.all():
+      return self.split(lanes, ~ok, ins)
+
+    self.advance(lanes, ins)
+    S.Values[lanes, t-1] = self.Sim.ioReadF(lanes, chan, self.Ticks[lanes])
+
+  def IOW(self, lanes, ins):
+    S = self.Stack
+    t = S.Top[lanes]
+    bad = t < 2
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    chan, ok = self.channel(S.Values[lanes, t-1], self.Writable)
+    if not ok.all():
+      return self.split(lanes, ~ok, ins)
+
+    self.advance(lanes, ins)
+    S.Top[lanes] = t - 2
+    self.Sim.ioWriteF(lanes, S.Values[lanes, t-2].astype(F64), chan, self.Ticks[lanes])
+
+  def FOR(self, lanes, ins):
+    # limit step index nextblockaddr --, and {limit step index startaddr} if
+    # it goes into the loop
+    S = self.Stack
+    C = self.CallStack
+    t = S.Top[lanes]
+    bad = t < 4
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    V = S.Values
+    limit, step, index = V[lanes, t-4], V[lanes, t-3], V[lanes, t-2]
+    target, ok = self.address(V[lanes, t-1])
+    enter = ((step > 0) & (index < limit)) | ((step < 0) & (index > limit))
+    ct = C.Top[lanes]
+    bad = numpy.where(enter, ct + 4 > C.Size, ~ok)
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    self.advance(lanes, ins)
+    S.Top[lanes] = t - 4
+    into = lanes[enter]
+    ct = ct[enter]
+    C.Values[into, ct] = limit[enter]
+    C.Values[into, ct+1] = step[enter]
+    C.Values[into, ct+2] = index[enter]
+    C.Values[into, ct+3] = ins.nextpc
+    C.Top[into] = ct + 4
+    C.grew(into)
+    self.PC[lanes[~enter]] = target[~enter]
+
+  def ENDFOR(self, lanes, ins):
+    # {limit step index startaddr} -- {limit step index+step startaddr} and
+    # back to startaddr, or -- {} at the end of the loop. The new index is
+    # compared before it's rounded to float32.
+    C = self.CallStack
+    ct = C.Top[lanes]
+    bad = ct < 4
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    V = C.Values
+    limit, step = V[lanes, ct-4], V[lanes, ct-3]
+    index = V[lanes, ct-2].astype(F64) + step
+    leave = numpy.where(step > 0, index >= limit, index <= limit)
+    target, ok = self.address(V[lanes, ct-1])
+    bad = ~leave & ~ok
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    self.advance(lanes, ins)
+    C.Top[lanes[leave]] = ct[leave] - 4
+    back = ~leave
+    V[lanes[back], ct[back]-2] = index[back]
+    self.PC[lanes[back]] = target[back]
+
+  def INDEX(self, lanes, ins):
+    S = self.Stack
+    C = self.CallStack
+    t = S.Top[lanes]
+    bad = t < 1
+    if bad.any():
+      return self.split(lanes, bad, ins)
+
+    # Only loops that are on the CallStack. FastCPU reads above the top.
+    ct = C.Top[lanes]
+    loop, ok = self.integer(S.Values[lanes, t-1], 0, (ct - 2) // 4)
+    if not ok.all():
+      return self.split(lanes, ~ok, ins)
+
+    self.advance(lanes, ins)
+    S.Values[lanes, t-1] = C.Values[lanes, ct - 2 - loop*4]
+
+  """
+  FUSED PAIRS. An immediate a and the opcode after it, for lanes that can
+  run both. Lanes the opcode would fail on just run the immediate.
+  """
+
+  def fused(self, lanes, ins, bad):
+    """
+    Run the immediate on its own for lanes[bad], and return the rest
+    """
+    if bad.any():
+      self.IMM(lanes[bad], ins.first)
+      lanes = lanes[~bad]
+
+    return lanes
+
+  def target(self, ins):
+    """
+    The fused immediate as a program address, or None if it isn't one
+    """
+    a = int(round(ins.operand)) if numpy.isfinite(ins.operand) else -1
+    return a if 0 <= a < len(self.Program) else None
+
+  def F_CALL(self, lanes, ins):
+    C = self.CallStack
+    a = self.target(ins)
+    lanes = self.fused(lanes, ins, (C.Top[lanes] >= C.Size) | (a is None))
+    if len(lanes):
+      self.advance(lanes, ins, 2)
+      self.push(C, lanes, C.Top[lanes], ins.nextpc)
+      self.PC[lanes] = a
+
+  def fusedBranch(self, lanes, ins, taken):
+    S = self.Stack
+    a = self.target(ins)
+    lanes = self.fused(lanes, ins, (S.Top[lanes] < 1) | (a is None))
+    if len(lanes):
+      self.advance(lanes, ins, 2)
+      t = S.Top[lanes]
+      go = taken(S.Values[lanes, t-1])
+      S.Top[lanes] = t - 1
+      self.PC[lanes[go]] = a
+
+  def F_BZ(self, lanes, ins):
+    self.fusedBranch(lanes, ins, lambda x: x == 0)
+
+  def F_BNZ(self, lanes, ins):
+    self.fusedBranch(lanes, ins, lambda x: x != 0)
+
+  def F_BRA(self, lanes, ins):
+    a = self.target(ins)
+    lanes = self.fused(lanes, ins, numpy.full(len(lanes), a is None))
+    if len(lanes):
+      self.advance(lanes, ins, 2)
+      self.PC[lanes] = a
+
+  def F_IOR(self, lanes, ins):
+    chan, ok = self.channel(numpy.array([ins.operand], dtype=F64), self.Readable)
+    lanes = self.fused(lanes, ins, numpy.full(len(lanes), not ok[0]))
+    if len(lanes):
+      S = self.Stack
+      self.advance(lanes, ins, 2)
+      self.push(S, lanes, S.Top[lanes], self.Sim.ioReadF(lanes, chan[0], self.Ticks[lanes]))
+
+  def F_IOW(self, lanes, ins):
+    S = self.Stack
+    chan, ok = self.channel(numpy.array([ins.operand], dtype=F64), self.Writable)
+    lanes = self.fused(lanes, ins, (S.Top[lanes] < 1) | (not ok[0]))
+    if len(lanes):
+      self.advance(lanes, ins, 2)
+      t = S.Top[lanes]
+      S.Top[lanes] = t - 1
+      self.Sim.ioWriteF(lanes, S.Values[lanes, t-1].astype(F64), chan[0], self.Ticks[lanes])
+
+def main(argv):
+  if len(argv) < 3:
+    print(__doc__)
+    return
+
+  n = int(argv[2])
+  word = argv[3] if len(argv) > 3 else "RunShot"
+  maxcycles = int(argv[4]) if len(argv) > 4 else 1000000
+
+  # Lane i starts i ticks late, so they don't all do the same
+  lanes = Lockstep(argv[1], n)
+  lanes.moveToWord(word)
+  lanes.Ticks[:] = numpy.arange(n)
+  lanes.Sim.Updated[:] = lanes.Ticks
+  starts = [lanes.snapshot(i) for i in range(n)]
+
+  started = time.perf_counter()
+  results = lanes.run(max_cycles=maxcycles)
+  taken = time.perf_counter() - started
+  print(f"Lockstep: {n} lanes, {sum(r.cycles for r in results)} cycles, {taken:.3f}s")
+
+  cpu = vm.FastCPU(systemtime.SystemTime())
+  cpu.loadDebug(argv[1])
+  different = 0
+  started = time.perf_counter()
+  for i in range(n):
+    # restore() keeps the deepest HighWater, so start each lane from none
+    for name in lanes.STACKS:
+      getattr(cpu, name).HighWater = 0
+    cpu.restore(starts[i])
+    result = cpu.run(max_cycles=maxcycles)
+    high = [getattr(cpu, name).HighWater for name in lanes.STACKS]
+    if ((result.reason, result.cycles) != results[i][:2] or cpu.snapshot() != lanes.snapshot(i)
+        or high != [getattr(lanes, name).HighWater[i] for name in lanes.STACKS]):
+      different += 1
+  taken = time.perf_counter() - started
+  print(f"One at a time: {taken:.3f}s. {different} lanes different.")
+
+if __name__ == "__main__":
+  main(sys.argv)
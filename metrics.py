@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Coverage and frequency counters for FROTH programs.
+
+Runs a CPU with an observer that counts how often each opcode is run, which
+addresses are run at all, the IO reads and writes on each channel, and the
+deepest each stack gets. They can be written out as JSON, or as Prometheus
+text, for the nightly sweeps to compare.
+
+Usage: python3 metrics.py prog.debug [word ...] [--max N] [--json out.json] [--prom out.prom]
+"""
+import array, json, os, sys
+import vm, systemtime
+from ioconsts import IOConsts
+
+class Metrics:
+  """
+  Counters for everything a CPU runs through run(). They add up over any
+  number of runs, until reset().
+  """
+  IOConsts = IOConsts()
+  STACKS = ("Stack", "CallStack", "ControlStack")
+
+  def __init__(self, cpu):
+    self.CPU = cpu
+    OP = cpu.Opcodes.OPCODENUM
+    self.O_IOR = OP['IOR']
+    self.O_IORT = OP['IORT']
+    self.O_IOW = OP['IOW']
+    self.reset()
+
+  def reset(self):
+    cpu = self.CPU
+    channels = len(self.IOConsts.IOCONSTNAME)
+    self.Opcodes = array.array('Q', [0]*256)
+    self.Hit = bytearray(len(cpu.ROM))
+    self.Reads = array.array('Q', [0]*channels)
+    self.Writes = array.array('Q', [0]*channels)
+    self.HighWater = dict((name, 0) for name in self.STACKS)
+    self.Cycles = 0
+    self.Ticks = 0
+
+  def ioChannel(self, pos):
+    """
+    Number of the channel at pos on the stack, or None if there isn't one
+    """
+    stack = self.CPU.Stack
+    if stack.Top <= pos:
+      return None
+
+    chan = int(round(stack.Values[stack.Top-1-pos]))
+    return chan if 0 <= chan < len(self.Reads) else None
+
+  def opcode(self, pc, ins):
+    """
+    The observer. Counts ins.
+    """
+    op = ins.op
+    self.Opcodes[op] += 1
+    self.Hit[pc] = 1
+    if (op == self.O_IOR) or (op == self.O_IORT):
+      chan = self.ioChannel(0)
+      if chan is not None:
+        self.Reads[chan] += 1
+    elif op == self.O_IOW:
+      chan = self.ioChannel(0)
+      if chan is not None:
+        self.Writes[chan] += 1
+
+  def run(self, max_cycles=None, until_ticks=None, ignorebp=None):
+    """
+    CPU.run(), counting everything it does
+    """
+    cpu = self.CPU
+    ticks = cpu.SysTime.Ticks
+    result = cpu.run(max_cycles, until_ticks, ignorebp, observer=self.opcode)
+    for name in self.STACKS:
+      self.HighWater[name] = max(self.HighWater[name], getattr(cpu, name).HighWater)
+    self.Cycles += result.cycles
+    self.Ticks += cpu.SysTime.Ticks - ticks
+    return result
+
+  def opName(self, op):
+    return "IMM" if op & 0x80 else self.CPU.Opcodes.OPCODENAME.get(op, "?")
+
+  def instructions(self):
+    """
+    Addresses of the instructions in the program, walking it from 0
+    """
+    cpu = self.CPU
+    addrs = []
+    addr = 0
+    while addr < len(cpu.D.MemBytes):
+      addrs.append(addr)
+      ins = cpu.Decoded[addr]
+      addr = (ins if ins is not None else cpu.decode(addr)).nextpc
+
+    return addrs
+
+  def toDict(self):
+    chans = self.IOConsts.IOCONSTNAME
+    program = self.instructions()
+    return {
+      'cycles' : self.Cycles,
+      'ticks' : self.Ticks,
+      'opcodes' : dict((f"0x{op:02X}", {'name' : self.opName(op), 'count' : n})
+        for op, n in enumerate(self.Opcodes) if n),
+      'coverage' : {
+        'instructions' : len(program),
+        'covered' : sum(self.Hit[addr] for addr in program),
+        'addresses' : [addr for addr, hit in enumerate(self.Hit) if hit],
+      },
+      'io' : dict((chans[c], {'reads' : self.Reads[c], 'writes' : self.Writes[c]})
+        for c in range(len(self.Reads))),
+      'stacks' : dict((name, {'highwater' : n, 'size' : getattr(self.CPU, name).Size})
+        for name, n in self.HighWater.items()),
+    }
+
+  def toJSON(self):
+    return json.dumps(self.toDict(), indent=2)
+
+  def prometheus(self, labels=None, prefix="froth_"):
+    """
+    The counters in Prometheus text exposition format. labels is a dict of
+    labels to put on every sample, eg. {'program' : 'Flat9'}.
+    """
+    labels = labels or {}
+    lines = []
+
+    def metric(name, kind, help, samples):
+      lines.append(f"# HELP {prefix}{name} {help}")
+      lines.append(f"# TYPE {prefix}{name} {kind}")
+      for extra, value in samples:
+        pairs = list(labels.items()) + list(extra.items())
+        text = ",".join(f'{k}="{v}"' for k, v in pairs)
+        lines.append(f"{prefix}{name}{{{text}}} {value}" if text else f"{prefix}{name} {value}")
+
+    chans = self.IOConsts.IOCONSTNAME
+    program = self.instructions()
+    metric("cycles_total", "counter", "Opcodes run.", [({}, self.Cycles)])
+    metric("ticks_total", "counter", "SysTime ticks taken.", [({}, self.Ticks)])
+    metric("opcode_total", "counter", "Times each opcode was run.",
+      [({'op' : f"0x{op:02X}", 'name' : self.opName(op)}, n)
+        for op, n in enumerate(self.Opcodes) if n])
+    metric("instructions", "gauge", "Instructions in the program.", [({}, len(program))])
+    metric("instructions_covered", "gauge", "Instructions in the program that were run.",
+      [({}, sum(self.Hit[addr] for addr in program))])
+    metric("io_reads_total", "counter", "IO reads on each channel.",
+      [({'channel' : chans[c]}, self.Reads[c]) for c in range(len(self.Reads))])
+    metric("io_writes_total", "counter", "IO writes on each channel.",
+      [({'channel' : chans[c]}, self.Writes[c]) for c in range(len(self.Writes))])
+    metric("stack_high_water", "gauge", "Most items each stack held.",
+      [({'stack' : name}, n) for name, n in self.HighWater.items()])
+    return "\n".join(lines) + "\n"
+
+def main(argv):
+  args = argv[1:]
+  options = {}
+  for option in ('--max', '--json', '--prom'):
+    if option in args:
+      i = args.index(option)
+      options[option[2:]] = args[i+1]
+      args = args[:i] + args[i+2:]
+
+  if not args:
+    print(__doc__)
+    return
+
+  words = args[1:] or ["RunShot"]
+  maxcycles = int(options.get('max', 10000000))
+
+  cpu = vm.FastCPU(systemtime.SystemTime())
+  cpu.loadDebug(args[0])
+  metrics = Metrics(cpu)
+  for word in words:
+    cpu.reset()
+    cpu.SysTime.reset()
+    cpu.Sim.reset()
+    cpu.moveToWord(word)
+    result = metrics.run(max_cycles=maxcycles)
+    print(f"{word}: {result.reason} after {result.cycles} cycles", file=sys.stderr)
+    if result.error is not None:
+      print(f"  {result.error!r}", file=sys.stderr)
+
+  if 'json' in options:
+    with open(options['json'], 'w') as outfile:
+      outfile.write(metrics.toJSON())
+
+  program = os.path.splitext(os.path.basename(args[0]))[0]
+  text = metrics.prometheus({'program' : program})
+  if 'prom' in options:
+    with open(options['prom'], 'w') as outfile:
+      outfile.write(text)
+  elif 'json' not in options:
+    print(text, end="")
+
+if __name__ == "__main__":
+  main(sys.argv)
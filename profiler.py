@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Per-word profiler for FROTH programs.
+
+Runs a CPU with an observer that follows CALL, ; and EXIT, and charges each
+opcode's cycle and SysTime ticks to the word it's in. Reports inclusive and
+exclusive cycles and ticks, call counts and the deepest call depth of each
+word, and can write collapsed stacks for flamegraph tools.
+
+Usage: python3 profiler.py prog.debug [word] [max_cycles] [--folded out.folded]
+"""
+from collections import defaultdict
+import bisect, sys
+import vm, systemtime
+
+class WordProfile:
+  """
+  What one word cost. Cycles and Ticks include the words it called,
+  SelfCycles and SelfTicks don't. MaxDepth is the deepest it was called,
+  with the word the run started in at depth 1.
+  """
+  def __init__(self, name):
+    self.Name = name
+    self.Calls = 0
+    self.Cycles = 0
+    self.SelfCycles = 0
+    self.Ticks = 0
+    self.SelfTicks = 0
+    self.MaxDepth = 0
+
+class Profiler:
+  def __init__(self, cpu):
+    self.CPU = cpu
+    self.D = cpu.D
+    self.Starts = sorted(self.D.WordsByAddr)
+    OP = cpu.Opcodes.OPCODENUM
+    self.O_CALL = OP['CALL']
+    self.O_RETS = (OP[';'], OP['EXIT'])
+    self.reset()
+
+  def reset(self):
+    self.Words = {}
+    self.PathCycles = defaultdict(int)
+    self.PathTicks = defaultdict(int)
+    self.Frames = []
+    self.Path = ""
+    self.Active = defaultdict(int)
+    self.LastOp = None
+    self.LastTicks = self.CPU.SysTime.Ticks
+
+  def wordAt(self, addr):
+    """
+    Name of the word that addr is in
+    """
+    i = bisect.bisect_right(self.Starts, addr) - 1
+    if i < 0:
+      return f"@{addr}"
+
+    return self.D.WordsByAddr[self.Starts[i]][0]
+
+  def profile(self, name):
+    prof = self.Words.get(name)
+    if prof is None:
+      prof = WordProfile(name)
+      self.Words[name] = prof
+
+    return prof
+
+  def enter(self, name):
+    """
+    Start a call of name, at the current cycle
+    """
+    cpu = self.CPU
+    prof = self.profile(name)
+    prof.Calls += 1
+    self.Frames.append((name, cpu.Cycles, cpu.SysTime.Ticks))
+    prof.MaxDepth = max(prof.MaxDepth, len(self.Frames))
+    self.Active[name] += 1
+    self.Path = ";".join(f[0] for f in self.Frames)
+
+  def leave(self):
+    cpu = self.CPU
+    name, cycles, ticks = self.Frames.pop()
+    self.Active[name] -= 1
+    if not self.Active[name]:
+      # Only the outermost call of a recursive word counts
+      prof = self.Words[name]
+      prof.Cycles += cpu.Cycles - cycles
+      prof.Ticks += cpu.SysTime.Ticks - ticks
+
+    self.Path = ";".join(f[0] for f in self.Frames)
+
+  def opcode(self, pc, ins):
+    """
+    The observer. Charges the ticks of the last opcode to where it ran,
+    follows the call or return it did, then charges this opcode's cycle.
+    """
+    ticks = self.CPU.SysTime.Ticks
+    if self.Frames:
+      self.Words[self.Frames[-1][0]].SelfTicks += ticks - self.LastTicks
+      self.PathTicks[self.Path] += ticks - self.LastTicks
+
+    self.LastTicks = ticks
+    last = self.LastOp
+    if last == self.O_CALL:
+      self.enter(self.D.WordsByAddr[pc][0] if pc in self.D.WordsByAddr else f"@{pc}")
+    elif last in self.O_RETS:
+      self.leave()
+
+    if not self.Frames:
+      self.enter(self.wordAt(pc))
+
+    self.Words[self.Frames[-1][0]].SelfCycles += 1
+    self.PathCycles[self.Path] += 1
+    self.LastOp = ins.op
+
+  def run(self, max_cycles=None, until_ticks=None, ignorebp=None):
+    """
+    CPU.run(), profiling everything it does. Can be called any number of
+    times, to add to the same profile.
+    """
+    result = self.CPU.run(max_cycles, until_ticks, ignorebp, observer=self.opcode)
+    # The last opcode's ticks
+    ticks = self.CPU.SysTime.Ticks
+    if self.Frames:
+      self.Words[self.Frames[-1][0]].SelfTicks += ticks - self.LastTicks
+      self.PathTicks[self.Path] += ticks - self.LastTicks
+
+    self.LastTicks = ticks
+    return result
+
+  def results(self):
+    """
+    The WordProfiles, most inclusive cycles first. Words that are still
+    running are counted up to now.
+    """
+    cpu = self.CPU
+    running = {}
+    for name, cycles, ticks in self.Frames:
+      if name not in running:
+        running[name] = (cpu.Cycles - cycles, cpu.SysTime.Ticks - ticks)
+
+    results = []
+    for name, prof in self.Words.items():
+      p = WordProfile(name)
+      p.__dict__.update(prof.__dict__)
+      p.Cycles += running.get(name, (0, 0))[0]
+      p.Ticks += running.get(name, (0, 0))[1]
+      results.append(p)
+
+    return sorted(results, key=lambda p: -p.Cycles)
+
+  def report(self):
+    lines = ["%-24s %8s %12s %12s %12s %12s %6s" % ("Word", "Calls", "Cycles", "Self", "Ticks", "Self", "Depth")]
+    for p in self.results():
+      lines.append("%-24s %8d %12d %12d %12d %12d %6d" % (p.Name, p.Calls, p.Cycles, p.SelfCycles,
+        p.Ticks, p.SelfTicks, p.MaxDepth))
+
+    return "\n".join(lines)
+
+  def collapsed(self, ticks=False):
+    """
+    Collapsed stacks, one "word;word;word count" line per call path, for
+    flamegraph tools. Counts are cycles, or SysTime ticks.
+    """
+    paths = self.PathTicks if ticks else self.PathCycles
+    return "\n".join(f"{path} {n}" for path, n in sorted(paths.items()) if n) + "\n"
+
+def main(argv):
+  args = argv[1:]
+  folded = None
+  if '--folded' in args:
+    i = args.index('--folded')
+    folded = args[i+1]
+    args = args[:i] + args[i+2:]
+
+  if not args:
+    print(__doc__)
+    return
+
+  word = args[1] if len(args) > 1 else "RunShot"
+  maxcycles = int(args[2]) if len(args) > 2 else 10000000
+
+  cpu = vm.FastCPU(systemtime.SystemTime())
+  cpu.loadDebug(args[0])
+  cpu.moveToWord(word)
+  profiler = Profiler(cpu)
+  result = profiler.run(max_cycles=maxcycles)
+  print(f"{word}: {result.reason} after {result.cycles} cycles, {cpu.SysTime.Ticks} ticks")
+  if result.error is not None:
+    print(f"  {result.error!r}")
+
+  print(profiler.report())
+  if folded is not None:
+    with open(folded, 'w') as outfile:
+      outfile.write(profiler.collapsed())
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Many DE1Sims at once, for parameter sweeps.
+
+DE1SimBatch holds the state of N independent simulated machines as numpy
+arrays, one element per instance, and does the same physics as DE1Sim to
+all of them, or any subset, in one go. Each instance has its own time, so
+everything that needs it takes the SysTime ticks of the instances it's for.
+
+IO is for a set of lanes: an instance number, or an array of them, with a
+channel and ticks for each (or one for all). Results come back the same
+way. view() makes an instance look like a DE1Sim, for a CPU's Sim.
+"""
+import numpy
+from vm import DE1Sim, SEntry
+import ioconsts
+
+class DE1SimBatch:
+  """
+  N DE1Sims. Each name in DE1Sim.STATE is an array of N values, and
+  HasTarget[target] says which instances have that target set, where a
+  DE1Sim's would be None.
+  """
+  FILTERED = DE1Sim.FILTERED
+  DECAY = DE1Sim.DECAY
+  IOConsts = ioconsts.IOConsts()
+
+  def __init__(self, n, ticks=0):
+    self.N = n
+    self.reset(ticks)
+
+  def reset(self, ticks=0):
+    """
+    DE1Sim.reset() for every instance, with Updated set to ticks
+    """
+    n = self.N
+    sim = DE1Sim(_Ticks(ticks))
+    self.HasTarget = {}
+    for name in DE1Sim.STATE:
+      x = getattr(sim, name)
+      if name == "Updated":
+        setattr(self, name, numpy.full(n, x, dtype=numpy.int64))
+      else:
+        setattr(self, name, numpy.full(n, 0.0 if x is None else x))
+
+    for value, target in self.FILTERED:
+      self.HasTarget[target] = numpy.full(n, getattr(sim, target) is not None)
+
+  def lanes(self, lanes, *values):
+    """
+    lanes as an array of instance numbers, and values broadcast to match
+    """
+    lanes = numpy.atleast_1d(numpy.arange(self.N)[lanes])
+    return (lanes,) + tuple(numpy.broadcast_to(v, lanes.shape) for v in values)
+
+  def snapshot(self, i):
+    """
+    Instance i's state, the same as DE1Sim.snapshot() would be
+    """
+    state = []
+    for name in DE1Sim.STATE:
+      has = self.HasTarget.get(name)
+      if (has is not None) and not has[i]:
+        state.append(None)
+      else:
+        state.append(getattr(self, name)[i].item())
+
+    return tuple(state)
+
+  def restore(self, i, state):
+    for name, x in zip(DE1Sim.STATE, state):
+      if name in self.HasTarget:
+        self.HasTarget[name][i] = x is not None
+
+      getattr(self, name)[i] = 0.0 if x is None else x
+
+  def valueAt(self, name, target, lanes, ticks):
+    """
+    What name will be for each of lanes at ticks, if its target doesn't
+    change before then
+    """
+    lanes, ticks = self.lanes(lanes, ticks)
+    x = getattr(self, name)[lanes]
+    goal = getattr(self, target)[lanes]
+    dt = ticks - self.Updated[lanes]
+    moving = self.HasTarget[target][lanes] & (dt > 0)
+    return numpy.where(moving, goal + (x - goal) * self.decay(numpy.where(moving, dt, 0)), x)
+
+  def decay(self, dt):
+    """
+    DECAY**dt for each of dt. numpy's power() doesn't always round the
+    same way as Python's, so each different dt is done once by Python, and
+    the results match a DE1Sim's exactly.
+    """
+    steps, where = numpy.unique(dt, return_inverse=True)
+    return numpy.array([self.DECAY**int(n) for n in steps])[where.reshape(numpy.shape(dt))]
+
+  def trend(self, name, target, lanes):
+    """
+    1 where name is going up with time, -1 where it's going down, and 0
+    where it isn't moving
+    """
+    lanes, = self.lanes(lanes)
+    x = getattr(self, name)[lanes]
+    goal = getattr(self, target)[lanes]
+    still = ~self.HasTarget[target][lanes] | (goal == x)
+    return numpy.where(still, 0, numpy.where(goal > x, 1, -1)).astype(numpy.int8)
+
+  def update(self, ticks, lanes=slice(None)):
+    """
+    Bring the values of lanes up to ticks, all in one go
+    """
+    lanes, ticks = self.lanes(lanes, ticks)
+    for name, target in self.FILTERED:
+      getattr(self, name)[lanes] = self.valueAt(name, target, lanes, ticks)
+
+    self.Updated[lanes] = ticks
+
+  def step(self, ticks=1, lanes=slice(None)):
+    """
+    Move lanes on by ticks, as if that many had gone by
+    """
+    lanes, ticks = self.lanes(lanes, ticks)
+    for name, target in self.FILTERED:
+      getattr(self, name)[lanes] = self.valueAt(name, target, lanes, self.Updated[lanes] + ticks)
+
+  def setTarget(self, target, x, lanes, ticks):
+    """
+    Set target to x for lanes, where x is None to unset it. Lanes whose
+    target changes are brought up to ticks first.
+    """
+    if x is None:
+      lanes, ticks = self.lanes(lanes, ticks)
+      changed = self.HasTarget[target][lanes]
+    else:
+      lanes, ticks, x = self.lanes(lanes, ticks, x)
+      has = self.HasTarget[target][lanes]
+      changed = ~has | (getattr(self, target)[lanes] != x)
+      x = x[changed]
+
+    lanes = lanes[changed]
+    self.update(ticks[changed], lanes)
+    self.HasTarget[target][lanes] = x is not None
+    if x is not None:
+      getattr(self, target)[lanes] = x
+
+  def clamp(self, x, minx, maxx):
+    x = numpy.where(x < minx, minx, x)
+    return numpy.where(x > maxx, maxx, x)
+
+  def channels(self, lanes, y, *values):
+    """
+    Yields (name, lanes, values...) for each channel in y, with the lanes
+    that are for it
+    """
+    lanes, y, *values = self.lanes(lanes, y, *values)
+    chans = numpy.round(y)
+    for chan in numpy.unique(chans):
+      pick = chans == chan
+      name = self.IOConsts.IOCONSTNAME[int(chan)]
+      yield (name, pick, lanes[pick]) + tuple(v[pick] for v in values)
+
+  def ioReadF(self, lanes, y, ticks):
+    """
+    What each of lanes reads from channel y at ticks. Returns a float if
+    lanes is one instance, or an array.
+    """
+    out = numpy.empty(numpy.atleast_1d(numpy.arange(self.N)[lanes]).shape)
+    for name, pick, some, when in self.channels(lanes, y, ticks):
+      if 'R' not in self.IOConsts.IODICT[name]:
+        raise TypeError(f"{name} can't be read")
+
+      out[pick] = getattr(self, f"{name}R")(some, when)
+
+    return out[0].item() if isinstance(lanes, (int, numpy.integer)) else out
+
+  def ioWriteF(self, lanes, x, y, ticks):
+    """
+    Each of lanes writes x to channel y at ticks
+    """
+    for name, pick, some, value, when in self.channels(lanes, y, x, ticks):
+      if 'W' in self.IOConsts.IODICT[name]:
+        getattr(self, f"{name}W")(some, value, when)
+
+  def ioTrend(self, lanes, y):
+    """
+    Which way reads of channel y go with time for each of lanes, the same
+    as DE1Sim.ioTrend(), with 0 for None
+    """
+    lanes, y = self.lanes(lanes, y)
+    out = numpy.zeros(len(lanes), dtype=numpy.int8)
+    for name, pick, some in self.channels(lanes, y):
+      if name == "IO_NumSeconds":
+        out[pick] = 1
+      for value, target in self.FILTERED:
+        if name == f"IO_{value}":
+          out[pick] = self.trend(value, target, some)
+
+    return out
+
+  def IO_PressureW(self, lanes, x, ticks):
+    self.setTarget("FlowTarget", None, lanes, ticks)
+    self.setTarget("PressureTarget", self.clamp(x, 0.0, 12.0), lanes, ticks)
+
+  def IO_PressureR(self, lanes, ticks):
+    return self.valueAt("Pressure", "PressureTarget", lanes, ticks)
+
+  def IO_PressureT(self, lanes, ticks):
+    lanes, = self.lanes(lanes)
+    return numpy.where(self.HasTarget["PressureTarget"][lanes], self.PressureTarget[lanes], -1.0)
+
+  def IO_ShowerTempW(self, lanes, x, ticks):
+    self.setTarget("ShowerTempTarget", self.clamp(x, 0.20, 105.0), lanes, ticks)
+
+  def IO_ShowerTempR(self, lanes, ticks):
+    return self.valueAt("ShowerTemp", "ShowerTempTarget", lanes, ticks)
+
+  def IO_ShowerTempT(self, lanes, ticks):
+    lanes, = self.lanes(lanes)
+    return self.ShowerTempTarget[lanes]
+
+  def IO_GroupMetalTempW(self, lanes, x, ticks):
+    self.setTarget("GroupMetalTempTarget", self.clamp(x, 0.20, 105.0), lanes, ticks)
+
+  def IO_GroupMetalTempR(self, lanes, ticks):
+    return self.valueAt("GroupMetalTemp", "GroupMetalTempTarget", lanes, ticks)
+
+  def IO_GroupMetalTempT(self, lanes, ticks):
+    lanes, = self.lanes(lanes)
+    return self.GroupMetalTempTarget[lanes]
+
+  def IO_NumSecondsR(self, lanes, ticks):
+    lanes, ticks = self.lanes(lanes, ticks)
+    return ticks / 6000.0
+
+  def view(self, i, systime):
+    """
+    Instance i as a DE1Sim, for a CPU running on systime
+    """
+    return DE1SimView(self, i, systime)
+
+class _Ticks:
+  """
+  Enough of a SystemTime to make a DE1Sim with
+  """
+  def __init__(self, ticks):
+    self.Ticks = ticks
+
+class DE1SimView:
+  """
+  One instance of a DE1SimBatch, with the same IO methods as a DE1Sim, so
+  a CPU can use it as its Sim
+  """
+  def __init__(self, batch, i, systime):
+    self.Batch = batch
+    self.I = i
+    self.SysTime = systime
+
+  def snapshot(self):
+    return self.Batch.snapshot(self.I)
+
+  def restore(self, state):
+    self.Batch.restore(self.I, state)
+
+  def ioReadF(self, y):
+    return self.Batch.ioReadF(self.I, y, self.SysTime.Ticks)
+
+  def ioWriteF(self, x, y):
+    self.Batch.ioWriteF(self.I, x, y, self.SysTime.Ticks)
+
+  def ioRead(self, y):
+    return SEntry(self.ioReadF(y.float), self.Batch.IOConsts.IOCONSTNAME[int(round(y.float))][3:])
+
+  def ioWrite(self, x, y):
+    self.ioWriteF(x.float, y.float)
+
+  def ioTrend(self, y):
+    trend = self.Batch.ioTrend(self.I, y)[0]
+    return int(trend) if trend else None
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Stack depth report, for sizing the firmware's stacks.
+
+Runs each entry word of a program from reset, and prints the most items
+Stack, CallStack and ControlStack held while it ran, and the peak over all
+of them, against the size the VM gives each stack.
+
+Usage: python3 stackreport.py prog.debug [prog.debug ...] [--max N]
+"""
+import os, sys
+import vm, systemtime
+
+ENTRYWORDS = ("RunShot", "Idle", "Halt")
+STACKS = ("Stack", "CallStack", "ControlStack")
+
+def depths(filename, maxcycles, words=ENTRYWORDS):
+  """
+  Returns [(word, RunResult, {stack name : high water})] for each word
+  """
+  cpu = vm.FastCPU(systemtime.SystemTime())
+  cpu.loadDebug(filename)
+  results = []
+  for word in words:
+    cpu.reset()
+    cpu.SysTime.reset()
+    cpu.Sim.reset()
+    cpu.moveToWord(word)
+    result = cpu.run(max_cycles=maxcycles)
+    results.append((word, result, dict((name, getattr(cpu, name).HighWater) for name in STACKS)))
+
+  return results, dict((name, getattr(cpu, name).Size) for name in STACKS)
+
+def report(filename, maxcycles):
+  results, sizes = depths(filename, maxcycles)
+  lines = [os.path.basename(filename)]
+  lines.append("  %-12s %-10s %10s" % ("Word", "Result", "Cycles") + "".join(" %12s" % name for name in STACKS))
+  for word, result, high in results:
+    line = "  %-12s %-10s %10d" % (word, result.reason, result.cycles) + "".join(" %12d" % high[name] for name in STACKS)
+    if isinstance(result.error, vm.StackOverflow):
+      line += "  overflowed"
+    elif result.reason == vm.StopReason.CYCLES:
+      line += "  still running"
+    lines.append(line)
+
+  peaks = dict((name, max(high[name] for word, result, high in results)) for name in STACKS)
+  lines.append("  %-12s %-10s %10s" % ("Peak", "", "") + "".join(" %12d" % peaks[name] for name in STACKS))
+  lines.append("  %-12s %-10s %10s" % ("Size", "", "") + "".join(" %12d" % sizes[name] for name in STACKS))
+  return "\n".join(lines)
+
+def main(argv):
+  args = argv[1:]
+  maxcycles = 10000000
+  if '--max' in args:
+    i = args.index('--max')
+    maxcycles = int(args[i+1])
+    args = args[:i] + args[i+2:]
+
+  if not args:
+    print(__doc__)
+    return
+
+  print("\n\n".join(report(filename, maxcycles) for filename in args))
+
+if __name__ == "__main__":
+  main(sys.argv)
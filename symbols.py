@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+import weakref
+
+class Sym:
+  """
+  A node in a symbolic expression, as built by the CPU for the debugger.
+
+  Fmt is a format string, and Args are the sub-expressions that go into it.
+  Args are either Syms, or plain leaf values (strings, None). Nodes are
+  hash-consed by sym(), so identical expressions share one node, and a
+  node never copies its children's text. Text is only built by render().
+  """
+  __slots__ = ("Fmt", "Args", "Depth", "__weakref__")
+
+  def __init__(self, fmt, args, depth):
+    self.Fmt = fmt
+    self.Args = args
+    self.Depth = depth
+
+  def __str__(self):
+    return render(self)
+
+  def __repr__(self):
+    return f"Sym({render(self)!r})"
+
+# Expressions can grow to twice this deep. Then everything below their top
+# MaxDepth levels is replaced by ELIDED, so the most recent MaxDepth levels
+# are always there, and rebuilding them only happens every MaxDepth levels.
+# This keeps the size of every expression bounded, however many times a
+# loop feeds a value back into itself.
+MaxDepth = 48
+
+# Default cutoff for render()
+RenderDepth = 10
+
+ELIDED = "..."
+
+Interned = weakref.WeakValueDictionary()
+
+def depthOf(x):
+  if type(x) is Sym:
+    return x.Depth
+
+  return 0
+
+def sym(fmt, *args):
+  """
+  Return the interned node for fmt applied to args
+  """
+  depth = 0
+  for x in args:
+    if (type(x) is Sym) and (x.Depth > depth):
+      depth = x.Depth
+
+  if depth >= 2*MaxDepth:
+    done = {}
+    args = tuple(trim(x, MaxDepth - 1, done) for x in args)
+    depth = max(depthOf(x) for x in args)
+
+  depth += 1
+  key = (fmt,) + args
+  node = Interned.get(key)
+  if node is None:
+    node = Sym(fmt, args, depth)
+    Interned[key] = node
+
+  return node
+
+def trim(x, depth, done):
+  """
+  x with everything below depth levels replaced by ELIDED. Only the nodes
+  on paths deeper than that are rebuilt, and done remembers them, as they
+  can be shared.
+  """
+  if depthOf(x) <= depth:
+    return x
+
+  if depth <= 0:
+    return ELIDED
+
+  key = (id(x), depth)
+  if key not in done:
+    done[key] = sym(x.Fmt, *[trim(a, depth-1, done) for a in x.Args])
+
+  return done[key]
+
+def render(x, depth=None):
+  """
+  Render a symbol as text, showing at most depth levels of nested expression.
+  """
+  if depth is None:
+    depth = RenderDepth
+
+  if not isinstance(x, Sym):
+    return f"{x}"
+
+  if depth <= 0:
+    return ELIDED
+
+  return x.Fmt.format(*[render(a, depth-1) for a in x.Args])
@@ -5,6 +5,9 @@ class SystemTime:
   """
   System time, measured in 6000ths of a second.
   """
+  # Ticks between AC zero crossings, which WAIT waits for
+  ACPERIOD = 50
+
   def __init__(self):
     self.reset()
 
@@ -15,12 +18,12 @@ class SystemTime:
     return 6000
 
   def waitTilNextACZero(self):
-    togo = self.Ticks % 50
+    togo = self.Ticks % self.ACPERIOD
     if togo == 0:
       # Already on an AC Zero Cross
       return
 
-    togo = 50 - togo # Calculate ticks to go
+    togo = self.ACPERIOD - togo # Calculate ticks to go
     self.Ticks += togo
 
   def addTicks(self, ticks):
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+import systemtime
+import vm
+
+def test_read_after_systime_reset():
+  st = systemtime.SystemTime()
+  sim = vm.DE1Sim(st)
+  st.addTicks(5000)
+  sim.setTarget('PressureTarget', 9.0)
+  st.addTicks(5000)
+  sim.setTarget('PressureTarget', 2.0)
+
+  st.reset()
+  sim.reset()
+  assert sim.value('Pressure', 'PressureTarget') == 0.0
+
+  sim.setTarget('PressureTarget', 2.0)
+  reads = []
+  for ticks in (0, 1000, 50000, 100000):
+    st.Ticks = ticks
+    reads.append(sim.value('Pressure', 'PressureTarget'))
+  assert reads[0] == 0.0
+  assert reads == sorted(reads)
+  assert abs(reads[-1] - 2.0) < 1e-9
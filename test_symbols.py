@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+import symbols
+from symbols import sym, render
+
+def test_loop_keeps_recent_levels():
+  x = "x"
+  for i in range(symbols.MaxDepth * 3 + 5):
+    x = sym("({0}+1)", x)
+    assert x.Depth <= 2*symbols.MaxDepth
+
+  for depth in (symbols.RenderDepth, symbols.MaxDepth):
+    expected = symbols.ELIDED
+    for i in range(depth):
+      expected = f"({expected}+1)"
+    assert render(x, depth) == expected
+
+def test_trimmed_nodes_are_shared():
+  a = sym("({0}+1)", "x")
+  b = sym("({0}+1)", "x")
+  assert a is b
+  x = y = "x"
+  for i in range(symbols.MaxDepth * 2 + 2):
+    x = sym("({0}*2)", x)
+    y = sym("({0}*2)", y)
+  assert x is y
+
+def test_shared_subexpressions_stay_small():
+  x = "x"
+  for i in range(symbols.MaxDepth * 4):
+    x = sym("({0}+{1})", x, x)
+  assert x.Depth <= 2*symbols.MaxDepth
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+import bisect
+from vm import StopReason
+
+class TimeLine:
+  """
+  Lets the debugger go backwards in time. Snapshots of the CPU are taken
+  every Interval cycles as it runs forward. Going back to cycle n restores
+  the last one at or before n, and runs forward from there. The machine is
+  deterministic, so that gets exactly the same state as the first time, and
+  only the span since that checkpoint is run again.
+
+  At most MaxCheckpoints are kept. When there would be more, every other one
+  is dropped and Interval doubles, so they always cover the whole run.
+
+  All forward running has to go through step() and run(), so checkpoints
+  get taken. After the CPU is reset or moved, call restart().
+
+  Observer is passed to CPU.run() by run(), and called the same way after
+  each step(). It doesn't see opcodes that are run again to go back.
+  """
+  def __init__(self, cpu, interval=1000, maxcheckpoints=256):
+    self.CPU = cpu
+    self.Observer = None
+    self.BaseInterval = interval
+    self.MaxCheckpoints = max(2, maxcheckpoints)
+    self.restart()
+
+  def restart(self):
+    """
+    Forget the past, and start again from where the CPU is now
+    """
+    self.Interval = self.BaseInterval
+    self.Checkpoints = [self.CPU.snapshot()]
+    self.Cycles = [self.CPU.Cycles]
+
+  def record(self):
+    """
+    Take a checkpoint, if the CPU is at least Interval past the last one
+    """
+    cycles = self.CPU.Cycles
+    if cycles < self.Cycles[-1] + self.Interval:
+      return
+
+    self.Checkpoints.append(self.CPU.snapshot())
+    self.Cycles.append(cycles)
+    if len(self.Checkpoints) > self.MaxCheckpoints:
+      self.Checkpoints = self.Checkpoints[::2]
+      self.Cycles = self.Cycles[::2]
+      self.Interval *= 2
+
+  def step(self, ignorebp=None):
+    self.record()
+    cpu = self.CPU
+    pc = cpu.PC
+    cycles = cpu.Cycles
+    try:
+      cpu.step(ignorebp)
+    finally:
+      if (self.Observer is not None) and (cpu.Cycles != cycles):
+        self.Observer(pc, cpu.Decoded[pc])
+
+  def run(self, max_cycles=None, ignorebp=None):
+    """
+    Same as CPU.run(), but stops at each checkpoint that's due to take it
+    """
+    cpu = self.CPU
+    start = cpu.Cycles
+    while True:
+      self.record()
+      left = None if max_cycles is None else start + max_cycles - cpu.Cycles
+      due = self.Cycles[-1] + self.Interval - cpu.Cycles
+      if (left is None) or (due < left):
+        left = due
+
+      result = cpu.run(max_cycles=left, ignorebp=ignorebp, observer=self.Observer)
+      ignorebp = None
+      done = cpu.Cycles - start
+      if (result.reason != StopReason.CYCLES) or ((max_cycles is not None) and (done >= max_cycles)):
+        return result._replace(cycles=done)
+
+  def replay(self, cycle):
+    """
+    Run forward to cycle, without stopping at breakpoints or watchpoints.
+    Returns the cycles where they would have stopped it, including where
+    it starts.
+    """
+    cpu = self.CPU
+    stops = []
+    ignorebp = None
+    observer = self.Observer
+    self.Observer = None
+    try:
+      while cpu.Cycles < cycle:
+        result = self.run(cycle - cpu.Cycles, ignorebp)
+        ignorebp = None
+        if result.reason == StopReason.BREAKPOINT:
+          stops.append(cpu.Cycles)
+          ignorebp = cpu.PC
+        elif result.reason == StopReason.WATCHPOINT:
+          stops.append(cpu.Cycles)
+        elif result.reason != StopReason.CYCLES:
+          break # Stopped or failed, so it can't get any further
+
+    finally:
+      self.Observer = observer
+
+    return stops
+
+  def goto(self, cycle):
+    """
+    Put the CPU in the state it was in at cycle, or as near as it gets if
+    it stops before then
+    """
+    cpu = self.CPU
+    cycle = max(cycle, self.Cycles[0])
+    i = bisect.bisect_right(self.Cycles, cycle) - 1
+    if not (self.Cycles[i] <= cpu.Cycles <= cycle):
+      cpu.restore(self.Checkpoints[i])
+
+    self.replay(cycle)
+
+  def stepBack(self):
+    self.goto(self.CPU.Cycles - 1)
+
+  def reverseContinue(self):
+    """
+    Go back to the last place before now where a breakpoint or watchpoint
+    would have stopped the CPU. Returns False, at the start, if there isn't
+    one.
+    """
+    cpu = self.CPU
+    now = cpu.Cycles
+    i = bisect.bisect_left(self.Cycles, now) - 1
+    while i >= 0:
+      end = now if i+1 >= len(self.Cycles) else min(now, self.Cycles[i+1])
+      cpu.restore(self.Checkpoints[i])
+      stops = self.replay(end)
+      if stops:
+        self.goto(stops[-1])
+        return True
+
+      i -= 1
+
+    self.goto(self.Cycles[0])
+    return False
@@ -0,0 +1,718 @@
+#!/usr/bin/env python3
+"""
+Translates a compiled FROTH program (the .bin and .debug files written by
+FrothCompiler.writeResults) into a standalone Python module, with one
+function per word. IF/ELSE/ENDIF, FOR/ENDFOR and label loops become Python
+ifs and while loops. A word whose branches don't nest like that is turned
+into a loop over its basic blocks instead.
+
+The module has no other dependencies. Run a word with:
+
+  m = Flat9.Machine(sim)  # sim is a vm.DE1Sim, or anything with ioReadF(),
+  m.run('RunShot')        # ioWriteF() and a SysTime
+
+Cycles and SysTime ticks are counted the same as by the VM, so WAITs and
+timed IO work the same. Self-modifying code isn't supported, and writes to
+the program raise ProgramError. Return-stack manipulation isn't supported
+either: a word has to return to the address its caller pushed, or ; and EXIT
+raise ProgramError.
+"""
+from collections import namedtuple
+import array, os, re, struct, sys
+import vm, systemtime
+from blockcompiler import BlockCompiler, StackGen
+
+# A basic block of a word. lines are its code, and succ describes where it
+# goes next, as a tuple starting with one of 'fall', 'cond', 'jump', 'dyn',
+# 'for', 'endfor', 'ret' or 'stop'.
+TBlock = namedtuple("TBlock", "start, end, lines, succ")
+
+class Unstructured(Exception):
+  pass
+
+RUNTIME = '''
+import array, math, struct
+
+class Stopped(Exception):
+  pass
+
+class ProgramError(Exception):
+  pass
+
+class Stack:
+  def __init__(self, size):
+    self.Values = array.array('f', [0.0]*size)
+    self.Top = 0
+    self.Size = size
+
+  def pushF(self, x):
+    if self.Top >= self.Size:
+      raise ProgramError('Stack overflow')
+
+    self.Values[self.Top] = x
+    self.Top += 1
+
+  def popF(self):
+    if self.Top < 1:
+      raise ProgramError('Stack underflow')
+
+    self.Top -= 1
+    return self.Values[self.Top]
+
+  def readF(self, pos):
+    i = self.Top - 1 - pos
+    if i < 0:
+      raise ProgramError('Stack underflow')
+
+    return self.Values[i]
+
+class Machine:
+  """
+  The state of the VM, and the memory and IO that the words use.
+  """
+  def __init__(self, sim):
+    self.Sim = sim
+    self.SysTime = sim.SysTime
+    self.Stack = Stack(64)
+    self.CallStack = Stack(64)
+    self.R = array.array('f', [0.0])
+    self.ROM = array.array('B', ROM)
+    self.Scratch = array.array('B', [0]*256)
+    self.RXPacket = array.array('B', [0]*16)
+    self.TXPacket = array.array('B', [0]*16)
+    self.PC = 0
+    self.Cycles = 0
+    self.Stopped = False
+
+  def run(self, word):
+    """
+    Run word until it executes STOP. Returns the number of cycles it took.
+    """
+    start = self.Cycles
+    try:
+      WORDS[word](self)
+    except Stopped:
+      pass
+
+    return self.Cycles - start
+
+  def stop(self, pc):
+    self.PC = pc
+    self.Stopped = True
+    raise Stopped('STOP Executed')
+
+  def callAddr(self, addr, ret):
+    if addr not in ADDRS:
+      raise ProgramError(f'CALL to {addr}, which is not the start of a word')
+
+    ADDRS[addr](self, ret)
+
+  def stackError(self):
+    raise ProgramError('Stack under or overflow')
+
+  def badOpcode(self, addr):
+    raise ProgramError(f'Invalid opcode {self.ROM[addr]:02X} at {addr}')
+
+  def badJump(self, word, addr):
+    raise ProgramError(f'Jump to {addr}, which is not a block in {word}')
+
+  def badReturn(self, addr, to, ret):
+    raise ProgramError(f'Return at {addr} to {int(round(to))}, not to {ret} where it was called from')
+
+  def ioWrite(self, x, y):
+    self.Sim.ioWriteF(x, y)
+
+  def memStore(self, val, addr):
+    addri = int(round(addr))
+    if addri < 0x100:
+      self.Scratch[addri:addri+4] = array.array('B', struct.pack('<f', val))
+      return
+
+    if (addri >= 0x1010) and (addri < 0x1020):
+      addri = addri - 0x1010
+      self.TXPacket[addri:addri+4] = array.array('B', struct.pack('<f', val))
+      return
+
+    if (addri >= 0x2000) and (addri < 0x2400):
+      self.progStore(addri - 0x2000, struct.pack('<f', val))
+      return
+
+    raise ProgramError('Write to invalid address')
+
+  def memStoreB(self, val, addr):
+    addri = int(round(addr))
+    if addri < 0x100:
+      self.Scratch[addri] = int(round(val))
+      return
+
+    if (addri >= 0x1010) and (addri < 0x1020):
+      self.TXPacket[addri - 0x1010] = int(round(val))
+      return
+
+    if (addri >= 0x2000) and (addri < 0x2400):
+      self.progStore(addri - 0x2000, bytes([int(round(val))]))
+      return
+
+    raise ProgramError('Write to invalid address')
+
+  def progStore(self, addr, data):
+    if addr < PROGRAMSIZE:
+      raise ProgramError('Write to the program. Self-modifying code is not supported')
+
+    self.ROM[addr:addr+len(data)] = array.array('B', data)
+
+  def memFetchF(self, addr):
+    addri = int(round(addr))
+    if addri < 0x0100:
+      return struct.unpack('<f', self.Scratch[addri:addri+4])[0]
+
+    if (addri >= 0x1000) and (addri < 0x1010):
+      addri = addri - 0x1000
+      return struct.unpack('<f', self.RXPacket[addri:addri+4])[0]
+
+    if (addri >= 0x2000) and (addri < 0x2400):
+      addri = addri - 0x2000
+      return struct.unpack('<f', self.ROM[addri:addri+4])[0]
+
+    raise ProgramError('Read from invalid address')
+
+  def memFetchBF(self, addr):
+    addri = int(round(addr))
+    if addri < 0x0100:
+      return float(self.Scratch[addri])
+
+    if (addri >= 0x1000) and (addri < 0x1010):
+      return float(self.RXPacket[addri - 0x1000])
+
+    if (addri >= 0x2000) and (addri < 0x2400):
+      return float(self.ROM[addri - 0x2000])
+
+    raise ProgramError('Read from invalid address')
+'''
+
+PREAMBLE = '''  S = cpu.Stack
+  V = S.Values
+  C = cpu.CallStack
+  st = cpu.SysTime
+  R = cpu.R
+'''
+
+class Transpiler:
+  """
+  Builds the module source for one program.
+  """
+  def __init__(self, debugfile, binfile=None):
+    self.CPU = vm.FastCPU(systemtime.SystemTime())
+    self.CPU.loadDebug(debugfile)
+    self.D = self.CPU.D
+    self.Compiler = BlockCompiler(self.CPU)
+    self.Header = None
+    if binfile is not None:
+      self.loadBin(binfile)
+
+    self.Size = len(self.D.MemBytes)
+    self.Words = sorted((addr, name) for name, (num, addr) in self.D.Words.items())
+    self.FuncNames = {}
+    for addr, name in self.Words:
+      self.FuncNames[addr] = self.funcName(name)
+
+  def loadBin(self, binfile):
+    """
+    Use the program from the .bin, in case it's been patched since the
+    .debug was written.
+    """
+    with open(binfile, 'rb') as f:
+      data = f.read()
+
+    fmt = "<4sHHHHHHH"
+    self.Header = struct.unpack(fmt, data[:struct.calcsize(fmt)])
+    magic, version, maxvol, maxsec, romstart, shot, idle, halt = self.Header
+    if magic != b"EFVM":
+      raise ValueError(f"{binfile} is not an EFVM file")
+
+    rom = data[romstart:]
+    self.CPU.ROM[0:len(rom)] = array.array('B', rom)
+    self.CPU.decodeAll()
+
+  def funcName(self, word):
+    return "word_" + re.sub(r'[^A-Za-z0-9_]', lambda m: "_%02X" % ord(m.group()), word)
+
+  def instructions(self, start, end):
+    """
+    Returns [(addr, Instr, name)] for the word from start to end
+    """
+    result = []
+    addr = start
+    while addr < end:
+      ins = self.CPU.Decoded[addr]
+      if ins is None:
+        ins = self.CPU.decode(addr)
+
+      result.append((addr, ins, self.Compiler.opName(ins)))
+      addr = ins.nextpc
+
+    return result
+
+  def source(self, name):
+    lines = []
+    lines.append("#!/usr/bin/env python3")
+    lines.append(f"# Generated from {name} by transpile.py. Don't edit, regenerate it instead.")
+    lines.append(RUNTIME)
+    rom = self.CPU.ROM[:self.Size].tobytes()
+    lines.append(f"ROM = bytes.fromhex('{rom.hex()}') + bytes({vm.CPU.PROGRAMRAMSIZE - self.Size})")
+    lines.append(f"PROGRAMSIZE = {self.Size}")
+    if self.Header is not None:
+      magic, version, maxvol, maxsec, romstart, shot, idle, halt = self.Header
+      lines.append(f"MAXVOL = {maxvol}")
+      lines.append(f"MAXSEC = {maxsec}")
+
+    lines.append("")
+    for i, (addr, word) in enumerate(self.Words):
+      end = self.Words[i+1][0] if i+1 < len(self.Words) else self.Size
+      nextword = self.FuncNames.get(end)
+      lines.append(self.word(word, addr, end, nextword))
+
+    lines.append("WORDS = {")
+    for addr, word in self.Words:
+      lines.append(f"  {word!r} : {self.FuncNames[addr]},")
+    lines.append("}")
+    lines.append("")
+    lines.append("ADDRS = {")
+    for addr, word in self.Words:
+      lines.append(f"  {addr} : {self.FuncNames[addr]},")
+    lines.append("}")
+
+    return "\n".join(lines) + "\n"
+
+  def word(self, word, start, end, nextword):
+    """
+    Returns the source of the function for one word
+    """
+    w = WordTranspiler(self, word, start, end, nextword)
+    try:
+      body = w.structured()
+    except Unstructured:
+      body = w.dispatch()
+
+    lines = [f"def {self.FuncNames[start]}(cpu, ret=None):", f'  """ {word} """']
+    return "\n".join(lines) + "\n" + PREAMBLE + "\n".join("  " + l for l in body) + "\n"
+
+class WordTranspiler:
+  """
+  Turns one word into Python
+  """
+  def __init__(self, t, word, start, end, nextword):
+    self.T = t
+    self.Word = word
+    self.Start = start
+    self.End = end
+    self.NextWord = nextword
+    self.Edges = []    # (from, to) for every branch with a known target
+    self.Gotos = []    # Same, but only for BZ, BNZ and BRA
+    self.Entries = set()
+    self.ForEnds = {}  # Start of each FOR block, to its ENDFOR block
+    self.Blocks = {}
+    self.split()
+
+  def split(self):
+    ins = self.T.instructions(self.Start, self.End)
+    leaders = {self.Start}
+    prev = None
+    fors = []
+    for addr, i, name in ins:
+      if name in ('BZ', 'BNZ', 'BRA', 'FOR') and (prev is not None) and (prev[1].operand is not None):
+        target = int(round(prev[1].operand))
+        if self.Start <= target < self.End:
+          leaders.add(target)
+
+      if (name is None) or (name in BlockCompiler.ENDERS) or (name in BlockCompiler.UNCOMPILED):
+        leaders.add(i.nextpc)
+
+      prev = (addr, i, name)
+
+    starts = sorted(a for a in leaders if a < self.End)
+    for n, bstart in enumerate(starts):
+      bend = starts[n+1] if n+1 < len(starts) else self.End
+      block = self.block([x for x in ins if bstart <= x[0] < bend])
+      self.Blocks[bstart] = block
+      kind = block.succ[0]
+      if kind in ('cond', 'jump'):
+        self.Gotos.append((bstart, block.succ[-1]))
+        self.Edges.append((bstart, block.succ[-1]))
+        self.Entries.add(block.succ[-1])
+
+      if kind == 'for':
+        fors.append(bstart)
+        self.Entries.add(block.end)
+        if block.succ[3] is not None:
+          self.Edges.append((bstart, block.succ[3]))
+          self.Entries.add(block.succ[3])
+
+      if kind == 'endfor':
+        if fors:
+          f = fors.pop()
+          self.ForEnds[f] = bstart
+          self.Edges.append((bstart, self.Blocks[f].end))
+
+  def block(self, ins):
+    """
+    Generate the code for a basic block, made from [(addr, Instr, name)]
+    """
+    gen = StackGen()
+    n = len(ins)
+    addr, last, ender = ins[-1]
+    nextpc = last.nextpc
+    if (ender is not None) and (ender not in BlockCompiler.ENDERS) and (ender not in BlockCompiler.UNCOMPILED):
+      ender = None
+
+    body = ins if ender is None and ins[-1][2] is not None else ins[:-1]
+    for i, (a, x, name) in enumerate(body):
+      gen.op(name, x, i+1)
+
+    post = []
+    succ = ('fall',)
+    if ins[-1][2] is None:
+      post.append(f"cpu.badOpcode({addr})")
+      succ = ('stop',)
+
+    elif ender in ('BZ', 'BNZ'):
+      a = gen.pop()
+      x = gen.pop()
+      taken, fall = (f"{x} == 0", f"{x} != 0") if ender == 'BZ' else (f"{x} != 0", f"{x} == 0")
+      target = self.literal(a)
+      if target is None:
+        succ = ('dyn', f"int(round({a})) if {taken} else {nextpc}")
+      else:
+        succ = ('cond', taken, fall, target)
+
+    elif ender == 'BRA':
+      a = gen.pop()
+      target = self.literal(a)
+      succ = ('dyn', f"int(round({a}))") if target is None else ('jump', target)
+
+    elif ender == 'CALL':
+      a = gen.pop()
+      target = self.literal(a)
+      post.append(f"C.pushF({nextpc})")
+      if target in self.T.FuncNames:
+        post.append(f"{self.T.FuncNames[target]}(cpu, {nextpc})")
+      else:
+        post.append(f"cpu.callAddr({target if target is not None else f'int(round({a}))'}, {nextpc})")
+
+    elif ender in (';', 'EXIT'):
+      # Only returns to the caller are supported, as that's where the
+      # Python function goes back to
+      post.append("to = C.popF()")
+      post.append("if to != ret:")
+      post.append(f"  cpu.badReturn({addr}, to, ret)")
+      succ = ('ret',)
+
+    elif ender == 'FOR':
+      nb = gen.pop()
+      index = gen.pop()
+      step = gen.pop()
+      limit = gen.pop()
+      enter = f"(({step} > 0.0) and ({index} < {limit})) or (({step} < 0.0) and ({index} > {limit}))"
+      pushes = [f"C.pushF({limit})", f"C.pushF({step})", f"C.pushF({index})", f"C.pushF({nextpc})"]
+      succ = ('for', enter, pushes, self.literal(nb), nb)
+
+    elif ender == 'ENDFOR':
+      post.append("CV = C.Values")
+      post.append("ct = C.Top")
+      post.append("if ct < 4:")
+      post.append("  cpu.stackError()")
+      post.append("index = CV[ct-2] + CV[ct-3]")
+      post.append("leave = (index >= CV[ct-4]) if (CV[ct-3] > 0) else (index <= CV[ct-4])")
+      succ = ('endfor', nextpc)
+
+    elif ender == 'WAIT':
+      post.append("st.waitTilNextACZero()")
+
+    elif ender == 'STOP':
+      post.append(f"cpu.stop({nextpc})")
+      succ = ('stop',)
+
+    elif ender in ('!', '!B', 'IOW'):
+      y = gen.pop()
+      x = gen.pop()
+      call = {'!' : 'memStore', '!B' : 'memStoreB', 'IOW' : 'ioWrite'}[ender]
+      post.append(f"cpu.{call}({x}, {y})")
+
+    elif ender == 'TOR':
+      post.append(f"C.pushF({gen.pop()})")
+
+    elif ender == 'FROMR':
+      post.append("S.pushF(C.popF())")
+
+    elif ender == 'COPY':
+      post.append("S.pushF(S.readF(int(round(S.popF()))))")
+
+    elif ender is not None:
+      post.append(f"cpu.badOpcode({addr})")
+      succ = ('stop',)
+
+    if succ[0] == 'fall':
+      succ = ('fall', nextpc)
+
+    lines = []
+    commit = gen.commit()
+    checks = []
+    if gen.Need:
+      checks.append(f"(top < {gen.Need})")
+    if gen.Grow:
+      checks.append(f"(top > S.Size - {gen.Grow})")
+
+    if checks or gen.Lines or commit:
+      lines.append("top = S.Top")
+
+    if checks:
+      lines.append(f"if {' or '.join(checks)}:")
+      lines.append("  cpu.stackError()")
+
+    # IOR sets the ticks part way through the block
+    timed = any("ticks0" in l for l in gen.Lines)
+    if timed:
+      lines.append("ticks0 = st.Ticks")
+
+    lines.extend(gen.Lines)
+    lines.extend(commit)
+    lines.append(f"cpu.Cycles += {n}")
+    lines.append(f"st.Ticks = ticks0 + {n}" if timed else f"st.Ticks += {n}")
+    lines.extend(post)
+
+    return TBlock(ins[0][0], nextpc, lines, succ)
+
+  def literal(self, x):
+    try:
+      return int(round(float(x)))
+    except ValueError:
+      return None
+
+  def dead(self, lo, hi):
+    """
+    True if nothing can get to the code from lo to hi
+    """
+    return not any(lo <= e < hi for e in self.Entries)
+
+  def checkClosed(self, lo, hi):
+    """
+    Raise Unstructured if anything outside lo to hi branches into the middle of it
+    """
+    for src, dst in self.Edges:
+      if (lo < dst < hi) and not (lo <= src < hi):
+        raise Unstructured()
+
+  def control(self, target, loops):
+    if not loops or loops[-1] is None:
+      return None
+
+    head, exit = loops[-1]
+    if target == head:
+      return "continue"
+
+    if target == exit:
+      return "break"
+
+    return None
+
+  def structured(self):
+    out = []
+    if self.region(self.Start, self.End, self.End, [], out, 0):
+      self.fallOut(out, "")
+
+    return out
+
+  def fallOut(self, out, ind):
+    # Run on into the next word, the same as the VM would
+    if self.NextWord is None:
+      out.append(ind + f"cpu.badJump({self.Word!r}, {self.End})")
+    else:
+      out.append(ind + f"return {self.NextWord}(cpu, ret)")
+
+  def region(self, lo, hi, follow, loops, out, indent, openloop=None):
+    """
+    Emit the blocks from lo to hi, inside the given loops. follow is where
+    control goes when it runs off the end. Returns True if it can.
+    """
+    ind = "  "*indent
+    a = lo
+    while a < hi:
+      if a not in self.Blocks:
+        raise Unstructured()
+
+      b = self.Blocks[a]
+      if a != openloop:
+        backs = [self.Blocks[s].end for s, t in self.Gotos if (t == a) and (a <= s < hi)]
+        if backs:
+          exit = max(backs)
+          self.checkClosed(a, exit)
+          out.append(ind + "while True:")
+          if self.region(a, exit, exit, loops + [(a, exit)], out, indent+1, openloop=a):
+            out.append(ind + "  break")
+
+          a = exit
+          continue
+
+      out.extend(ind + l for l in b.lines)
+      kind = b.succ[0]
+      if kind == 'fall':
+        a = b.end
+        continue
+
+      if kind == 'cond':
+        taken, fall, t = b.succ[1:]
+        ctl = self.control(t, loops)
+        if ctl is not None:
+          out.append(ind + f"if {taken}:")
+          out.append(ind + f"  {ctl}")
+          a = b.end
+          continue
+
+        if not (b.end < t <= hi):
+          raise Unstructured()
+
+        # IF. See if it has an ELSE, ie. the code before t ends by
+        # branching past the code after it.
+        u = t
+        last = [x for x in self.Blocks.values() if (b.end <= x.start < t) and (x.end == t)]
+        if last and (last[0].succ[0] == 'jump') and (t < last[0].succ[1] <= hi) and (self.control(last[0].succ[1], loops) is None):
+          u = last[0].succ[1]
+
+        self.checkClosed(b.end, t)
+        out.append(ind + f"if {fall}:")
+        self.body(b.end, t, u, loops, out, indent+1)
+        if u != t:
+          self.checkClosed(t, u)
+          out.append(ind + "else:")
+          self.body(t, u, u, loops, out, indent+1)
+
+        a = u
+        continue
+
+      if kind == 'jump':
+        t = b.succ[1]
+        ctl = self.control(t, loops)
+        if ctl is not None:
+          out.append(ind + ctl)
+          falls = False
+        elif t == follow:
+          falls = True
+        elif (b.end < t <= hi) and self.dead(b.end, t):
+          a = t
+          continue
+        else:
+          raise Unstructured()
+
+        if not self.dead(b.end, hi):
+          raise Unstructured()
+
+        return falls
+
+      if kind == 'for':
+        enter, pushes, nb = b.succ[1:4]
+        e = self.ForEnds.get(a)
+        if (nb is None) or (e is None) or (self.Blocks[e].end != nb) or (nb > hi):
+          raise Unstructured()
+
+        self.checkClosed(b.end, nb)
+        out.append(ind + f"if {enter}:")
+        out.extend(ind + "  " + l for l in pushes)
+        out.append(ind + "  while True:")
+        self.region(b.end, nb, None, loops + [None], out, indent+2)
+        a = nb
+        continue
+
+      if kind == 'endfor':
+        if (not loops) or (loops[-1] is not None) or (b.end != hi):
+          raise Unstructured()
+
+        out.append(ind + "if leave:")
+        out.append(ind + "  C.Top = ct - 4")
+        out.append(ind + "  break")
+        out.append(ind + "CV[ct-2] = index")
+        return False
+
+      if kind == 'ret':
+        out.append(ind + "return")
+
+      if kind in ('ret', 'stop'):
+        if not self.dead(b.end, hi):
+          raise Unstructured()
+
+        return False
+
+      # A computed branch
+      raise Unstructured()
+
+    return True
+
+  def body(self, lo, hi, follow, loops, out, indent):
+    # The body of an if, which can't be empty
+    n = len(out)
+    self.region(lo, hi, follow, loops, out, indent)
+    if len(out) == n:
+      out.append("  "*indent + "pass")
+
+  def dispatch(self):
+    """
+    The word as a loop over its blocks, for when it can't be structured
+    """
+    out = [f"pc = {self.Start}", "while True:"]
+    first = True
+    for a in sorted(self.Blocks):
+      b = self.Blocks[a]
+      out.append(f"  {'if' if first else 'elif'} pc == {a}:")
+      first = False
+      out.extend("    " + l for l in b.lines)
+      kind = b.succ[0]
+      if kind == 'fall':
+        if b.end >= self.End:
+          self.fallOut(out, "    ")
+        else:
+          out.append(f"    pc = {b.end}")
+
+      elif kind == 'cond':
+        taken, fall, t = b.succ[1:]
+        out.append(f"    pc = {t} if {taken} else {b.end}")
+
+      elif kind == 'jump':
+        out.append(f"    pc = {b.succ[1]}")
+
+      elif kind == 'for':
+        enter, pushes, target, nb = b.succ[1:]
+        out.append(f"    if {enter}:")
+        out.extend("      " + l for l in pushes)
+        out.append(f"      pc = {b.end}")
+        out.append("    else:")
+        out.append(f"      pc = {target if target is not None else f'int(round({nb}))'}")
+
+      elif kind == 'dyn':
+        out.append(f"    pc = {b.succ[1]}")
+
+      elif kind == 'endfor':
+        out.append("    if leave:")
+        out.append("      C.Top = ct - 4")
+        out.append(f"      pc = {b.end}")
+        out.append("    else:")
+        out.append("      CV[ct-2] = index")
+        out.append("      pc = int(round(CV[ct-1]))")
+
+      elif kind == 'ret':
+        out.append("    return")
+
+    out.append("  else:")
+    out.append(f"    cpu.badJump({self.Word!r}, pc)")
+    return out
+
+def main(filename, outfile=None):
+  filebase = filename.rsplit(".", 1)[0]
+  binfile = filebase + ".bin"
+  t = Transpiler(filebase + ".debug", binfile if os.path.exists(binfile) else None)
+  if outfile is None:
+    outfile = filebase + ".py"
+
+  with open(outfile, 'w') as f:
+    f.write(t.source(os.path.basename(filebase)))
+
+if __name__ == '__main__':
+  main(*sys.argv[1:3])
@@ -1,12 +1,63 @@
 #!/usr/bin/env python3
-from collections import deque, namedtuple
+from collections import namedtuple
 from opcodes import OpCodes
 import array, math, struct, sys
 from disasm import DebugDis
-import ioconsts
+from symbols import sym
+from blockcompiler import BlockCompiler
+import ioconsts, instrument
+
+LOG = instrument.channel('vm')
+SIMLOG = instrument.channel('sim')
 
 SEntry = namedtuple("SEntry", "float, symbol")
 
+# A decoded instruction. Handlers of immediates are called with the decoded
+# operand and its symbol, everything else is called with no arguments.
+Instr = namedtuple("Instr", "op, handler, operand, length, nextpc, symbol")
+
+# An immediate and the opcode after it, run as one by the run loops. op is one
+# of CPU.FUSEDOPS, operand is the immediate, and first is the plain Instr of
+# the immediate, for when the pair has to be run one opcode at a time.
+FusedInstr = namedtuple("FusedInstr", "op, handler, operand, length, nextpc, symbol, first")
+
+# A breakpoint, patched into the decoded tables in place of the instruction at
+# its address. op is CPU.TRAPOP, and original is the Instr it replaced, which
+# is run instead when the breakpoint is being ignored.
+TrapInstr = namedtuple("TrapInstr", "op, handler, operand, length, nextpc, symbol, original")
+
+# What CPU.run() returns. reason is one of the StopReason values, cycles is
+# how many opcodes were run, and error is the exception, if reason is ERROR.
+# watch is the WatchHit, if reason is WATCHPOINT.
+RunResult = namedtuple("RunResult", "reason, cycles, error, watch", defaults=(None,))
+
+# The whole state of a machine, from CPU.snapshot(). The memories are bytes,
+# the stacks are from F32Stack.snapshot() and sim is from DE1Sim.snapshot().
+# memsymbols is a copy of MemAddrSymbols, or None for a FastCPU. It holds
+# nothing mutable, so it can be kept, copied and restored any number of times.
+Snapshot = namedtuple("Snapshot", "pc, cycles, stopped, ticks, stack, callstack, controlstack, "
+  "scratch, tx, rx, rom, sim, memsymbols")
+
+# The condition on a breakpoint. text is what it was set with, and test is
+# that compiled to a function of the CPU.
+BPCondition = namedtuple("BPCondition", "text, test")
+
+# A store that hit a watchpoint. addr is the address stored to, length is 4
+# for a float or 1 for a byte, and old and new are the values there before
+# and after.
+WatchHit = namedtuple("WatchHit", "addr, length, old, new")
+
+class StopReason:
+  """
+  Why CPU.run() returned
+  """
+  BREAKPOINT = 'breakpoint' # PC is at a breakpoint. The opcode there hasn't run.
+  STOPPED = 'stopped'       # STOP was executed, or the CPU was already stopped
+  CYCLES = 'cycles'         # max_cycles opcodes have been run
+  TICKS = 'ticks'           # SysTime has reached until_ticks
+  ERROR = 'error'           # An opcode raised an exception
+  WATCHPOINT = 'watchpoint' # A store hit a watchpoint. It's been done, and PC is after it.
+
 def toF32(x):
   #print(x)
   return struct.unpack('f', struct.pack('f', float(x)))[0]
@@ -19,21 +70,54 @@ def floatFromBytes(x):
 
 class F32Stack:
   """
-  A stack implemented on top of a deque, so we can
-  catch under and overflow cleanly.
+  A fixed size stack of float32 values, preallocated so pushes and pops don't
+  allocate, and so we can catch under and overflow cleanly. Top is the number
+  of items on the stack, and Values[Top-1] is the TOS. HighWater is the
+  most items it's held since it was reset.
+
+  A symbolic stack keeps a parallel list of symbols, and its items are SEntry
+  tuples. A non-symbolic stack only holds values, and is used through the *F
+  methods. read() and pop() still return an SEntry (with no symbol) from a
+  non-symbolic stack, so the debugger can show it.
   """
-  def __init__(self, size, callbackover, callbackunder):
-    self.Stack = deque()
+  def __init__(self, size, callbackover, callbackunder, symbolic=True):
+    self.Values = array.array('f', [0.0]*size)
+    self.Symbols = [None]*size if symbolic else None
+    self.Top = 0
+    self.HighWater = 0
     self.Size = size
     self.CallbackO = callbackover
     self.CallbackU = callbackunder
+    self.Symbolic = symbolic
     self.Changed = True
 
   def reset(self):
-    self.Stack = deque()
+    self.Top = 0
+    self.HighWater = 0
+    if self.Symbolic:
+      self.Symbols = [None]*self.Size
 
   def __len__(self):
-    return len(self.Stack)
+    return self.Top
+
+  def snapshot(self):
+    """
+    The items on the stack, as (values, symbols). values is their bytes,
+    and symbols is None if the stack isn't symbolic.
+    """
+    top = self.Top
+    return (self.Values[:top].tobytes(), tuple(self.Symbols[:top]) if self.Symbolic else None)
+
+  def restore(self, state):
+    values, symbols = state
+    top = len(values) // 4
+    self.Values[:top] = array.array('f', values)
+    if self.Symbolic:
+      self.Symbols[:top] = symbols if symbols is not None else [None]*top
+
+    self.Top = top
+    self.HighWater = max(self.HighWater, top)
+    self.Changed = True
 
   def read(self, pos):
     """
@@ -43,44 +127,121 @@ class F32Stack:
     1 = TOS-1
     2 = ToS-2, etc
     """
-    pos += 1
-    if len(self.Stack) < pos:
+    i = self.Top - 1 - pos
+    if i < 0:
       self.CallbackU()
 
-    return self.Stack[-pos]
+    if not self.Symbolic:
+      return SEntry(self.Values[i], None)
+
+    return SEntry(self.Values[i], self.Symbols[i])
 
   def peek(self, x):
     return self.read(0)
 
   def push(self, x):
-    if len(self.Stack) >= self.Size:
+    top = self.Top
+    if top >= self.Size:
       self.CallbackO()
 
-    x._replace(float=toF32(x.float))
-    self.Stack.append(x) # Append to right of stack
+    self.Values[top] = x.float # Rounds to float32
+    if self.Symbolic:
+      self.Symbols[top] = x.symbol
+
+    self.Top = top + 1
+    if top >= self.HighWater:
+      self.HighWater = top + 1
     self.Changed = True
 
   def pop(self):
-    if len(self.Stack) <= 0:
+    top = self.Top - 1
+    if top < 0:
       self.CallbackU()
 
+    self.Top = top
     self.Changed = True
-    return self.Stack.pop() # Pop off right of stack
+    if not self.Symbolic:
+      return SEntry(self.Values[top], None)
+
+    return SEntry(self.Values[top], self.Symbols[top])
 
   def pop2(self):
-    b = self.pop()
-    a = self.pop()
+    top = self.Top - 2
+    if top < 0:
+      self.CallbackU()
+
+    self.Top = top
     self.Changed = True
-    return (a, b)
+    if not self.Symbolic:
+      return (SEntry(self.Values[top], None), SEntry(self.Values[top+1], None))
+
+    return (SEntry(self.Values[top], self.Symbols[top]), SEntry(self.Values[top+1], self.Symbols[top+1]))
+
+  # Raw float access, for non-symbolic stacks
+
+  def readF(self, pos):
+    i = self.Top - 1 - pos
+    if i < 0:
+      self.CallbackU()
+
+    return self.Values[i]
+
+  def pushF(self, x):
+    top = self.Top
+    if top >= self.Size:
+      self.CallbackO()
+
+    self.Values[top] = x
+    self.Top = top + 1
+    if top >= self.HighWater:
+      self.HighWater = top + 1
+
+  def popF(self):
+    top = self.Top - 1
+    if top < 0:
+      self.CallbackU()
+
+    self.Top = top
+    return self.Values[top]
+
+  def pop2F(self):
+    top = self.Top - 2
+    if top < 0:
+      self.CallbackU()
+
+    self.Top = top
+    return (self.Values[top], self.Values[top+1])
 
 class DE1Sim:
   """
   Simulates the rest of the machine outside the CPU
+
+  Each of FILTERED moves towards its target by a fraction of the gap every
+  SysTime tick, so n ticks on it's at target + (x - target) * DECAY**n.
+  That's worked out when it's read, from the values at Updated, which only
+  change when a target does. So a read costs the same however long it's
+  been, and doesn't change anything.
   """
+  # Everything that changes as it runs
+  STATE = ("Pressure", "Flow", "GroupMetalTemp", "ShowerTemp",
+    "PressureTarget", "FlowTarget", "GroupMetalTempTarget", "ShowerTempTarget", "Updated")
+
+  # (value, target) pairs, and how much of the gap between them is left
+  # after a tick
+  FILTERED = (("Pressure", "PressureTarget"), ("Flow", "FlowTarget"),
+    ("ShowerTemp", "ShowerTempTarget"), ("GroupMetalTemp", "GroupMetalTempTarget"))
+  DECAY = 0.99
+
   def __init__(self, systime):
     self.SysTime = systime
     self.IOConsts = ioconsts.IOConsts()
+    self.reset()
 
+  def reset(self):
+    """
+    Back to how it starts, from now. Call it after SysTime.reset(), as the
+    values are worked out from the ticks since Updated.
+    """
     self.Pressure = 0.0
     self.Flow = 0.0
     self.GroupMetalTemp  = 0.0
@@ -90,18 +251,80 @@ class DE1Sim:
     self.FlowTarget = None
     self.GroupMetalTempTarget = 0.0
     self.ShowerTempTarget = 0.0
+    self.Updated = self.SysTime.Ticks
 
   def startShot(self):
     self.NumMS = 0
 
-  def step(self):
-    if self.PressureTarget != None:
-      self.Pressure = 0.99*self.Pressure + 0.01*self.PressureTarget
+  def snapshot(self):
+    return tuple(getattr(self, name) for name in self.STATE)
 
-    if self.FlowTarget != None:
-      self.Flow = 0.99*self.Flow + 0.01*self.FlowTarget
+  def restore(self, state):
+    for name, x in zip(self.STATE, state):
+      setattr(self, name, x)
 
-    self.ShowerTemp = 0.99*self.ShowerTemp + 0.01*self.ShowerTempTarget
+  def valueAt(self, name, target, ticks):
+    """
+    What name will be at ticks, if its target doesn't change before then
+    """
+    x = getattr(self, name)
+    goal = getattr(self, target)
+    if (goal is None) or (ticks <= self.Updated):
+      return x
+
+    return goal + (x - goal) * self.DECAY**(ticks - self.Updated)
+
+  def value(self, name, target):
+    return self.valueAt(name, target, self.SysTime.Ticks)
+
+  def trend(self, name, target):
+    """
+    1 if name is going up with time, -1 if it's going down, or None if it
+    isn't moving
+    """
+    x = getattr(self, name)
+    goal = getattr(self, target)
+    if (goal is None) or (goal == x):
+      return None
+
+    return 1 if goal > x else -1
+
+  def ioTrend(self, y):
+    """
+    Which way reads of channel y go as time goes on. 1 for up, -1 for down,
+    or None if they stay the same.
+    """
+    name = self.IOConsts.IOCONSTNAME.get(int(round(y)))
+    if name == "IO_NumSeconds":
+      return 1
+
+    for value, target in self.FILTERED:
+      if name == f"IO_{value}":
+        return self.trend(value, target)
+
+    return None
+
+  def update(self):
+    """
+    Bring all the values up to now, before a target changes
+    """
+    ticks = self.SysTime.Ticks
+    for name, target in self.FILTERED:
+      setattr(self, name, self.valueAt(name, target, ticks))
+
+    self.Updated = ticks
+
+  def setTarget(self, target, x):
+    if getattr(self, target) != x:
+      self.update()
+      setattr(self, target, x)
+
+  def step(self, ticks=1):
+    """
+    Move everything on by ticks, as if that many had gone by
+    """
+    for name, target in self.FILTERED:
+      setattr(self, name, self.valueAt(name, target, self.Updated + ticks))
 
   def clamp(self, x, minx, maxx):
     if x < minx:
@@ -114,29 +337,46 @@ class DE1Sim:
 
   def ioWrite(self, x, y):
     name = self.IOConsts.IOCONSTNAME[int(round(y.float))]
-    print(f"ioWrite of {x} to {name}")
+    if SIMLOG.Debug:
+      SIMLOG.debug(f"ioWrite of {x} to {name}")
     permissions = self.IOConsts.IODICT[name]
     if 'W' in permissions:
       getattr(self, f"{name}W")(x.float)
 
   def ioRead(self, y):
     name = self.IOConsts.IOCONSTNAME[int(round(y.float))]
-    print("ioRead from ", name, end='')
     permissions = self.IOConsts.IODICT[name]
     if 'R' in permissions:
       res = getattr(self, f"{name}R")()
-      print(": ", res)
+      if SIMLOG.Debug:
+        SIMLOG.debug(f"ioRead from {name}: {res}")
       return res
 
+  def ioWriteF(self, x, y):
+    """
+    ioWrite without symbols. Writes the float x to channel y.
+    """
+    name = self.IOConsts.IOCONSTNAME[int(round(y))]
+    if 'W' in self.IOConsts.IODICT[name]:
+      getattr(self, f"{name}W")(x)
+
+  def ioReadF(self, y):
+    """
+    ioRead without symbols. Returns the float read from channel y.
+    """
+    name = self.IOConsts.IOCONSTNAME[int(round(y))]
+    if 'R' in self.IOConsts.IODICT[name]:
+      return getattr(self, f"{name}R")().float
+
   def IO_PressureW(self, x):
     #("IO_Pressure"         , "RWT"),  # R = Readable. W = Writeable. T = Can read back
-    self.FlowTarget = None
+    self.setTarget("FlowTarget", None)
     x = self.clamp(x, 0.0, 12.0)
 
-    self.PressureTarget = x
+    self.setTarget("PressureTarget", x)
 
   def IO_PressureR(self):
-    return SEntry(self.Pressure, "Pressure")
+    return SEntry(self.value("Pressure", "PressureTarget"), "Pressure")
 
   def IO_PressureT(self):
     if self.PressureTarget == None:
@@ -146,20 +386,20 @@ class DE1Sim:
 
   def IO_ShowerTempW(self, x):
     x = self.clamp(x, 0.20, 105.0)
-    self.ShowerTempTarget = x
+    self.setTarget("ShowerTempTarget", x)
 
   def IO_ShowerTempR(self):
-    return SEntry(self.ShowerTemp, "ShowerTemp")
+    return SEntry(self.value("ShowerTemp", "ShowerTempTarget"), "ShowerTemp")
 
   def IO_ShowerTempT(self):
     return SEntry(self.ShowerTempTarget, "ShowerTempTarget")
 
   def IO_GroupMetalTempW(self, x):
     x = self.clamp(x, 0.20, 105.0)
-    self.GroupMetalTempTarget = x
+    self.setTarget("GroupMetalTempTarget", x)
 
   def IO_GroupMetalTempR(self):
-    return SEntry(self.GroupMetalTemp, "GroupMetalTemp")
+    return SEntry(self.value("GroupMetalTemp", "GroupMetalTempTarget"), "GroupMetalTemp")
 
   def IO_GroupMetalTempT(self):
     return SEntry(self.GroupMetalTempTarget, "GroupMetalTempTarget")
@@ -194,12 +434,23 @@ class VMCPUInvalidWrite(VMCPUMemAccessError):
 class VMCPUInvalidRead(VMCPUMemAccessError):
   pass # Read from invalid address
 
+class VMCPUInvalidOpcode(VMCPUException):
+  pass # Opcode byte with no handler
+
 class VMCPUInfo(VMCPUException):
   pass # Informational exceptions. Mostly used by debugger.
 
 class VMCPUBreakpoint(VMCPUInfo):
   pass
 
+class VMCPUWatchpoint(VMCPUBreakpoint):
+  """
+  A store has written to a watched address. Hit is the WatchHit.
+  """
+  def __init__(self, msg, hit):
+    super().__init__(msg)
+    self.Hit = hit
+
 class VMCPUStopped(VMCPUInfo):
   """
   Tell the caller that the CPU has executed the STOP opcode
@@ -227,7 +478,44 @@ class CPU:
     '@'  : 'FETCH',
     '!B' : 'STOREB',
     '@B' : 'FETCHB',
+    'RXP?' : 'RXP',
+  }
+  Symbolic = True
+  PROGRAMRAMSIZE = 0x400
+  MAXOPCODELEN = max(OpCodes.LONGEROPCODES.values())
+
+  # Most SysTime ticks one opcode can take. 1, plus up to 49 for a WAIT.
+  MAXTICKSPERCYCLE = 50
+
+  # Opcodes that get fused with an immediate in front of them, and the op
+  # numbers of the fused pairs. These are above 0xFF, so they can't be real.
+  FUSEDOPS = {
+    'CALL' : 0x100,
+    'BZ'   : 0x101,
+    'BNZ'  : 0x102,
+    'BRA'  : 0x103,
+    'IOR'  : 0x104,
+    'IOW'  : 0x105,
   }
+
+  # Op number of a breakpoint trap in the decoded tables
+  TRAPOP = 0x1FF
+
+  # Names that breakpoint conditions can use, and what they're read from
+  CONDITIONNAMES = {
+    'TOS'    : "cpu.Stack.read(0).float",
+    'NOS'    : "cpu.Stack.read(1).float",
+    'Depth'  : "cpu.Stack.Top",
+    'RDepth' : "cpu.CallStack.Top",
+    'PC'     : "cpu.PC",
+    'Cycles' : "cpu.Cycles",
+    'Ticks'  : "cpu.SysTime.Ticks",
+    'S'      : "lambda i: cpu.Stack.read(i).float",
+    'R'      : "lambda i: cpu.CallStack.read(i).float",
+    'F'      : "cpu.memFetchF",
+    'B'      : "cpu.memFetchBF",
+  }
+
   def __init__(self, systime):
     self.SysTime = systime
     self.Sim = DE1Sim(systime)
@@ -238,6 +526,9 @@ class CPU:
     self.Scratch = array.array('B', [0]*256)
     self.RXPacket = array.array('B', [0]*16)
     self.TXPacket = array.array('B', [0]*16)
+    self.BreakPoints = set()
+    self.BPConditions = {}
+    self.WatchPoints = set()
 
     self.reset()
 
@@ -258,14 +549,54 @@ class CPU:
     self.Stopped = 0
     self.Stack.reset()
     self.CallStack.reset()
-    self.BreakPoints = set()
+    self.ControlStack.reset()
+    self.clearBreakPoints()
+    self.clearWatchPoints()
     self.Stopped = False
-    self.MemWriteList = []
+    self.MemWriteList = set()
 
     # Store the symbols of addresses written to, in format (addrsymbol, datasymbol, type).
     # Type is float or byte, 'f' or 'b'
     self.MemAddrSymbols = {} 
 
+  def snapshot(self):
+    """
+    Returns a Snapshot of the CPU, its memories, SysTime and the Sim.
+    Breakpoints and watchpoints aren't part of it.
+    """
+    return Snapshot(self.PC, self.Cycles, self.Stopped, self.SysTime.Ticks,
+      self.Stack.snapshot(), self.CallStack.snapshot(), self.ControlStack.snapshot(),
+      self.Scratch.tobytes(), self.TXPacket.tobytes(), self.RXPacket.tobytes(), self.ROM.tobytes(),
+      self.Sim.snapshot(), dict(self.MemAddrSymbols) if self.Symbolic else None)
+
+  def restore(self, snap):
+    """
+    Put everything back the way it was when snap was taken
+    """
+    self.PC = snap.pc
+    self.Cycles = snap.cycles
+    self.Stopped = snap.stopped
+    self.SysTime.Ticks = snap.ticks
+    self.Stack.restore(snap.stack)
+    self.CallStack.restore(snap.callstack)
+    self.ControlStack.restore(snap.controlstack)
+    self.Scratch[:] = array.array('B', snap.scratch)
+    self.TXPacket[:] = array.array('B', snap.tx)
+    self.RXPacket[:] = array.array('B', snap.rx)
+    self.Sim.restore(snap.sim)
+    if snap.memsymbols is not None:
+      self.MemAddrSymbols = dict(snap.memsymbols)
+
+    # Only throw away what was decoded from the part of program RAM that's
+    # different
+    rom = self.ROM.tobytes()
+    if rom != snap.rom:
+      changed = [a for a in range(len(rom)) if rom[a] != snap.rom[a]]
+      self.ROM[:] = array.array('B', snap.rom)
+      self.invalidate(changed[0], changed[-1] + 1 - changed[0])
+
+    self.MemWriteList.add((0, len(self.Scratch)))
+
   def memClear(self):
     for i in range(256):
       self.Scratch[i] = 0
@@ -280,18 +611,303 @@ class CPU:
 
   def loadDebug(self, filename):
     self.D = DebugDis(filename)
+    # Program RAM is 1K. Pad the program out so all of it can be written.
     self.ROM = array.array('B', self.D.MemBytes)
+    if len(self.ROM) < self.PROGRAMRAMSIZE:
+      self.ROM.extend([0]*(self.PROGRAMRAMSIZE - len(self.ROM)))
+
+    self.Dispatch = self.buildDispatch()
+    self.decodeAll()
     self.reset()
 
+  def buildDispatch(self):
+    """
+    Build a 256 entry table of bound handlers, indexed by opcode byte.
+    All the immediate opcodes share IMM, and get their operand from the decoder.
+    """
+    table = [self.badOpcode]*256
+    for num, opname in self.Opcodes.OPCODENAME.items():
+      if opname == "IMM":
+        continue # Not a real opcode. 7 bit immediates have the high bit set.
+
+      if opname in self.Opcodes.LONGEROPCODES:
+        table[num] = self.IMM
+        continue
+
+      opname = self.OpMap.get(opname, opname)
+      table[num] = getattr(self, opname)
+
+    for opcode in range(0x80, 0x100):
+      table[opcode] = self.IMM
+
+    return table
+
+  def decodeAll(self):
+    """
+    Decode the whole program into self.Decoded, which holds one Instr per
+    address. Addresses that weren't reached by walking the program from 0
+    (eg. the middle of an immediate) get decoded if execution ever gets there.
+    """
+    self.Decoded = [None]*len(self.ROM)
+    addr = 0
+    while addr < len(self.D.MemBytes):
+      addr = self.decode(addr).nextpc
+
+    self.Fused = [None]*len(self.ROM)
+    addr = 0
+    while addr < len(self.D.MemBytes):
+      addr = self.fuse(addr).nextpc
+
+  def decode(self, addr):
+    opcode = self.ROM[addr]
+    handler = self.Dispatch[opcode]
+    operand = None
+    length = 1
+    if handler == self.IMM:
+      operand, length = self.decodeImmediate(addr)
+
+    ins = Instr(opcode, handler, operand, length, addr+length, self.immSymbol(addr, length, operand))
+    self.Decoded[addr] = ins
+    return ins
+
+  def fuse(self, addr):
+    """
+    Decode the instruction at addr for self.Fused, which is the same as
+    self.Decoded, except that an immediate followed by one of FUSEDOPS is
+    a single FusedInstr.
+    """
+    first = self.Decoded[addr]
+    if first is None:
+      first = self.decode(addr)
+
+    ins = first
+    if (first.operand is not None) and (first.nextpc < len(self.ROM)):
+      second = self.Decoded[first.nextpc]
+      if second is None:
+        second = self.decode(first.nextpc)
+
+      fusedop = self.FUSEDOPS.get(self.Opcodes.OPCODENAME.get(second.op))
+      if (fusedop is not None) and (second.operand is None):
+        ins = FusedInstr(fusedop, first.handler, first.operand, first.length + second.length,
+          second.nextpc, first.symbol, first)
+
+    self.Fused[addr] = ins
+    return ins
+
+  def decodeImmediate(self, addr):
+    """
+    Returns (value, length) of the immediate at addr
+    """
+    opcode = self.ROM[addr]
+    if opcode & 0x80:
+      # It's an immediate unsigned 7 bit literal
+      return (opcode & 0x7F, 1)
+
+    opname = self.Opcodes.OPCODENAME[opcode]
+    length = self.Opcodes.LONGEROPCODES[opname]
+    daddr = addr + 1
+    if opname == "PCIMMS":
+      return (self.ROM[daddr] + addr - 128, length)
+
+    if opname == "IMMS":
+      return (self.ROM[daddr] - 128, length)
+
+    if opname == "IMMU":
+      return (self.ROM[daddr] | (self.ROM[daddr+1] << 8), length)
+
+    # IMMF
+    return (struct.unpack("<f", self.ROM[daddr:daddr+4])[0], length)
+
+  def immSymbol(self, addr, length, val):
+    """
+    The symbol for an immediate is the source token that produced it. If the
+    program has been patched since it was compiled, use the value instead.
+    """
+    if val is None:
+      return None
+
+    if self.ROM[addr:addr+length] != self.D.MemBytes[addr:addr+length]:
+      return f"{val}"
+
+    symbol = self.D.AddrToSource[addr][5]
+    if val < 0:
+      symbol = ' '+symbol
+
+    return symbol
+
+  def invalidate(self, addr, length):
+    """
+    Program RAM from addr to addr+length has been written. Throw away any
+    decoded instruction that overlaps it, so it gets decoded again. Traps
+    for breakpoints in there are patched back in.
+    """
+    # A fused pair is at most one byte longer than the longest opcode
+    low = max(0, addr - self.MAXOPCODELEN)
+    for table in (self.Decoded, self.Fused):
+      for a in range(low, min(addr + length, len(table))):
+        ins = table[a]
+        if (ins is not None) and (a + ins.length > addr):
+          table[a] = None
+
+    for bp in self.BreakPoints:
+      if low <= bp < addr + length:
+        self.trap(bp)
+
+  def trap(self, addr):
+    """
+    Patch a trap for the breakpoint at addr into the decoded tables, so the
+    run loops only find out about breakpoints when they reach one.
+    """
+    ins = self.decode(addr)
+    trap = TrapInstr(self.TRAPOP, self.breakpointHit, None, ins.length, ins.nextpc, None, ins)
+    self.Decoded[addr] = trap
+    self.Fused[addr] = trap
+
+  def breakpointHit(self):
+    raise VMCPUBreakpoint('Breakpoint hit')
+
   def toggleBP(self, addr):
     if addr in self.BreakPoints:
       self.BreakPoints.remove(addr)
+      self.BPConditions.pop(addr, None)
     else:
       self.BreakPoints.add(addr)
 
+    # Drops anything decoded through addr, and patches the trap in if it's set
+    self.invalidate(addr, 1)
+
+  def setBP(self, addr, condition=None):
+    """
+    Set a breakpoint at addr, that only stops when condition is true. The
+    condition is a Python expression, which can use the CONDITIONNAMES, eg.
+    "TOS > 9.0", "F(4) == 0" (the scratch float at 4), or "Cycles > 100000".
+    It's compiled here, so a bad one raises SyntaxError now, and is only
+    evaluated when the breakpoint is reached. One that raises when it's
+    evaluated (eg. TOS with an empty stack) stops.
+    """
+    if condition:
+      self.BPConditions[addr] = BPCondition(condition, self.compileCondition(condition))
+    else:
+      self.BPConditions.pop(addr, None)
+
+    if addr not in self.BreakPoints:
+      self.BreakPoints.add(addr)
+      self.invalidate(addr, 1)
+
+  def compileCondition(self, condition):
+    code = compile(condition, "<breakpoint condition>", 'eval')
+    lines = ["def test(cpu):"]
+    for name, value in self.CONDITIONNAMES.items():
+      if name in code.co_names:
+        lines.append(f"  {name} = {value}")
+
+    lines.append(f"  return bool(({condition}\n))")
+    local = {}
+    exec(compile("\n".join(lines) + "\n", "<breakpoint condition>", 'exec'), {'math' : math}, local)
+    return local['test']
+
+  def breakHere(self, addr):
+    """
+    True if the breakpoint at addr should stop, ie. it has no condition,
+    or its condition is true now.
+    """
+    condition = self.BPConditions.get(addr)
+    if condition is None:
+      return True
+
+    try:
+      return condition.test(self)
+    except Exception:
+      return True
+
+  def clearBreakPoints(self):
+    bps = self.BreakPoints
+    self.BreakPoints = set()
+    self.BPConditions = {}
+    for addr in bps:
+      self.invalidate(addr, 1)
+
   def isBP(self, addr):
     return addr in self.BreakPoints
 
+  def toggleWP(self, addr, length=4):
+    """
+    Watch stores to addr to addr+length-1, which can be in scratch, the TX
+    packet or program RAM. A store to any of it stops the CPU with a
+    VMCPUWatchpoint, after the store has been done.
+
+    The watched bytes are kept as a bitmap in WatchMask. While there are
+    any, memStore and memStoreB are replaced on this CPU by versions that
+    check it, so stores cost nothing extra when nothing is watched.
+    """
+    if (addr, length) in self.WatchPoints:
+      self.WatchPoints.remove((addr, length))
+    else:
+      self.WatchPoints.add((addr, length))
+
+    self.WatchMask = 0
+    for a, n in self.WatchPoints:
+      for b in range(a, a + n):
+        bit = self.watchWindow(b)[2]
+        if bit is not None:
+          self.WatchMask |= 1 << bit
+
+    if self.WatchMask:
+      self.memStore = self.watchedMemStore
+      self.memStoreB = self.watchedMemStoreB
+    else:
+      self.__dict__.pop('memStore', None)
+      self.__dict__.pop('memStoreB', None)
+
+  def isWP(self, addr):
+    bit = self.watchWindow(addr)[2]
+    return (bit is not None) and bool(self.WatchMask & (1 << bit))
+
+  def clearWatchPoints(self):
+    for a, n in list(self.WatchPoints):
+      self.toggleWP(a, n)
+
+  def watchWindow(self, addr):
+    """
+    Returns (memory, offset, bit) for a store to addr. memory is the array
+    it goes into, and bit is its bit in WatchMask. bit is None if addr
+    can't be written.
+    """
+    if 0 <= addr < 0x100:
+      return (self.Scratch, addr, addr)
+
+    if 0x1010 <= addr < 0x1020:
+      return (self.TXPacket, addr - 0x1010, addr - 0x1010 + 0x100)
+
+    if 0x2000 <= addr < 0x2400:
+      return (self.ROM, addr - 0x2000, addr - 0x2000 + 0x110)
+
+    return (None, 0, None)
+
+  def watchedMemStore(self, val, addr):
+    self.watchedStore(type(self).memStore, 4, val, addr)
+
+  def watchedMemStoreB(self, val, addr):
+    self.watchedStore(type(self).memStoreB, 1, val, addr)
+
+  def watchedStore(self, store, length, val, addr):
+    addri = int(round(addr.float if self.Symbolic else addr))
+    memory, offset, bit = self.watchWindow(addri)
+    if (bit is None) or not ((self.WatchMask >> bit) & ((1 << length) - 1)):
+      store(self, val, addr)
+      return
+
+    old = memory[offset:offset+length].tobytes()
+    store(self, val, addr)
+    new = memory[offset:offset+length].tobytes()
+    if length == 4:
+      old, new = floatFromBytes(old), floatFromBytes(new)
+    else:
+      old, new = old[0], new[0]
+
+    hit = WatchHit(addri, length, old, new)
+    raise VMCPUWatchpoint(f'Watchpoint hit: {addri:#06x} changed from {old} to {new}', hit)
+
   def stackErrorUCB(self):
     raise StackUnderflow('Stack underflow')
 
@@ -308,7 +924,7 @@ class CPU:
     return self.MemWriteList
 
   def clearMemWriteList(self):
-    self.MemWriteList = []
+    self.MemWriteList = set()
 
   def getCurrentOpcodeName(self):
     opcode = self.ROM[self.PC]
@@ -330,73 +946,128 @@ class CPU:
     return addr + self.Opcodes.opcodeLen(addr)
 
   def runUntilBreakpoint(self):
-    while self.PC not in self.BreakPoints:
-      self.step()
+    result = self.run()
+    if result.reason == StopReason.STOPPED:
+      raise VMCPUStopped('STOP Executed')
+
+    if result.reason == StopReason.ERROR:
+      raise result.error
+
+  def run(self, max_cycles=None, until_ticks=None, ignorebp=None, observer=None):
+    """
+    Run until a breakpoint, STOP or an error, or until max_cycles opcodes
+    have been run, or until SysTime reaches until_ticks. ignorebp is the
+    same as for step(), and only applies to the first opcode.
+
+    If observer is given, it's called as observer(pc, ins) just before each
+    opcode runs, with ins the Instr at pc. Cycles and SysTime haven't been
+    counted for it yet.
+
+    Returns a RunResult. Nothing is raised, errors are returned in it.
+    """
+    start = self.Cycles
+    end = sys.maxsize if max_cycles is None else start + max_cycles
+    ticks = sys.maxsize if until_ticks is None else until_ticks
+    systime = self.SysTime
+    decoded = self.Decoded
+    symbolic = self.Symbolic
+    trapop = self.TRAPOP
+    error = None
+    watch = None
+
+    try:
+      if self.Stopped:
+        raise VMCPUStopped('CPU is stopped')
+
+      while True:
+        if self.Cycles >= end:
+          reason = StopReason.CYCLES
+          break
+
+        if systime.Ticks >= ticks:
+          reason = StopReason.TICKS
+          break
+
+        pc = self.PC
+        ins = decoded[pc]
+        if ins is None:
+          ins = self.decode(pc)
+
+        if ins.op == trapop:
+          if ((pc != ignorebp) or (self.Cycles != start)) and self.breakHere(pc):
+            reason = StopReason.BREAKPOINT
+            break
+
+          ins = ins.original
+
+        if observer is not None:
+          observer(pc, ins)
+
+        self.Cycles += 1
+        systime.Ticks += 1
+        self.PC = ins.nextpc
+        if ins.operand is None:
+          ins.handler()
+        else:
+          ins.handler(ins.operand, symbol = ins.symbol)
+
+        if symbolic and self.D.tagged(self.PC):
+          self.tagTOS()
+
+    except VMCPUWatchpoint as e:
+      reason = StopReason.WATCHPOINT
+      watch = e.Hit
+      if symbolic and self.D.tagged(self.PC):
+        self.tagTOS()
+    except VMCPUStopped:
+      reason = StopReason.STOPPED
+    except Exception as e:
+      reason = StopReason.ERROR
+      error = e
+
+    return RunResult(reason, self.Cycles - start, error, watch)
+
+  def tagTOS(self):
+    tos = self.Stack.pop()
+    tos = tos._replace(symbol=self.D.getTag(self.PC))
+    self.Stack.push(tos)
 
   def step(self, ignorebp=None):
     if self.Stopped:
       raise VMCPUStopped('CPU is stopped')
 
-    if self.PC in self.BreakPoints:
-      if self.PC != ignorebp:
+    ins = self.Decoded[self.PC]
+    if ins is None:
+      ins = self.decode(self.PC)
+
+    if ins.op == self.TRAPOP:
+      if (self.PC != ignorebp) and self.breakHere(self.PC):
         raise VMCPUBreakpoint('Breakpoint hit')
 
+      ins = ins.original
+
     self.Cycles += 1
     self.SysTime.addTicks(1)  # 1 tick per opcode, for now
-    opsize = 1
-    opcode = self.ROM[self.PC]
-    if self.Opcodes.isImmediate(opcode):
-      symbol = self.D.getInfo(self.PC).tval
-      if (opcode & 0x80):
-        # It's an immediate unsigned 7 bit literal
-        self.IMM(opcode & 0x7F, symbol = symbol)
+    self.PC = ins.nextpc
+    try:
+      if ins.operand is None:
+        if LOG.Trace and (ins.op in self.Opcodes.OPCODENAME):
+          LOG.trace(self.Opcodes.OPCODENAME[ins.op])
+        ins.handler()
       else:
-        opname = self.Opcodes.OPCODENAME[opcode]
-        if opname in self.Opcodes.LONGEROPCODES:
-          # One of the immediate instructions
-          opsize = self.Opcodes.LONGEROPCODES[opname]
-          daddr = self.PC+1
-          if opname == 'PCIMMS':
-            val = self.ROM[daddr] + self.PC - 128
-            if val < 0:
-              symbol = ' '+symbol
-            self.IMM(val, symbol = symbol)
-
-          if opname == "IMMS":
-            val = self.ROM[daddr] - 128
-            if val < 0:
-              symbol = ' '+symbol
-            self.IMM(val, symbol = symbol)
-
-          if opname == "IMMU":
-            val = self.ROM[daddr] | (self.ROM[daddr+1] << 8)
-            self.IMM(val, symbol = symbol)
-
-          if opname == "IMMF":
-            val = struct.unpack("<f", self.ROM[daddr:daddr+4])[0]
-            if val < 0:
-              symbol = ' '+symbol
-            self.IMM(val, symbol = symbol)
-
-      self.PC += opsize
-
-    else:
-      # Not immediate
-      self.PC += 1
-
-      opname = self.Opcodes.OPCODENAME[opcode]
-      print(opname)
-      if opname in self.OpMap:
-        # Remap to a method name
-        opname = self.OpMap[opname]
+        ins.handler(ins.operand, symbol = ins.symbol)
 
-      getattr(self, opname)() # Call the method with this name
+    except VMCPUWatchpoint:
+      # The store has been done, so finish the step before stopping
+      if self.Symbolic and self.D.tagged(self.PC):
+        self.tagTOS()
+      raise
 
-    if self.D.tagged(self.PC):
-      tos = self.Stack.pop()
-      tos = tos._replace(symbol=self.D.getTag(self.PC))
-      self.Stack.push(tos)
+    if self.Symbolic and self.D.tagged(self.PC):
+      self.tagTOS()
 
+  def badOpcode(self):
+    raise VMCPUInvalidOpcode('Invalid opcode %02X at %d' % (self.ROM[self.PC-1], self.PC-1))
 
   def ioWrite(self, x, y):
     self.Sim.ioWrite(x, y)
@@ -410,22 +1081,24 @@ class CPU:
       # Write to scratch
       self.MemAddrSymbols[addri] = (addr.symbol, val.symbol, 'f')
       self.Scratch[addri:addri+4] = array.array('B', toFBytes(val.float))
-      self.MemWriteList.append((addri, 4))
+      self.MemWriteList.add((addri, 4))
       return
 
     if (addri >= 0x1010) and (addri < 0x1020):
       # Write to packet TX
       self.MemAddrSymbols[addri] = (addr.symbol, val.symbol, 'f')
-      self.TXPacket[addri:addri+4] = toFBytes(val.float)
-      self.MemWriteList.append((addri, 4))
+      offset = addri - 0x1010
+      self.TXPacket[offset:offset+4] = array.array('B', toFBytes(val.float))
+      self.MemWriteList.add((addri, 4))
       return
 
     if (addri >= 0x2000) and (addri < 0x2400):
       # Write directly into program RAM
       self.MemAddrSymbols[addri] = (addr.symbol, val.symbol, 'f')
       addri = addri - 0x2000
-      self.ROM[addri:addri+4] = toFBytes(val.float)
-      self.MemWriteList.append((addri, 4))
+      self.ROM[addri:addri+4] = array.array('B', toFBytes(val.float))
+      self.invalidate(addri, 4)
+      self.MemWriteList.add((addri, 4))
       return
 
     raise VMCPUInvalidWrite('Write to invalid address')
@@ -436,14 +1109,14 @@ class CPU:
       # Write to scratch
       self.MemAddrSymbols[addri] = (addr.symbol, val.symbol, 'b')
       self.Scratch[addri] = int(round(val.float))
-      self.MemWriteList.append((addri, 1))
+      self.MemWriteList.add((addri, 1))
       return
 
     if (addri >= 0x1010) and (addri < 0x1020):
       # Write to packet TX
       self.MemAddrSymbols[addri] = (addr.symbol, val.symbol, 'b')
-      self.TXPacket[addri] = int(round(val.float))
-      self.MemWriteList.append((addri, 1))
+      self.TXPacket[addri - 0x1010] = int(round(val.float))
+      self.MemWriteList.add((addri, 1))
       return
 
     if (addri >= 0x2000) and (addri < 0x2400):
@@ -451,7 +1124,8 @@ class CPU:
       self.MemAddrSymbols[addri] = (addr.symbol, val.symbol, 'b')
       addri = addri - 0x2000
       self.ROM[addri] = int(round(val.float))
-      self.MemWriteList.append((addri, 1))
+      self.invalidate(addri, 1)
+      self.MemWriteList.add((addri, 1))
       return
 
     raise VMCPUInvalidWrite('Write to invalid address')
@@ -470,10 +1144,38 @@ class CPU:
     if s1 == None:
       s1 = ''
     if s2 == None:
-      s1 = ' '
-      s2 = ''
+      return ' '
+
+    return sym(s1 + "{0}", s2)
 
-    return s1 + s2
+  # Raw reads, with no symbols
+  def memFetchF(self, addr):
+    addri = int(round(addr))
+    if addri < 0x0100:
+      return floatFromBytes(self.Scratch[addri:addri+4])
+
+    if (addri >= 0x1000) and (addri < 0x1010):
+      addri = addri - 0x1000
+      return floatFromBytes(self.RXPacket[addri:addri+4])
+
+    if (addri >= 0x2000) and (addri < 0x2400):
+      addri = addri - 0x2000
+      return floatFromBytes(self.ROM[addri:addri+4])
+
+    raise VMCPUInvalidRead('Read from invalid address')
+
+  def memFetchBF(self, addr):
+    addri = int(round(addr))
+    if addri < 0x0100:
+      return float(self.Scratch[addri])
+
+    if (addri >= 0x1000) and (addri < 0x1010):
+      return float(self.RXPacket[addri - 0x1000])
+
+    if (addri >= 0x2000) and (addri < 0x2400):
+      return float(self.ROM[addri - 0x2000])
+
+    raise VMCPUInvalidRead('Read from invalid address')
 
   def memFetch(self, addr, suggestedvals=''):
     addri = int(round(addr.float))
@@ -486,7 +1188,7 @@ class CPU:
     if (addri >= 0x1000) and (addri < 0x1010):
       # Read from packet RX
       addrs, vals, vtype = self.getMemAddrSymInfo(addri, suggestedvals=self.concat('@',addr.symbol))
-      f = floatFromBytes(self.RXPacket[addri:addri+4])
+      f = floatFromBytes(self.RXPacket[addri-0x1000:addri-0x1000+4])
       return SEntry(f, vals)
 
     if (addri >= 0x2000) and (addri < 0x2400):
@@ -509,7 +1211,7 @@ class CPU:
     if (addri >= 0x1000) and (addri < 0x1010):
       # Read from packet RX
       addrs, vals, vtype = self.getMemAddrSymInfo(addri, suggestedvals=self.concat('@',addr.symbol))
-      f = float(self.RXPacket[addri])
+      f = float(self.RXPacket[addri-0x1000])
       return SEntry(f, vals)
 
     if (addri >= 0x2000) and (addri < 0x2400):
@@ -548,7 +1250,7 @@ class CPU:
   def COPY(self):
     # COPY  x -- Stack[-x] (0 is the item before x, etc)
     x = self.Stack.pop()
-    self.Stack.push(self.Stack.read(x))
+    self.Stack.push(self.Stack.read(int(round(x.float))))
 
   def ROT(self):
     # ROT    |a b c -- b c a   | Rotate top 3 values of stack around
@@ -571,99 +1273,99 @@ class CPU:
   def PLUS(self):
     # +     x y -- (x+y)
     x, y = self.Stack.pop2()
-    res = SEntry(x.float+y.float, f"{x.symbol}+{y.symbol}")
+    res = SEntry(x.float+y.float, sym("{0}+{1}", x.symbol, y.symbol))
     self.Stack.push(res)
 
   def MINUS(self):
     # -     x y -- (x-y)
     x, y = self.Stack.pop2()
-    res = SEntry(x.float-y.float, f"{x.symbol}-{y.symbol}")
+    res = SEntry(x.float-y.float, sym("{0}-{1}", x.symbol, y.symbol))
     self.Stack.push(res)
 
   def TIMES(self):
     # *     x y -- (x*y)
     x, y = self.Stack.pop2()
-    res = SEntry(x.float*y.float, f"({x.symbol})*({y.symbol})")
+    res = SEntry(x.float*y.float, sym("({0})*({1})", x.symbol, y.symbol))
     self.Stack.push(res)    
 
   def DIV(self):
     # /     x y -- (x/y)
     x, y = self.Stack.pop2()
-    res = SEntry(x.float/y.float, f"({x.symbol})/({y.symbol})")
+    res = SEntry(x.float/y.float, sym("({0})/({1})", x.symbol, y.symbol))
     self.Stack.push(res)
 
   def POW(self):
     # POW   x y -- pow(x,y)
     x, y = self.Stack.pop2()
-    res = SEntry(math.pow(x.float, y.float), f"POW({x.symbol}, {y.symbol})")
+    res = SEntry(math.pow(x.float, y.float), sym("POW({0}, {1})", x.symbol, y.symbol))
     self.Stack.push(res)
 
   def NEG(self):
     # NEG   x -- (-x)        : Invert sign of TOS.
     x = self.Stack.pop()
-    res = SEntry(-x.float, f"-{x.symbol}")
+    res = SEntry(-x.float, sym("-{0}", x.symbol))
     self.Stack.push(res)
 
   def REC(self):
     # REC   x -- (1/x)       : Reciprocal of TOS.
     x = self.Stack.pop()
-    res = SEntry(1.0/x.float, f"(1.0/{x.symbol})")
+    res = SEntry(1.0/x.float, sym("(1.0/{0})", x.symbol))
     self.Stack.push(res)
 
   def TZ(self):
     # TZ    x -- 1|0         : Test Zero.  TOS = 1 if x  = 0, else 0
     x = self.Stack.pop()
     if x.float == 0:
-      self.Stack.push(SEntry(1.0, f'({x.symbol}==0)'))
+      self.Stack.push(SEntry(1.0, sym("({0}==0)", x.symbol)))
     else:
-      self.Stack.push(SEntry(0.0, f'({x.symbol}==0)'))
+      self.Stack.push(SEntry(0.0, sym("({0}==0)", x.symbol)))
 
   def TGT(self):
     # TGT   x y -- (x>y)     : Test Greater Than.  TOS = 1 if x  > y, else 0
     x, y = self.Stack.pop2()
     if x.float > y.float:
-      self.Stack.push(SEntry(1.0, f"({x.symbol}>{y.symbol})"))
+      self.Stack.push(SEntry(1.0, sym("({0}>{1})", x.symbol, y.symbol)))
     else:
-      self.Stack.push(SEntry(0.0, f"({x.symbol}>{y.symbol})"))
+      self.Stack.push(SEntry(0.0, sym("({0}>{1})", x.symbol, y.symbol)))
 
   def TLT(self):
     # TLT   x y -- (x<y)     : Test Less Than. TOS = 1 if x  < y, else 0
     x, y = self.Stack.pop2()
     if x.float < y.float:
-      self.Stack.push(SEntry(1.0, f"({x.symbol}<{y.symbol})"))
+      self.Stack.push(SEntry(1.0, sym("({0}<{1})", x.symbol, y.symbol)))
     else:
-      self.Stack.push(SEntry(0.0, f"({x.symbol}<{y.symbol})"))
+      self.Stack.push(SEntry(0.0, sym("({0}<{1})", x.symbol, y.symbol)))
 
   def TGE(self):
     # TGE   x y -- (x>=y)    : Test Greater or Equal.  TOS = 1 if x >= y, else 0
     x, y = self.Stack.pop2()
     if x.float >= y.float:
-      self.Stack.push(SEntry(1.0, f"({x.symbol}>={y.symbol})"))
+      self.Stack.push(SEntry(1.0, sym("({0}>={1})", x.symbol, y.symbol)))
     else:
-      self.Stack.push(SEntry(0.0, f"({x.symbol}>={y.symbol})"))
+      self.Stack.push(SEntry(0.0, sym("({0}>={1})", x.symbol, y.symbol)))
 
   def TLE(self):
     # TLE   x y -- (x<=y)    : Test Less or Equal. TOS = 1 if x <= y, else 0
     x, y = self.Stack.pop2()
     if x.float <= y.float:
-      self.Stack.push(SEntry(1.0, f"({x.symbol}<={y.symbol})"))
+      self.Stack.push(SEntry(1.0, sym("({0}<={1})", x.symbol, y.symbol)))
     else:
-      self.Stack.push(SEntry(0.0, f"({x.symbol}<={y.symbol})"))
+      self.Stack.push(SEntry(0.0, sym("({0}<={1})", x.symbol, y.symbol)))
 
   def TIN(self):
     # TIN   x -- 1|0         : Test Invalid Number. TOS = 1 if x is NaN or Inf
     x = self.Stack.pop()
     if math.isnan(x.float) or math.isinf(x.float):
-      self.Stack.push(SEntry(1.0, f"TIN({x.symbol})"))
+      self.Stack.push(SEntry(1.0, sym("TIN({0})", x.symbol)))
     else:
-      self.Stack.push(SEntry(0.0, f"TIN({x.symbol})"))
+      self.Stack.push(SEntry(0.0, sym("TIN({0})", x.symbol)))
 
   def OR(self):
     # OR    x y -- (x OR y) : Bitwise integer OR
     x, y = self.Stack.pop2()
     xi = int(round(x.float))
     yi = int(round(y.float))
-    res = SEntry(xi|yi, f"({x.symbol}|{y.symbol})")
+    res = SEntry(xi|yi, sym("({0}|{1})", x.symbol, y.symbol))
     self.Stack.push(res) # Push converts everything to a float32
 
   def AND(self):
@@ -671,7 +1373,7 @@ class CPU:
     x, y = self.Stack.pop2()
     xi = int(round(x.float))
     yi = int(round(y.float))
-    res = SEntry(xi & yi, f"({x.symbol}&{y.symbol})")
+    res = SEntry(xi & yi, sym("({0}&{1})", x.symbol, y.symbol))
     self.Stack.push(res) # Push converts everything to a float32
 
   def XOR(self):
@@ -679,15 +1381,15 @@ class CPU:
     x, y = self.Stack.pop2()
     xi = int(round(x.float))
     yi = int(round(y.float))
-    res = SEntry(xi ^ yi, f"({x.symbol}^{y.symbol})")
+    res = SEntry(xi ^ yi, sym("({0}^{1})", x.symbol, y.symbol))
     self.Stack.push(res) # Push converts everything to a float32
 
   def BINV(self):
     # BINV  x   -- (~x)      : Bitwise Inverse. Treats x as an integer
     x = self.Stack.pop()
     xi = int(round(x.float))
-    res = SEntry(~xi, f"~{x.symbol}")
-    self.Stack.push(~x)
+    res = SEntry(~xi, sym("~{0}", x.symbol))
+    self.Stack.push(res)
 
   def BNZ(self):
     # BNZ   x a --           : Branch to a if x != 0. 
@@ -755,7 +1457,8 @@ class CPU:
   def IMM(self, imm, symbol=''):
     if symbol=='':
       symbol = f"{imm.float}"
-    print(imm)
+    if LOG.Trace:
+      LOG.trace(f"{imm}")
     # IMM    # -- x          : Push an immediate value from (0..127) onto the stack.
     # IMMS   # -- x          : Push an immediate value from (-127 to 128) onto the stack.
     # IMMF   # -- x          : Push an immediate single-precision float (32-bit) onto the stack.
@@ -826,7 +1529,6 @@ class CPU:
     index, nextblockaddr = self.Stack.pop2()
     limit, step = self.Stack.pop2()
     nbai = int(round(nextblockaddr.float))
-    nextblockaddr._replace(float=nbai)
 
     #print(limit, step, index, nextblockaddr)
 
@@ -851,7 +1553,7 @@ class CPU:
       self.CallStack.push(SEntry(self.PC, f"{self.PC}"))
     else:
       # Just branch to end of loop
-      self.PC = nextblockaddr.float
+      self.PC = nbai
 
   def ENDFOR(self):
     """
@@ -867,7 +1569,6 @@ class CPU:
     index, startaddr = self.CallStack.pop2()
     limit, step = self.CallStack.pop2()
     sai = int(round(startaddr.float))
-    startaddr._replace(float=sai)
 
     i = index.float + step.float
     index = SEntry(i, f"{i}")
@@ -887,7 +1588,7 @@ class CPU:
       self.CallStack.push(step)
       self.CallStack.push(index)
       self.CallStack.push(startaddr)
-      self.PC = startaddr.float
+      self.PC = sai
 
   def INDEX(self):
     """
@@ -898,4 +1599,713 @@ class CPU:
     posi = int(round(loop.float))
     posi = posi*4 + 1
     index = self.CallStack.read(posi)
-    self.Stack.push(index)
\ No newline at end of file
+    self.Stack.push(index)
+
+
+class FastCPU(CPU):
+  """
+  A CPU for headless runs. The stacks hold raw floats, and no symbols or
+  MemAddrSymbols are kept, so there is nothing for the debugger to show
+  except values. Results are the same as CPU.
+  """
+  Symbolic = False
+
+  def __init__(self, systime):
+    super().__init__(systime)
+    self.CallStack = F32Stack(64, self.stackErrorOCB, self.stackErrorUCB, symbolic=False)
+    self.Stack = F32Stack(64, self.stackErrorOCB, self.stackErrorUCB, symbolic=False)
+    self.ControlStack = F32Stack(64, self.stackErrorOCB, self.stackErrorUCB, symbolic=False)
+
+  def run(self, max_cycles=None, until_ticks=None, ignorebp=None, observer=None):
+    """
+    Same as CPU.run(), but runs with runCompiled(). For a tick budget, it
+    runs in chunks that can't go past until_ticks, as every opcode adds at
+    least one tick, and at most MAXTICKSPERCYCLE.
+
+    An observer has to see every opcode, so then it's the same as CPU.run().
+    """
+    if observer is not None:
+      return CPU.run(self, max_cycles, until_ticks, ignorebp, observer)
+
+    start = self.Cycles
+    end = sys.maxsize if max_cycles is None else start + max_cycles
+    systime = self.SysTime
+    error = None
+    watch = None
+
+    try:
+      while True:
+        left = end - self.Cycles
+        if left <= 0:
+          reason = StopReason.CYCLES
+          break
+
+        if until_ticks is not None:
+          togo = until_ticks - systime.Ticks
+          if togo <= 0:
+            reason = StopReason.TICKS
+            break
+
+          left = min(left, max(1, togo // self.MAXTICKSPERCYCLE))
+
+        self.runCompiled(left, ignorebp)
+        ignorebp = None
+
+    except VMCPUWatchpoint as e:
+      reason = StopReason.WATCHPOINT
+      watch = e.Hit
+    except VMCPUBreakpoint:
+      reason = StopReason.BREAKPOINT
+    except VMCPUStopped:
+      reason = StopReason.STOPPED
+    except Exception as e:
+      reason = StopReason.ERROR
+      error = e
+
+    return RunResult(reason, self.Cycles - start, error, watch)
+
+  def decodeAll(self):
+    super().decodeAll()
+    self.BlockCompiler = BlockCompiler(self)
+    self.Blocks = [None]*len(self.ROM)
+
+  def invalidate(self, addr, length):
+    super().invalidate(addr, length)
+    # A block is at most MAXLENGTH opcodes of at most MAXOPCODELEN bytes each
+    low = max(0, addr - BlockCompiler.MAXLENGTH*self.MAXOPCODELEN)
+    for a in range(low, min(addr + length, len(self.Blocks))):
+      block = self.Blocks[a]
+      if (block is not None) and (block.start < addr + length) and (block.end > addr):
+        self.Blocks[a] = None
+
+  def runCompiled(self, maxcycles=None, ignorebp=None):
+    """
+    Same as runCached(), but runs the program a basic block at a time, with
+    each block compiled to a Python function the first time it's reached.
+    See BlockCompiler.
+
+    Breakpoints are never compiled into a block, and setting one throws
+    away the blocks it's in. Blocks that would go past maxcycles, and
+    blocks that can't run (eg. because they would under or overflow,
+    or raise) are interpreted by runCached() instead. So are blocks that
+    have been written to since they were compiled, which get compiled again
+    next time.
+    """
+    if self.Stopped:
+      raise VMCPUStopped('CPU is stopped')
+
+    blocks = self.Blocks
+    compiler = self.BlockCompiler
+    end = sys.maxsize if maxcycles is None else self.Cycles + maxcycles
+
+    while self.Cycles < end:
+      pc = self.PC
+      block = blocks[pc]
+      if block is None:
+        block = compiler.compile(pc)
+        blocks[pc] = block
+
+      skipbp = ignorebp
+      ignorebp = None
+      if (block.func is None) or (self.Cycles + block.length > end):
+        self.runCached(min(max(block.length, 1), end - self.Cycles), skipbp)
+        continue
+
+      npc = block.func()
+      if npc is None:
+        self.runCached(block.length)
+      else:
+        self.PC = npc
+
+  def runCached(self, maxcycles=None, ignorebp=None):
+    """
+    Run until STOP, a breakpoint, an error, or until maxcycles opcodes have
+    been executed. Raises the same exceptions as step(), and ignorebp works
+    the same way, for the first opcode only.
+
+    This gives the same results as calling step() in a loop, but the top of
+    the stack, the stack depth, PC and the cycle count are kept in local
+    variables, and the common opcodes work on those directly. Other opcodes,
+    and any opcode that would under or overflow a stack, spill the locals
+    back to the CPU and call the normal handler. The locals are also spilled
+    when the run ends, however it ends, so the stacks are always consistent
+    when the debugger looks at them.
+
+    Immediates followed by a CALL, branch or IO opcode are run from
+    self.Fused as one step, unless maxcycles falls between the two halves,
+    or one of them would fail. A breakpoint on the second half stops them
+    being fused at all. Then they're run one at a
+    time, so the stacks and Cycles always end up the same as stepping.
+
+    The stack is held as Values[0:top-1], with the TOS in tos.
+    """
+    if self.Stopped:
+      raise VMCPUStopped('CPU is stopped')
+
+    OP = self.Opcodes.OPCODENUM
+    O_PLUS, O_MINUS, O_TIMES, O_DIV = OP['+'], OP['-'], OP['*'], OP['/']
+    O_DUP, O_DROP, O_SWAP, O_OVER = OP['DUP'], OP['DROP'], OP['SWAP'], OP['OVER']
+    O_TGT, O_TLT, O_TGE, O_TLE, O_TZ = OP['TGT'], OP['TLT'], OP['TGE'], OP['TLE'], OP['TZ']
+    O_BZ, O_BNZ, O_BRA = OP['BZ'], OP['BNZ'], OP['BRA']
+    O_CALL, O_RET, O_EXIT = OP['CALL'], OP[';'], OP['EXIT']
+    O_FETCH, O_WAIT, O_NOP = OP['@'], OP['WAIT'], OP['NOP']
+    F = self.FUSEDOPS
+    F_CALL, F_BZ, F_BNZ, F_BRA, F_IOR, F_IOW = F['CALL'], F['BZ'], F['BNZ'], F['BRA'], F['IOR'], F['IOW']
+
+    S = self.Stack
+    V = S.Values
+    size = S.Size
+    C = self.CallStack
+    csize = C.Size
+    R = array.array('f', [0.0]) # Rounds results to float32, like a push does
+    decoded = self.Fused
+    O_TRAP = self.TRAPOP
+    conditions = self.BPConditions
+    sim = self.Sim
+    systime = self.SysTime
+    limit = sys.maxsize if maxcycles is None else maxcycles
+
+    pc = self.PC
+    top = S.Top
+    tos = V[top-1] if top else 0.0
+    peak = S.HighWater
+    cbase = self.Cycles
+    cycles = 0
+    synced = 0  # Value of cycles when SysTime was last brought up to date
+    spilled = False
+
+    try:
+      while cycles < limit:
+        ins = decoded[pc]
+        if ins is None:
+          ins = self.fuse(pc)
+
+        pc = ins.nextpc
+        cycles += 1
+        op = ins.op
+
+        if ins.operand is not None:
+          if op >= 0x100:
+            if (top < size) and (cycles < limit):
+              a = ins.operand
+              if op == F_CALL:
+                if C.Top < csize:
+                  cycles += 1
+                  C.pushF(pc)
+                  pc = int(round(a))
+                  continue
+
+              elif op == F_BZ:
+                if top >= 1:
+                  cycles += 1
+                  x = tos
+                  top -= 1
+                  tos = V[top-1]
+                  if x == 0:
+                    pc = int(round(a))
+                  continue
+
+              elif op == F_BNZ:
+                if top >= 1:
+                  cycles += 1
+                  x = tos
+                  top -= 1
+                  tos = V[top-1]
+                  if x != 0:
+                    pc = int(round(a))
+                  continue
+
+              elif op == F_BRA:
+                cycles += 1
+                pc = int(round(a))
+                continue
+
+              elif op == F_IOR:
+                cycles += 1
+                systime.Ticks += cycles - synced
+                synced = cycles
+                R[0] = sim.ioReadF(a)
+                V[top-1] = tos
+                tos = R[0]
+                top += 1
+                if top > peak:
+                  peak = top
+                continue
+
+              elif op == F_IOW:
+                if top >= 1:
+                  cycles += 1
+                  systime.Ticks += cycles - synced
+                  synced = cycles
+                  x = tos
+                  top -= 1
+                  tos = V[top-1]
+                  sim.ioWriteF(x, a)
+                  continue
+
+            # Can't run the pair as one, so just run the immediate
+            pc = ins.first.nextpc
+
+          if top < size:
+            V[top-1] = tos
+            tos = ins.operand
+            top += 1
+            if top > peak:
+              peak = top
+            continue
+
+        elif op == O_PLUS:
+          if top >= 2:
+            top -= 1
+            R[0] = V[top-1] + tos
+            tos = R[0]
+            continue
+
+        elif op == O_DUP:
+          if 1 <= top < size:
+            V[top-1] = tos
+            top += 1
+            if top > peak:
+              peak = top
+            continue
+
+        elif op == O_SWAP:
+          if top >= 2:
+            V[top-2], tos = tos, V[top-2]
+            continue
+
+        elif op == O_OVER:
+          if 2 <= top < size:
+            V[top-1] = tos
+            tos = V[top-2]
+            top += 1
+            if top > peak:
+              peak = top
+            continue
+
+        elif op == O_DROP:
+          if top >= 1:
+            top -= 1
+            tos = V[top-1]
+            continue
+
+        elif op == O_BZ:
+          if top >= 2:
+            x = V[top-2]
+            a = tos
+            top -= 2
+            tos = V[top-1]
+            if x == 0:
+              pc = int(round(a))
+            continue
+
+        elif op == O_BNZ:
+          if top >= 2:
+            x = V[top-2]
+            a = tos
+            top -= 2
+            tos = V[top-1]
+            if x != 0:
+              pc = int(round(a))
+            continue
+
+        elif op == O_BRA:
+          if top >= 1:
+            a = tos
+            top -= 1
+            tos = V[top-1]
+            pc = int(round(a))
+            continue
+
+        elif op == O_CALL:
+          if top >= 1:
+            C.pushF(pc)
+            a = tos
+            top -= 1
+            tos = V[top-1]
+            pc = int(round(a))
+            continue
+
+        elif (op == O_RET) or (op == O_EXIT):
+          pc = int(round(C.popF()))
+          continue
+
+        elif op == O_MINUS:
+          if top >= 2:
+            top -= 1
+            R[0] = V[top-1] - tos
+            tos = R[0]
+            continue
+
+        elif op == O_TIMES:
+          if top >= 2:
+            top -= 1
+            R[0] = V[top-1] * tos
+            tos = R[0]
+            continue
+
+        elif op == O_DIV:
+          if top >= 2:
+            R[0] = V[top-2] / tos
+            top -= 1
+            tos = R[0]
+            continue
+
+        elif op == O_TGE:
+          if top >= 2:
+            top -= 1
+            tos = 1.0 if V[top-1] >= tos else 0.0
+            continue
+
+        elif op == O_TGT:
+          if top >= 2:
+            top -= 1
+            tos = 1.0 if V[top-1] > tos else 0.0
+            continue
+
+        elif op == O_TLE:
+          if top >= 2:
+            top -= 1
+            tos = 1.0 if V[top-1] <= tos else 0.0
+            continue
+
+        elif op == O_TLT:
+          if top >= 2:
+            top -= 1
+            tos = 1.0 if V[top-1] < tos else 0.0
+            continue
+
+        elif op == O_TZ:
+          if top >= 1:
+            tos = 1.0 if tos == 0 else 0.0
+            continue
+
+        elif op == O_FETCH:
+          if top >= 1:
+            tos = self.memFetchF(tos)
+            continue
+
+        elif op == O_WAIT:
+          systime.Ticks += cycles - synced
+          synced = cycles
+          systime.waitTilNextACZero()
+          continue
+
+        elif op == O_NOP:
+          continue
+
+        elif op == O_TRAP:
+          here = pc - ins.length
+          if (cycles != 1) or (here != ignorebp):
+            # Stop at it, with the opcode not run, unless it has a
+            # condition that's false. The condition sees the real stacks.
+            pc = here
+            cycles -= 1
+            if here in conditions:
+              if top:
+                V[top-1] = tos
+              S.Top = top
+              self.PC = pc
+              self.Cycles = cbase + cycles
+              systime.Ticks += cycles - synced
+              synced = cycles
+
+            if self.breakHere(here):
+              raise VMCPUBreakpoint('Breakpoint hit')
+
+            pc = ins.nextpc
+            cycles += 1
+
+          # Not stopping, so run what it replaced the slow way
+          ins = ins.original
+
+        # Anything else goes through the normal handler, on the real stacks
+        if top:
+          V[top-1] = tos
+        S.Top = top
+        S.HighWater = peak
+        self.PC = pc
+        self.Cycles = cbase + cycles
+        systime.Ticks += cycles - synced
+        synced = cycles
+        spilled = True
+
+        if ins.operand is None:
+          ins.handler()
+        else:
+          ins.handler(ins.operand)
+
+        spilled = False
+        pc = self.PC
+        top = S.Top
+        tos = V[top-1] if top else 0.0
+        peak = S.HighWater
+
+    finally:
+      if not spilled:
+        if top:
+          V[top-1] = tos
+        S.Top = top
+        S.HighWater = peak
+        S.Changed = True
+        self.PC = pc
+
+      self.Cycles = cbase + cycles
+      systime.Ticks += cycles - synced
+
+  def ioWrite(self, x, y):
+    self.Sim.ioWriteF(x, y)
+
+  def ioRead(self, x):
+    self.Stack.pushF(self.Sim.ioReadF(x))
+
+  def memStore(self, val, addr):
+    addri = int(round(addr))
+    if addri < 0x100:
+      # Write to scratch
+      self.Scratch[addri:addri+4] = array.array('B', toFBytes(val))
+      return
+
+    if (addri >= 0x1010) and (addri < 0x1020):
+      # Write to packet TX
+      addri = addri - 0x1010
+      self.TXPacket[addri:addri+4] = array.array('B', toFBytes(val))
+      return
+
+    if (addri >= 0x2000) and (addri < 0x2400):
+      # Write directly into program RAM
+      addri = addri - 0x2000
+      self.ROM[addri:addri+4] = array.array('B', toFBytes(val))
+      self.invalidate(addri, 4)
+      return
+
+    raise VMCPUInvalidWrite('Write to invalid address')
+
+  def memStoreB(self, val, addr):
+    addri = int(round(addr))
+    if addri < 0x100:
+      # Write to scratch
+      self.Scratch[addri] = int(round(val))
+      return
+
+    if (addri >= 0x1010) and (addri < 0x1020):
+      # Write to packet TX
+      self.TXPacket[addri - 0x1010] = int(round(val))
+      return
+
+    if (addri >= 0x2000) and (addri < 0x2400):
+      # Write directly into program RAM
+      addri = addri - 0x2000
+      self.ROM[addri] = int(round(val))
+      self.invalidate(addri, 1)
+      return
+
+    raise VMCPUInvalidWrite('Write to invalid address')
+
+  """
+  OPCODES START HERE. Same as CPU, but on raw floats.
+  """
+
+  def DUP(self):
+    self.Stack.pushF(self.Stack.readF(0))
+
+  def DROP(self):
+    self.Stack.popF()
+
+  def OVER(self):
+    self.Stack.pushF(self.Stack.readF(1))
+
+  def SWAP(self):
+    x, y = self.Stack.pop2F()
+    self.Stack.pushF(y)
+    self.Stack.pushF(x)
+
+  def COPY(self):
+    x = self.Stack.popF()
+    self.Stack.pushF(self.Stack.readF(int(round(x))))
+
+  def ROT(self):
+    c = self.Stack.popF()
+    b = self.Stack.popF()
+    a = self.Stack.popF()
+    self.Stack.pushF(b)
+    self.Stack.pushF(c)
+    self.Stack.pushF(a)
+
+  def NROT(self):
+    c = self.Stack.popF()
+    b = self.Stack.popF()
+    a = self.Stack.popF()
+    self.Stack.pushF(c)
+    self.Stack.pushF(a)
+    self.Stack.pushF(b)
+
+  def PLUS(self):
+    x, y = self.Stack.pop2F()
+    self.Stack.pushF(x+y)
+
+  def MINUS(self):
+    x, y = self.Stack.pop2F()
+    self.Stack.pushF(x-y)
+
+  def TIMES(self):
+    x, y = self.Stack.pop2F()
+    self.Stack.pushF(x*y)
+
+  def DIV(self):
+    x, y = self.Stack.pop2F()
+    self.Stack.pushF(x/y)
+
+  def POW(self):
+    x, y = self.Stack.pop2F()
+    self.Stack.pushF(math.pow(x, y))
+
+  def NEG(self):
+    self.Stack.pushF(-self.Stack.popF())
+
+  def REC(self):
+    self.Stack.pushF(1.0/self.Stack.popF())
+
+  def TZ(self):
+    self.Stack.pushF(1.0 if self.Stack.popF() == 0 else 0.0)
+
+  def TGT(self):
+    x, y = self.Stack.pop2F()
+    self.Stack.pushF(1.0 if x > y else 0.0)
+
+  def TLT(self):
+    x, y = self.Stack.pop2F()
+    self.Stack.pushF(1.0 if x < y else 0.0)
+
+  def TGE(self):
+    x, y = self.Stack.pop2F()
+    self.Stack.pushF(1.0 if x >= y else 0.0)
+
+  def TLE(self):
+    x, y = self.Stack.pop2F()
+    self.Stack.pushF(1.0 if x <= y else 0.0)
+
+  def TIN(self):
+    x = self.Stack.popF()
+    self.Stack.pushF(1.0 if (math.isnan(x) or math.isinf(x)) else 0.0)
+
+  def OR(self):
+    x, y = self.Stack.pop2F()
+    self.Stack.pushF(float(int(round(x)) | int(round(y))))
+
+  def AND(self):
+    x, y = self.Stack.pop2F()
+    self.Stack.pushF(float(int(round(x)) & int(round(y))))
+
+  def XOR(self):
+    x, y = self.Stack.pop2F()
+    self.Stack.pushF(float(int(round(x)) ^ int(round(y))))
+
+  def BINV(self):
+    self.Stack.pushF(float(~int(round(self.Stack.popF()))))
+
+  def BNZ(self):
+    x, a = self.Stack.pop2F()
+    if x != 0:
+      self.PC = int(round(a))
+
+  def BZ(self):
+    x, a = self.Stack.pop2F()
+    if x == 0:
+      self.PC = int(round(a))
+
+  def BRA(self):
+    self.PC = int(round(self.Stack.popF()))
+
+  def CALL(self):
+    self.CallStack.pushF(self.PC)  # PC should already be pointing to the next instruction
+    self.PC = int(round(self.Stack.popF()))
+
+  def RET(self):
+    self.PC = int(round(self.CallStack.popF()))
+
+  def EXIT(self):
+    self.PC = int(round(self.CallStack.popF()))
+
+  def TOR(self):
+    self.CallStack.pushF(self.Stack.popF())
+
+  def FROMR(self):
+    self.Stack.pushF(self.CallStack.popF())
+
+  def COPYR(self):
+    self.Stack.pushF(self.CallStack.readF(0))
+
+  def IMM(self, imm, symbol=None):
+    self.Stack.pushF(imm)
+
+  def STORE(self):
+    x, y = self.Stack.pop2F()
+    self.memStore(x, y)
+
+  def FETCH(self):
+    self.Stack.pushF(self.memFetchF(self.Stack.popF()))
+
+  def STOREB(self):
+    x, y = self.Stack.pop2F()
+    self.memStoreB(x, y)
+
+  def FETCHB(self):
+    self.Stack.pushF(self.memFetchBF(self.Stack.popF()))
+
+  def TXP(self):
+    self.Stack.pushF(1)
+
+  def RXP(self):
+    self.Stack.pushF(1)
+
+  def IOR(self):
+    self.ioRead(self.Stack.popF())
+
+  def IOW(self):
+    x, y = self.Stack.pop2F()
+    self.ioWrite(x, y)
+
+  def IORT(self):
+    self.ioReadTarget(self.Stack.popF())
+
+  def FOR(self):
+    index, nextblockaddr = self.Stack.pop2F()
+    limit, step = self.Stack.pop2F()
+
+    if step > 0.0:
+      enterloop = index < limit
+    elif step < 0.0:
+      enterloop = index > limit
+    else:
+      enterloop = False
+
+    if enterloop:
+      self.CallStack.pushF(limit)
+      self.CallStack.pushF(step)
+      self.CallStack.pushF(index)
+      self.CallStack.pushF(self.PC)
+    else:
+      # Just branch to end of loop
+      self.PC = int(round(nextblockaddr))
+
+  def ENDFOR(self):
+    index, startaddr = self.CallStack.pop2F()
+    limit, step = self.CallStack.pop2F()
+
+    index = index + step
+    if step > 0:
+      leave = index >= limit
+    else:
+      leave = index <= limit
+
+    if not leave:
+      self.CallStack.pushF(limit)
+      self.CallStack.pushF(step)
+      self.CallStack.pushF(index)
+      self.CallStack.pushF(startaddr)
+      self.PC = int(round(startaddr))
+
+  def INDEX(self):
+    posi = int(round(self.Stack.popF()))*4 + 1
+    self.Stack.pushF(self.CallStack.readF(posi))
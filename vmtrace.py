@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Binary execution traces.
+
+A Tracer records every opcode a CPU runs, and every IO read and write, as
+fixed size binary records. They go into a preallocated ring buffer, which
+keeps the most recent ones, or are written in blocks to a trace file, which
+keeps them all. Nothing is printed.
+
+A Trace reads them back, from a file or a Tracer, and can select records by
+cycle range, address range or word. It uses numpy if it's there, and plain
+tuples if it isn't.
+
+Usage: python3 vmtrace.py prog.trace [prog.debug] [--word W] [--cycles A:B] [--addrs A:B]
+"""
+from collections import namedtuple
+import struct, sys
+from opcodes import OpCodes
+from disasm import DebugDis
+import ioconsts
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+MAGIC = b"FROTHTR1"
+
+# One record. For an opcode, value is the TOS before it runs (NaN if the
+# stack is empty), and op is its first byte. For IO, op is the channel, and
+# value is what was read or written. cycle and ticks are from before the
+# opcode that did it.
+RECORD = struct.Struct("<QQHBBf")
+TraceRecord = namedtuple("TraceRecord", "cycle, ticks, pc, op, kind, value")
+
+# Record kinds
+OPCODE = 0
+IOREAD = 1
+IOWRITE = 2
+
+if numpy is not None:
+  DTYPE = numpy.dtype([('cycle', '<u8'), ('ticks', '<u8'), ('pc', '<u2'), ('op', 'u1'),
+    ('kind', 'u1'), ('value', '<f4')])
+
+class Tracer:
+  """
+  Records a CPU's execution. Run the CPU with run(), which is CPU.run()
+  with the tracer watching. capacity is the size of the buffer, in records.
+  With no filename it's a ring buffer, and keeps the last capacity records.
+  With a filename, it's written to that file every time it fills, and
+  close() writes what's left.
+  """
+  def __init__(self, cpu, capacity=1 << 16, filename=None):
+    self.CPU = cpu
+    self.Capacity = capacity
+    self.Buffer = bytearray(capacity * RECORD.size)
+    self.Count = 0
+    self.File = None
+    if filename is not None:
+      self.File = open(filename, 'wb')
+      self.File.write(MAGIC)
+
+  def add(self, cycle, ticks, pc, op, kind, value):
+    i = self.Count % self.Capacity
+    RECORD.pack_into(self.Buffer, i * RECORD.size, cycle, ticks, pc, op, kind, value)
+    self.Count += 1
+    if (self.File is not None) and (i == self.Capacity - 1):
+      self.File.write(self.Buffer)
+
+  def opcode(self, pc, ins):
+    cpu = self.CPU
+    stack = cpu.Stack
+    tos = stack.Values[stack.Top-1] if stack.Top else float('nan')
+    self.add(cpu.Cycles, cpu.SysTime.Ticks, pc, cpu.ROM[pc], OPCODE, tos)
+
+  def ioRead(self, x):
+    cpu = self.CPU
+    cpu.__class__.ioRead(cpu, x)
+    chan = int(round(x.float if cpu.Symbolic else x))
+    stack = cpu.Stack
+    self.add(cpu.Cycles - 1, cpu.SysTime.Ticks - 1, cpu.PC - 1, chan, IOREAD, stack.Values[stack.Top-1])
+
+  def ioWrite(self, x, y):
+    cpu = self.CPU
+    value, chan = (x.float, y.float) if cpu.Symbolic else (x, y)
+    self.add(cpu.Cycles - 1, cpu.SysTime.Ticks - 1, cpu.PC - 1, int(round(chan)), IOWRITE, value)
+    cpu.__class__.ioWrite(cpu, x, y)
+
+  def run(self, max_cycles=None, until_ticks=None, ignorebp=None):
+    """
+    CPU.run(), recording everything it does
+    """
+    cpu = self.CPU
+    cpu.ioRead = self.ioRead
+    cpu.ioWrite = self.ioWrite
+    try:
+      return cpu.run(max_cycles, until_ticks, ignorebp, observer=self.opcode)
+    finally:
+      del cpu.ioRead
+      del cpu.ioWrite
+
+  def data(self):
+    """
+    The records in the buffer, oldest first, as bytes
+    """
+    i = self.Count % self.Capacity
+    if (self.Count < self.Capacity) or (self.File is not None):
+      return bytes(self.Buffer[:i * RECORD.size])
+
+    return bytes(self.Buffer[i * RECORD.size:] + self.Buffer[:i * RECORD.size])
+
+  def close(self):
+    if self.File is not None:
+      self.File.write(self.data())
+      self.File.close()
+      self.File = None
+
+class Trace:
+  """
+  Trace records, from a file written by a Tracer, or from a Tracer's
+  buffer. records is a numpy structured array, or a list of TraceRecords
+  without numpy.
+  """
+  Opcodes = OpCodes()
+  IOConsts = ioconsts.IOConsts()
+
+  def __init__(self, source, debug=None):
+    if isinstance(source, Tracer):
+      data = source.data()
+    else:
+      with open(source, 'rb') as infile:
+        data = infile.read()
+
+      if data[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{source} isn't a trace file")
+
+      data = data[len(MAGIC):]
+
+    self.D = debug
+    self.Records = self.fromBytes(data)
+
+  def fromBytes(self, data):
+    if numpy is not None:
+      return numpy.frombuffer(data, dtype=DTYPE)
+
+    return [TraceRecord(*r) for r in RECORD.iter_unpack(data)]
+
+  def __len__(self):
+    return len(self.Records)
+
+  def __iter__(self):
+    for r in self.Records:
+      yield TraceRecord(*(r.tolist() if numpy is not None else r))
+
+  def wordRange(self, word):
+    """
+    Returns (first, last) addresses of word. Needs the program's debug info.
+    """
+    starts = sorted(addr for num, addr in self.D.Words.values())
+    first = self.D.Words[word][1]
+    later = [a for a in starts if a > first]
+    return (first, (later[0] if later else len(self.D.MemBytes)) - 1)
+
+  def select(self, cycles=None, addrs=None, word=None, kinds=None):
+    """
+    The records in a range of cycles, (first, last), and/or a range of
+    addresses, (first, last), or in a word. kinds is a set of record kinds.
+    Ranges include both ends.
+    """
+    if word is not None:
+      addrs = self.wordRange(word)
+
+    records = self.Records
+    if numpy is not None:
+      keep = numpy.ones(len(records), dtype=bool)
+      if cycles is not None:
+        keep &= (records['cycle'] >= cycles[0]) & (records['cycle'] <= cycles[1])
+      if addrs is not None:
+        keep &= (records['pc'] >= addrs[0]) & (records['pc'] <= addrs[1])
+      if kinds is not None:
+        keep &= numpy.isin(records['kind'], list(kinds))
+      return records[keep]
+
+    return [r for r in records
+      if ((cycles is None) or (cycles[0] <= r.cycle <= cycles[1]))
+      and ((addrs is None) or (addrs[0] <= r.pc <= addrs[1]))
+      and ((kinds is None) or (r.kind in kinds))]
+
+  def format(self, record):
+    """
+    One line of text for a record, from records or from iterating
+    """
+    cycle, ticks, pc, op, kind, value = (record.tolist() if hasattr(record, 'tolist') else record)
+    if kind == OPCODE:
+      name = "IMM" if op & 0x80 else self.Opcodes.OPCODENAME.get(op, f"{op:02X}")
+      return f"{cycle:10d} {ticks:10d} {pc:5d} {name:8s} TOS {value}"
+
+    what = "ioRead " if kind == IOREAD else "ioWrite"
+    return f"{cycle:10d} {ticks:10d} {pc:5d} {what}  {self.IOConsts.IOCONSTNAME.get(op, op)} {value}"
+
+def parseRange(text):
+  first, last = text.split(':')
+  return (int(first), int(last))
+
+def main(argv):
+  if len(argv) < 2:
+    print(__doc__)
+    return
+
+  args = argv[1:]
+  options = {}
+  while len(args) > 2 and args[-2].startswith('--'):
+    options[args[-2][2:]] = args[-1]
+    args = args[:-2]
+
+  if ('word' in options) and (len(args) < 2):
+    print("--word needs the program's .debug file", file=sys.stderr)
+    return
+
+  debug = DebugDis(args[1]) if len(args) > 1 else None
+  if ('word' in options) and (options['word'] not in debug.Words):
+    print(f"No word {options['word']} in {args[1]}", file=sys.stderr)
+    return
+
+  trace = Trace(args[0], debug)
+  records = trace.select(
+    cycles = parseRange(options['cycles']) if 'cycles' in options else None,
+    addrs = parseRange(options['addrs']) if 'addrs' in options else None,
+    word = options.get('word'))
+
+  for r in records:
+    print(trace.format(r))
+
+if __name__ == "__main__":
+  main(sys.argv)